@@ -0,0 +1,56 @@
+import argparse
+import json
+import statistics
+import sys
+
+# Compares two run_bench reports case by case and exits non-zero on a throughput
+# regression larger than the threshold.
+
+def load(path):
+    with open(path) as f:
+        report = json.load(f)
+    cases = {}
+    for result in report['results']:
+        key = (result['profile'], result['size'], str(result['threads']))
+        cases.setdefault(key, []).append(result)
+    return report.get('meta', {}), cases
+
+def median(results, field):
+    values = [r[field] for r in results if r.get('ok') and r.get(field) is not None]
+    return statistics.median(values) if values else None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare two benchmark reports")
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=0.10, help="allowed throughput drop (0.10 = 10%%)")
+    args = parser.parse_args(argv)
+
+    base_meta, base = load(args.base)
+    new_meta, new = load(args.new)
+    print(f"base {base_meta.get('revision')}  new {new_meta.get('revision')}")
+    print(f"{'profile':8} {'size':>11} {'threads':>7} {'base MB/s':>10} {'new MB/s':>10} {'change':>8} "
+          f"{'ttfb ms':>8} {'rss MB':>7}")
+    regressions = 0
+    for key in sorted(set(base) & set(new), key=lambda k: (k[0], k[1], k[2])):
+        old_rate = median(base[key], 'throughput')
+        new_rate = median(new[key], 'throughput')
+        ttfb = median(new[key], 'ttfb')
+        rss = median(new[key], 'peak_rss')
+        if old_rate and new_rate:
+            change = new_rate / old_rate - 1
+            flag = '  REGRESSION' if change < -args.threshold else ''
+            regressions += bool(flag)
+            change_text = f"{change:+8.1%}"
+        else:
+            # A case that used to pass and now fails counts as a regression
+            flag = '  REGRESSION' if old_rate and not new_rate else ''
+            regressions += bool(flag)
+            change_text = f"{'n/a':>8}"
+        print(f"{key[0]:8} {key[1]:>11} {key[2]:>7} "
+              f"{(old_rate or 0) / 1048576:10.1f} {(new_rate or 0) / 1048576:10.1f} {change_text} "
+              f"{(ttfb or 0) * 1000:8.1f} {(rss or 0) / 1048576:7.1f}{flag}")
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,302 @@
+import argparse
+import os
+import random
+import re
+import select
+import socket
+import ssl
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local HTTP server for benchmarks. GET /file/<size> serves <size> bytes of
+# deterministic data, so any byte range can be produced without keeping files around.
+# With redirects=N the file is reached through N hops of /hop/<n>/file/<size>.
+# With tls=True it serves HTTPS with a throwaway self-signed certificate, and with
+# http2=True as well, clients that pick h2 in ALPN get HTTP/2 (needs the h2 package).
+
+BLOCK = random.Random(1234).randbytes(1048576)
+WRITE_SIZE = 65536
+
+def content(start, length):
+    out = bytearray()
+    pos = start
+    end = start + length
+    while pos < end:
+        offset = pos % len(BLOCK)
+        piece = BLOCK[offset:offset + (end - pos)]
+        out += piece
+        pos += len(piece)
+    return bytes(out)
+
+class RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Tuned through make_server()
+    rate = 0  # Bytes per second per connection, 0 for unlimited
+    latency = 0.0  # Seconds before each response starts
+    reset_probability = 0.0  # Chance per 64 KB write to drop the connection with a RST
+    error_probability = 0.0  # Chance per Range request to answer 503 with Retry-After
+    stall_probability = 0.0  # Chance per 64 KB write to go silent for stall_seconds
+    stall_seconds = 30.0
+    redirects = 0
+    reject_head = False  # Answer HEAD with 405 like some object stores do
+    ignore_range = False
+    etag = '"bench-1"'
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        if isinstance(self.request, ssl.SSLSocket):
+            self.request.do_handshake()
+        super().setup()
+
+    def handle(self):
+        if isinstance(self.request, ssl.SSLSocket) and self.request.selected_alpn_protocol() == 'h2':
+            self.handle_h2()
+        else:
+            super().handle()
+
+    def handle_h2(self):
+        # Serves the same files over HTTP/2: every stream gets its share of each pass,
+        # as far as flow control allows
+        import h2.config
+        import h2.connection
+        import h2.events
+        sock = self.request
+        conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False, header_encoding='utf-8'))
+        conn.initiate_connection()
+        sock.sendall(conn.data_to_send())
+        streams = {}  # stream id -> [next byte, last byte]
+        try:
+            while True:
+                sendable = [sid for sid in streams if conn.local_flow_control_window(sid) > 0]
+                if not sendable or sock.pending() or select.select([sock], [], [], 0)[0]:
+                    data = sock.recv(65536)
+                    if not data:
+                        return
+                    for event in conn.receive_data(data):
+                        if isinstance(event, h2.events.RequestReceived):
+                            self.h2_request(conn, event.stream_id, dict(event.headers), streams)
+                        elif isinstance(event, h2.events.StreamReset):
+                            streams.pop(event.stream_id, None)
+                        elif isinstance(event, h2.events.ConnectionTerminated):
+                            return
+                for sid in [sid for sid in streams if conn.local_flow_control_window(sid) > 0]:
+                    pos, end = streams[sid]
+                    n = min(conn.local_flow_control_window(sid), conn.max_outbound_frame_size, end - pos + 1)
+                    if n > 0:
+                        conn.send_data(sid, content(pos, n), end_stream=pos + n > end)
+                        streams[sid][0] += n
+                        if pos + n > end:
+                            del streams[sid]
+                sock.sendall(conn.data_to_send())
+        except (OSError, ssl.SSLError):
+            pass
+
+    def h2_request(self, conn, stream_id, headers, streams):
+        match = re.fullmatch(r'/file/(\d+)(?:\?.*)?', headers.get(':path', ''))
+        if not match:
+            conn.send_headers(stream_id, [(':status', '404'), ('content-length', '0')], end_stream=True)
+            return
+        size = int(match.group(1))
+        start, end = 0, size - 1
+        status = '200'
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', headers.get('range', '').strip())
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            status = '206'
+            if start > end:
+                conn.send_headers(stream_id, [(':status', '416'), ('content-range', f'bytes */{size}')],
+                                  end_stream=True)
+                return
+        response = [(':status', status), ('content-length', str(end - start + 1)), ('accept-ranges', 'bytes'),
+                    ('etag', self.etag), ('content-type', 'application/octet-stream')]
+        if status == '206':
+            response.append(('content-range', f'bytes {start}-{end}/{size}'))
+        head = headers.get(':method') == 'HEAD'
+        conn.send_headers(stream_id, response, end_stream=head)
+        if not head:
+            streams[stream_id] = [start, end]
+
+    def do_HEAD(self):
+        if self.reject_head:
+            self.send_response(405)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def respond(self, send_body):
+        match = re.fullmatch(r'(?:/hop/(\d+))?/file/(\d+)(?:\?.*)?', self.path)
+        if not match:
+            self.send_error(404)
+            return
+        hop = int(match.group(1) or 0)
+        size = int(match.group(2))
+        if hop < self.redirects:
+            self.send_response(302)
+            self.send_header('Location', f'/hop/{hop + 1}/file/{size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_probability and 'Range' in self.headers and random.random() < self.error_probability:
+            self.send_response(503)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        start, end = 0, size - 1
+        rng = self.headers.get('Range')
+        ranged = False
+        if rng and not self.ignore_range:
+            match = re.fullmatch(r'bytes=(\d+)-(\d*)', rng.strip())
+            if match:
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+                ranged = True
+            if start >= size or start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+        self.send_response(206 if ranged else 200)
+        if ranged:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        if not self.ignore_range:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.end_headers()
+        if send_body:
+            self.send_body(start, end)
+
+    def send_body(self, start, end):
+        pos = start
+        began = time.monotonic()
+        sent = 0
+        try:
+            while pos <= end:
+                n = min(WRITE_SIZE, end - pos + 1)
+                if self.reset_probability and random.random() < self.reset_probability:
+                    self.reset()
+                    return
+                if self.stall_probability and random.random() < self.stall_probability:
+                    time.sleep(self.stall_seconds)
+                self.wfile.write(content(pos, n))
+                pos += n
+                sent += n
+                if self.rate:
+                    ahead = sent / self.rate - (time.monotonic() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def reset(self):
+        # SO_LINGER with a zero timeout makes close() send a RST instead of a FIN
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self.connection.close()
+        self.close_connection = True
+
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 512
+    context = None  # SSL context when serving HTTPS
+    certfile = None
+
+    def get_request(self):
+        sock, address = super().get_request()
+        if self.context is not None:
+            # The handshake happens in the handler thread
+            sock = self.context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+        return sock, address
+
+    def handle_error(self, request, client_address):
+        pass
+
+def self_signed_cert(host):
+    # Certificate and key for host in a temporary directory, made with the openssl CLI
+    directory = tempfile.mkdtemp(prefix='kdm-bench-tls-')
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    san = f"IP:{host}" if re.fullmatch(r'[\d.]+', host) else f"DNS:{host}"
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-subj', f'/CN={host}', '-addext', f'subjectAltName={san}',
+                    '-keyout', keyfile, '-out', certfile], check=True, capture_output=True)
+    return certfile, keyfile
+
+def make_server(host='127.0.0.1', port=0, rate=0, latency=0.0, reset_probability=0.0, ignore_range=False,
+                error_probability=0.0, stall_probability=0.0, stall_seconds=30.0, redirects=0, reject_head=False,
+                tls=False, http2=False):
+    handler = type('Handler', (RangeHandler,), {
+        'rate': rate,
+        'latency': latency,
+        'reset_probability': reset_probability,
+        'ignore_range': ignore_range,
+        'error_probability': error_probability,
+        'stall_probability': stall_probability,
+        'stall_seconds': stall_seconds,
+        'redirects': redirects,
+        'reject_head': reject_head,
+    })
+    server = QuietServer((host, port), handler)
+    if tls or http2:
+        certfile, keyfile = self_signed_cert(host)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        context.set_alpn_protocols(['h2', 'http/1.1'] if http2 else ['http/1.1'])
+        server.context = context
+        server.certfile = certfile
+    return server
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Range-capable HTTP server for benchmarks")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--rate", type=int, default=0, help="bytes per second per connection")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before each response")
+    parser.add_argument("--reset-probability", type=float, default=0.0, help="chance per 64 KB to reset")
+    parser.add_argument("--ignore-range", action="store_true", help="answer every request with 200")
+    parser.add_argument("--error-probability", type=float, default=0.0,
+                        help="chance per Range request to answer 503 with Retry-After: 1")
+    parser.add_argument("--stall-probability", type=float, default=0.0, help="chance per 64 KB to go silent")
+    parser.add_argument("--stall-seconds", type=float, default=30.0, help="how long a stall lasts")
+    parser.add_argument("--redirects", type=int, default=0, help="redirect hops in front of every file")
+    parser.add_argument("--reject-head", action="store_true", help="answer HEAD with 405")
+    parser.add_argument("--tls", action="store_true", help="serve HTTPS with a self-signed certificate")
+    parser.add_argument("--http2", action="store_true", help="serve HTTPS and offer h2 in ALPN")
+    args = parser.parse_args(argv)
+    server = make_server(port=args.port, rate=args.rate, latency=args.latency,
+                         reset_probability=args.reset_probability, ignore_range=args.ignore_range,
+                         error_probability=args.error_probability, stall_probability=args.stall_probability,
+                         stall_seconds=args.stall_seconds, redirects=args.redirects, reject_head=args.reject_head,
+                         tls=args.tls, http2=args.http2)
+    # The port goes out first so a parent process can pick it up, then the certificate
+    # clients have to trust when serving HTTPS
+    print(server.server_address[1], flush=True)
+    if server.certfile:
+        print(server.certfile, flush=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,233 @@
+import argparse
+import hashlib
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Throughput benchmark for MultiThreadDownloader. Every server profile runs in its own
+# process and every case in a fresh child process, so peak RSS and CPU time belong to
+# that one download. Run from the repository root:
+#
+#     python -m bench.run_bench --output results.json
+#     python -m bench.compare before.json results.json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROFILES = {
+    'clean': [],
+    'capped': ['--rate', str(2 * 1048576)],
+    'latency': ['--latency', '0.05'],
+    'flaky': ['--reset-probability', '0.002'],
+    'norange': ['--ignore-range'],
+    'errors': ['--error-probability', '0.2'],
+    'stalls': ['--stall-probability', '0.001', '--stall-seconds', '30'],
+    'redirects': ['--redirects', '3', '--latency', '0.02'],
+    'nohead': ['--reject-head'],
+    'tls': ['--tls'],
+    'h2': ['--http2'],
+}
+
+UNITS = {'K': 1024, 'M': 1048576, 'G': 1073741824}
+
+def parse_size(value):
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in UNITS:
+        return int(float(value[:-1]) * UNITS[value[-1]])
+    return int(value)
+
+def parse_threads(value):
+    # 0 means the downloader's auto mode
+    return 0 if value == 'auto' else int(value)
+
+def expected_md5(size):
+    from bench.range_server import content
+    digest = hashlib.md5()
+    for start in range(0, size, 8388608):
+        digest.update(content(start, min(8388608, size - start)))
+    return digest.hexdigest()
+
+def run_case(url, threads, verify, engine='threads', http2=False):
+    # Runs in the child process; prints one JSON result
+    from kdm import AsyncDownloader, DownloadTask, MultiThreadDownloader
+
+    workdir = tempfile.mkdtemp(prefix='kdm-bench-')
+    result = {'ok': False, 'error': None}
+    try:
+        options = {'http2': http2} if engine == 'async' else {}
+        engine_class = AsyncDownloader if engine == 'async' else MultiThreadDownloader
+        downloader = engine_class(num_threads=threads or 64, auto_threads=not threads,
+                                  profile_path=os.path.join(workdir, 'hosts.json'), **options)
+        probe_start = time.perf_counter()
+        filename, total_size, _ = downloader.get_file_info(url)
+        result['probe_seconds'] = time.perf_counter() - probe_start
+        if not filename:
+            result['error'] = 'Failed to get file info'
+            return result
+        task = DownloadTask(url, os.path.join(workdir, filename), total_size)
+        done = threading.Event()
+        marks = {}
+
+        def received():
+            return max(task.downloaded, sum(max(0, s.pos - s.start) for s in list(task.segments)))
+
+        def sample():
+            # Progress callbacks are batched, so bytes are watched directly
+            while not done.is_set():
+                n = received()
+                if n and 'first_byte' not in marks:
+                    marks['first_byte'] = time.perf_counter()
+                if total_size and n >= total_size and 'all_bytes' not in marks:
+                    marks['all_bytes'] = time.perf_counter()
+                    return
+                time.sleep(0.002)
+
+        def on_error(task, error):
+            result['error'] = error
+            done.set()
+
+        def on_complete(task):
+            marks['complete'] = time.perf_counter()
+            result['ok'] = True
+            done.set()
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        start = time.perf_counter()
+        sampler.start()
+        downloader.start_download(task, lambda task, speed: None, on_complete, on_error)
+        done.set()
+        sampler.join()
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        end = marks.get('complete', time.perf_counter())
+        elapsed = end - start
+        result.update({
+            'bytes': total_size,
+            'seconds': elapsed,
+            'throughput': total_size / elapsed if result['ok'] and elapsed > 0 else 0,
+            'ttfb': marks['first_byte'] - start if 'first_byte' in marks else None,
+            'finalize_seconds': end - marks['all_bytes'] if result['ok'] and 'all_bytes' in marks else None,
+            # ru_maxrss is in KB on Linux and in bytes on macOS
+            'peak_rss': usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+            'cpu_user': usage.ru_utime,
+            'cpu_system': usage.ru_stime,
+        })
+        if result['ok'] and verify:
+            with open(task.filename, 'rb') as f:
+                digest = hashlib.file_digest(f, 'md5').hexdigest() if hasattr(hashlib, 'file_digest') \
+                    else hashlib.md5(f.read()).hexdigest()
+            if digest != expected_md5(total_size):
+                result.update(ok=False, error='Corrupt output')
+        return result
+    except Exception as e:
+        result['error'] = str(e)
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def start_server(profile):
+    server = subprocess.Popen([sys.executable, '-m', 'bench.range_server'] + PROFILES[profile],
+                              cwd=ROOT, stdout=subprocess.PIPE, text=True)
+    port = int(server.stdout.readline())
+    if '--tls' in PROFILES[profile] or '--http2' in PROFILES[profile]:
+        # The certificate path follows the port; clients trust it through the environment
+        return server, f'https://127.0.0.1:{port}', server.stdout.readline().strip()
+    return server, f'http://127.0.0.1:{port}', None
+
+def run_child(url, threads, verify, timeout, engine, http2=False, certfile=None):
+    command = [sys.executable, '-m', 'bench.run_bench', '--child', url, '--threads', str(threads),
+               '--engine', engine]
+    if http2:
+        command.append('--http2')
+    if verify:
+        command.append('--verify')
+    env = dict(os.environ, REQUESTS_CA_BUNDLE=certfile) if certfile else None
+    try:
+        child = subprocess.run(command, cwd=ROOT, capture_output=True, text=True, timeout=timeout, env=env)
+    except subprocess.TimeoutExpired:
+        return {'ok': False, 'error': f'Timed out after {timeout}s'}
+    lines = child.stdout.strip().splitlines()
+    if child.returncode != 0 or not lines:
+        return {'ok': False, 'error': (child.stderr.strip().splitlines() or ['child failed'])[-1]}
+    return json.loads(lines[-1])
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark kdm against a local range server")
+    parser.add_argument('--profiles', default='clean,capped,latency,flaky,norange',
+                        help=f"comma separated, from: {', '.join(PROFILES)}")
+    parser.add_argument('--sizes', default='1M,16M,64M', help="comma separated file sizes, e.g. 512K,1G")
+    parser.add_argument('--threads', default='1,8,32,auto', help="comma separated thread counts or 'auto'")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per case")
+    parser.add_argument('--timeout', type=int, default=300, help="seconds per run")
+    parser.add_argument('--engine', choices=['threads', 'async'], default='threads',
+                        help="download engine to measure; compare two reports to compare engines")
+    parser.add_argument('--http2', action='store_true', help="let the async engine use HTTP/2 where offered")
+    parser.add_argument('--verify', action='store_true', help="check the downloaded bytes afterwards")
+    parser.add_argument('--output', help="write JSON here instead of stdout")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.child:
+        print(json.dumps(run_case(args.child, parse_threads(args.threads), args.verify, args.engine, args.http2)))
+        return 0
+
+    profiles = [p for p in args.profiles.split(',') if p]
+    unknown = [p for p in profiles if p not in PROFILES]
+    if unknown:
+        raise SystemExit(f"unknown profile: {', '.join(unknown)}")
+    sizes = [parse_size(s) for s in args.sizes.split(',') if s]
+    threads = [parse_threads(t) for t in args.threads.split(',') if t]
+
+    results = []
+    for profile in profiles:
+        server, base, certfile = start_server(profile)
+        try:
+            for size in sizes:
+                for count in threads:
+                    for run in range(args.repeat):
+                        result = run_child(f'{base}/file/{size}', count, args.verify, args.timeout, args.engine,
+                                           args.http2, certfile)
+                        result.update(profile=profile, size=size, threads=count or 'auto', run=run)
+                        results.append(result)
+                        rate = f"{result['throughput'] / 1048576:8.1f} MB/s" if result['ok'] else result['error']
+                        print(f"{profile:8} {size:>11} {str(count or 'auto'):>5}  {rate}", file=sys.stderr)
+        finally:
+            server.terminate()
+            server.wait()
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'engine': args.engine,
+            'http2': args.http2,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return 0 if all(r['ok'] for r in results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
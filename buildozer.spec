@@ -15,12 +15,15 @@ source.dir = .
 # (str) Source files to include (let empty to include all the files)
 source.include_exts = py,png,jpg,kv,atlas
 
+# (list) Source directories to exclude
+source.exclude_dirs = bench
+
 # (str) Application versioning (method 1)
 version = 2.0
 
 # (list) Application requirements
 # comma separated e.g. requirements = sqlite3,kivy
-requirements = python3,kivy,kivymd,requests,certifi
+requirements = python3,sqlite3,kivy,kivymd,requests,certifi
 
 # (str) Supported orientation (landscape, sensorLandscape, portrait, sensorPortrait or all)
 orientation = portrait
@@ -0,0 +1,34 @@
+# Download engine without any GUI dependencies. main_kivy.py builds the app on top of
+# it, and `python -m kdm` runs it from the command line.
+import importlib
+
+from .task import DownloadTask
+from .stream import DownloadStream
+from .segments import Segment, SegmentScheduler
+from .storage import OutputFile, ResumeJournal
+from .control import ConnectionBudget, ConnectionController, HostProfiles
+from .metrics import MetricsRegistry
+from .mirrors import Mirror, MirrorSet
+from .ratelimit import BandwidthLimiter, RateSchedule, TokenBucket
+from .scheduler import DownloadScheduler
+from .history import DownloadHistory
+from .downloader import MultiThreadDownloader
+
+# Loaded on first use, like archive support: most runs need neither engine nor daemon
+LAZY = {
+    'AsyncDownloader': 'asyncengine',
+    'DownloadDaemon': 'daemon', 'DaemonClient': 'daemon', 'DaemonError': 'daemon',
+}
+
+def __getattr__(name):
+    if name not in LAZY:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(f'.{LAZY[name]}', __name__), name)
+
+__all__ = [
+    'DownloadTask', 'DownloadStream', 'Segment', 'SegmentScheduler', 'OutputFile', 'ResumeJournal',
+    'ConnectionBudget', 'ConnectionController', 'HostProfiles',
+    'MetricsRegistry', 'Mirror', 'MirrorSet', 'BandwidthLimiter', 'RateSchedule', 'TokenBucket',
+    'DownloadScheduler', 'DownloadHistory', 'MultiThreadDownloader', 'AsyncDownloader',
+    'DownloadDaemon', 'DaemonClient', 'DaemonError',
+]
@@ -0,0 +1,269 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .asynchttp import HttpClient
+from .downloader import MultiThreadDownloader
+from .integrity import PieceHasher
+from .storage import OutputFile
+
+class AsyncDownloader(MultiThreadDownloader):
+    # Same start_download(task, on_progress, on_complete, on_error) contract as
+    # MultiThreadDownloader, but the range connections of every download run as
+    # coroutines on one event loop thread instead of one OS thread each. Pausing or
+    # cancelling cancels them at the next progress tick, even in the middle of a
+    # stalled read. Disk writes, hashing and fsync run on helper threads (writer_threads
+    # of them, at least one) so they never hold up the loop. Downloads without range
+    # support still use a blocking connection on the caller's thread. With http2=True,
+    # HTTPS origins that negotiate h2 get their ranges as streams over a few
+    # multiplexed connections.
+    CHUNK_SIZE = 262144
+    TICK = 0.25
+
+    def __init__(self, *args, http2=False, writer_threads=0, **kwargs):
+        self.loop = asyncio.new_event_loop()
+        self.http = HttpClient(http2=http2)
+        # Takes the place of the threaded engine's WriterStage
+        self.disk = ThreadPoolExecutor(max_workers=max(1, writer_threads))
+        super().__init__(*args, **kwargs)
+        threading.Thread(target=self.loop.run_forever, name="kdm-async", daemon=True).start()
+
+    def stats(self):
+        stats = super().stats()
+        stats['http2'] = {
+            'enabled': self.http.http2,
+            'connections': sum(len(c) for c in self.http.h2.values()),
+            'streams': sum(len(conn.streams) for c in self.http.h2.values() for conn in c),
+            'origins': sorted(f"{scheme}://{host}:{port}" for (scheme, host, port), protocol
+                              in self.http.protocols.items() if protocol == 'h2'),
+        }
+        return stats
+
+    def _size_pool(self, total):
+        pass  # No worker pool; connections only draw slots from the budget
+
+    def _multi_thread_download(self, task, on_progress, on_complete, on_error):
+        # Blocks the calling thread until the download ends, like the threaded engine
+        while asyncio.run_coroutine_threadsafe(
+                self._download(task, on_progress, on_complete, on_error), self.loop).result():
+            pass  # Corrupted pieces were turned back into segments; fetch them
+
+    async def _on_disk(self, fn, *args):
+        return await self.loop.run_in_executor(self.disk, fn, *args)
+
+    async def _download(self, task, on_progress, on_complete, on_error):
+        # Returns True when the download should run again to repair pieces
+        journal, fresh, host, scheduler = self._prepare_run(task)
+        controller = scheduler.controller
+
+        last_update = time.time()
+        last_downloaded = task.downloaded
+
+        try:
+            output = await self._on_disk(OutputFile, task.temp_filename, task.total_size, fresh)
+        except OSError as e:
+            task.status = "failed"
+            on_error(task, str(e))
+            return False
+
+        workers = set()
+        try:
+            self._spawn_tasks(task, scheduler, output, host, workers)
+
+            while True:
+                if task.cancel or task.paused:
+                    # Cancelled mid-read; the cursors already cover every byte written
+                    for worker in workers:
+                        worker.cancel()
+                    await asyncio.gather(*workers, return_exceptions=True)
+                    workers = set()
+                    if task.cancel:
+                        return False
+                    break
+
+                if workers:
+                    _, workers = await asyncio.wait(workers, timeout=self.TICK,
+                                                    return_when=asyncio.FIRST_COMPLETED)
+                elif task.invalidated or task.failure or scheduler.finished() or not controller.may_grow:
+                    break
+                else:
+                    # Only waiting for a connection slot
+                    await asyncio.sleep(self.TICK)
+
+                current_time = time.time()
+                if current_time - last_update >= self.TICK:
+                    task.downloaded = scheduler.confirmed()
+                    elapsed = current_time - last_update
+                    speed = (task.downloaded - last_downloaded) / elapsed if elapsed > 0 else 0
+                    task.speed = speed
+                    task.metrics.sample(current_time, speed, controller.active)
+                    on_progress(task, speed)
+                    last_update = current_time
+                    last_downloaded = task.downloaded
+                    if time.time() - journal.last_sync >= journal.SYNC_INTERVAL:
+                        await self._on_disk(journal.save, output)
+                    if task.digest:
+                        await self._on_disk(task.digest.catch_up, output.read_at,
+                                            scheduler.contiguous(), self.DIGEST_CATCH_UP)
+
+                    controller.sample(task.downloaded, current_time)
+                    if task.mirror_set:
+                        task.mirror_set.sample()
+                    scheduler.steer()
+                    if not scheduler.finished():
+                        self._spawn_tasks(task, scheduler, output, host, workers)
+
+            # Not on the disk threads; a repair may fetch pieces again
+            return await self.loop.run_in_executor(None, self._finish_run, task, scheduler, host, journal,
+                                                   output, on_complete, on_error)
+
+        except Exception as e:
+            on_error(task, str(e))
+            return False
+        finally:
+            for worker in workers:
+                worker.cancel()
+            if workers:
+                await asyncio.gather(*workers, return_exceptions=True)
+            output.close()
+
+    def _spawn_tasks(self, task, scheduler, output, host, workers):
+        # Start connections up to the task's target as far as the shared budget allows
+        controller = scheduler.controller
+        budget = self.budget
+        spare = scheduler.spare()
+        while (spare > 0 and not (task.paused or task.invalidated or task.failure)
+               and controller.may_grow and controller.enlist()):
+            spare -= 1
+            mirror = None
+            if task.mirror_set:
+                mirror = next((m for m in task.mirror_set.candidates() if budget.acquire(m.host)), None)
+                acquired = mirror is not None
+            else:
+                acquired = budget.acquire(host)
+            if not acquired:
+                controller.leave()
+                return
+            workers.add(self.loop.create_task(self._segment_task(
+                task, scheduler, output, mirror.host if mirror else host, mirror)))
+
+    async def _segment_task(self, task, scheduler, output, host, mirror=None):
+        controller = scheduler.controller
+        cell = task.mirror_set.enlist(mirror) if mirror else None
+        retired = False
+        try:
+            while not (task.paused or task.cancel or task.failure):
+                if controller.retire():
+                    retired = True
+                    return
+                if mirror and mirror.evict:
+                    break
+                attempt = scheduler.acquire()
+                if attempt is None:
+                    delay = scheduler.next_retry()
+                    if delay is None:
+                        break
+                    await asyncio.sleep(min(delay, self.TICK))
+                    continue
+                seg, cursor = attempt
+                try:
+                    ok = await self._fetch(task, scheduler, output, seg, cursor, mirror, cell)
+                finally:
+                    scheduler.release(seg, cursor)
+                if not ok and not (task.paused or task.cancel):
+                    controller.record_error()
+        finally:
+            if not retired:
+                controller.leave()
+            if cell:
+                task.mirror_set.leave(mirror, cell)
+            self.budget.release(host)
+
+    def _store(self, task, output, pieces, offset, data):
+        output.write_at(offset, data)
+        if pieces:
+            pieces.feed(offset, data)
+            task.digest.feed_at(offset, data)
+
+    async def _throttle(self, task, n):
+        # BandwidthLimiter.throttle without blocking the loop
+        delay = self.limiter.reserve(task, n)
+        wakeup = self.limiter.wakeup
+        deadline = time.monotonic() + delay
+        while delay > 0 and not (task.paused or task.cancel or wakeup.is_set()):
+            await asyncio.sleep(min(delay, self.TICK))
+            delay = deadline - time.monotonic()
+
+    async def _fetch(self, task, scheduler, output, seg, cursor, mirror=None, cell=None):
+        # download_chunk as a coroutine
+        start = cursor[0]
+        end = seg.end
+        if start > end:
+            return True
+
+        source = mirror or task
+        conn = task.metrics.open(start, end, retry=seg.failures > 0, host=mirror.host if mirror else None)
+        result, error, retry_after = 'error', None, None
+        response = None
+        try:
+            url = source.download_url
+            response = await self.http.get(url, {'Range': f'bytes={start}-{end}'}, self.retry.timeout)
+            conn.response(response.status)
+            error, retry_after = self._check_response(task, mirror, url, response.status, response.headers, start)
+            if error:
+                return False
+
+            offset = start
+            pieces = PieceHasher(task.piece_hashes, task.total_size) if task.checksum else None
+            stall_timeout = self.retry.stall_timeout
+            while True:
+                if task.paused or task.cancel or task.failure:
+                    result = 'stopped'
+                    return False
+                if scheduler.controller.claim() or (mirror and mirror.evict) or seg.preempted:
+                    result = 'stopped'
+                    return True
+                want = min(self.CHUNK_SIZE, seg.end - offset + 1)
+                if want <= 0:
+                    break
+                data = await response.read(want, stall_timeout)
+                if not data:
+                    break
+                data_len = len(data)
+                written = conn.received(data_len)
+                await self._on_disk(self._store, task, output, pieces, offset, data)
+                conn.wrote(written)
+                offset += data_len
+                cursor[0] = offset
+                if cell:
+                    cell[0] += data_len
+                throttled = time.perf_counter()
+                await self._throttle(task, data_len)
+                conn.throttled(throttled)
+                if offset > seg.end or seg.complete:
+                    break
+            done = offset > end or seg.complete
+            result = 'ok' if done else 'error'
+            if not done:
+                error = "Connection closed early"
+            elif mirror:
+                task.mirror_set.succeeded(mirror)
+            return done
+        except asyncio.CancelledError:
+            result = 'stopped'
+            raise
+        except asyncio.TimeoutError:
+            error = "Read timed out"
+            return False
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            return False
+        finally:
+            if response is not None:
+                response.release()
+            if result == 'error':
+                seg.failures += 1
+                if not (task.paused or task.cancel or task.invalidated or task.failure):
+                    self._schedule_retry(task, scheduler, seg, conn.bytes, error, retry_after, mirror)
+            task.metrics.close(conn, result, error)
@@ -0,0 +1,466 @@
+import asyncio
+import os
+import ssl
+from collections import deque
+from urllib.parse import urljoin, urlsplit
+
+from requests.utils import DEFAULT_CA_BUNDLE_PATH
+
+# Just enough HTTP on asyncio streams for ranged GETs: keep-alive HTTP/1.1 connections
+# per origin, redirects, Content-Length, chunked and read-to-close bodies. With http2
+# on and the optional h2 package installed, HTTPS origins that pick h2 in ALPN carry
+# the requests as parallel streams over a few connections instead. Proxies from the
+# environment are not used, unlike with requests.
+
+def h2_available():
+    try:
+        import h2.connection  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+class HTTPError(Exception):
+    pass
+
+class _Connection:
+    def __init__(self, key, reader, writer):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+
+    def close(self):
+        self.writer.close()
+
+class Response:
+    def __init__(self, client, conn, url, status, headers):
+        self.client = client
+        self.conn = conn
+        self.url = url
+        self.status = status
+        self.headers = headers  # Lower-cased names
+        self.chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+        length = headers.get('content-length')
+        self.remaining = int(length) if length and length.isdigit() and not self.chunked else None
+        self.chunk_left = 0
+        self.done = status in (204, 304) or self.remaining == 0
+        self.keep_alive = (headers.get('connection', '').lower() != 'close'
+                           and (self.chunked or self.remaining is not None or status in (204, 304)))
+
+    async def read(self, n, timeout=None):
+        # Up to n bytes of the body as soon as any are available; b'' at the end
+        if self.done:
+            return b''
+        reader = self.conn.reader
+        if self.chunked:
+            if not self.chunk_left:
+                line = await asyncio.wait_for(reader.readline(), timeout)
+                size = int(line.split(b';')[0].strip() or b'0', 16)
+                if not size:
+                    # Skip trailers up to the blank line that ends the body
+                    while (await asyncio.wait_for(reader.readline(), timeout)).strip():
+                        pass
+                    self.done = True
+                    return b''
+                self.chunk_left = size
+            n = min(n, self.chunk_left)
+        elif self.remaining is not None:
+            n = min(n, self.remaining)
+        data = await asyncio.wait_for(reader.read(n), timeout)
+        if not data:
+            if self.remaining is None and not self.chunked:
+                self.done = True
+                return b''
+            raise HTTPError("Connection closed early")
+        if self.chunked:
+            self.chunk_left -= len(data)
+            if not self.chunk_left:
+                await asyncio.wait_for(reader.readexactly(2), timeout)
+        elif self.remaining is not None:
+            self.remaining -= len(data)
+            self.done = not self.remaining
+        return data
+
+    def release(self):
+        # Back to the pool when the body was read to its end, otherwise dropped
+        conn, self.conn = self.conn, None
+        if conn is None:
+            return
+        if self.done and self.keep_alive:
+            self.client.put(conn)
+        else:
+            conn.close()
+
+class _H2Stream:
+    # Response side of one request on an HTTP/2 connection. Data is acknowledged to the
+    # server as it is read, so a slow reader holds back only its own stream.
+    def __init__(self, owner, stream_id, url):
+        self.owner = owner
+        self.stream_id = stream_id
+        self.url = url
+        self.status = None
+        self.headers = {}
+        self.chunks = deque()  # [data, flow-controlled length]
+        self.ended = False
+        self.error = None
+        self.event = asyncio.Event()
+
+    def _wake(self):
+        self.event.set()
+
+    async def wait_headers(self, timeout):
+        while self.status is None and self.error is None:
+            self.event.clear()
+            await asyncio.wait_for(self.event.wait(), timeout)
+        if self.status is None:
+            raise self.error
+
+    async def read(self, n, timeout=None):
+        while not self.chunks:
+            if self.error is not None:
+                raise self.error
+            if self.ended:
+                return b''
+            self.event.clear()
+            await asyncio.wait_for(self.event.wait(), timeout)
+        chunk = self.chunks[0]
+        data = chunk[0]
+        if len(data) > n:
+            chunk[0] = data[n:]
+            return data[:n]
+        self.chunks.popleft()
+        self.owner.acknowledge(self, chunk[1])
+        return data
+
+    def release(self):
+        self.owner.close_stream(self)
+
+class _H2Connection:
+    # One HTTP/2 connection to an origin. A reader task feeds the frames to h2 and
+    # dispatches them to the streams; writes are flushed right after each h2 call.
+    MAX_STREAMS = 100
+    CONNECTION_WINDOW = 16777216
+    STREAM_WINDOW = 4194304
+
+    def __init__(self, client, key, reader, writer):
+        import h2.config
+        import h2.connection
+        import h2.settings
+        self.client = client
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.streams = {}
+        self.closed = False
+        self.h2 = h2.connection.H2Connection(h2.config.H2Configuration(client_side=True, header_encoding='utf-8'))
+        self.h2.local_settings = h2.settings.Settings(client=True, initial_values={
+            h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: self.STREAM_WINDOW,
+            h2.settings.SettingCodes.ENABLE_PUSH: 0,
+        })
+        self.h2.initiate_connection()
+        self.h2.increment_flow_control_window(self.CONNECTION_WINDOW - 65535)
+        self.flush()
+        self.task = asyncio.get_running_loop().create_task(self._read_loop())
+
+    @property
+    def capacity(self):
+        limit = min(self.MAX_STREAMS, self.h2.remote_settings.max_concurrent_streams)
+        return 0 if self.closed else limit - len(self.streams)
+
+    def flush(self):
+        data = self.h2.data_to_send()
+        if data and not self.closed:
+            self.writer.write(data)
+
+    def request(self, url, path, authority, headers):
+        stream_id = self.h2.get_next_available_stream_id()
+        scheme = self.key[0]
+        self.h2.send_headers(stream_id, [(':method', 'GET'), (':scheme', scheme), (':authority', authority),
+                                         (':path', path), ('user-agent', self.client.user_agent)]
+                             + [(name.lower(), value) for name, value in headers.items()], end_stream=True)
+        stream = self.streams[stream_id] = _H2Stream(self, stream_id, url)
+        self.flush()
+        return stream
+
+    def acknowledge(self, stream, length):
+        if self.closed or stream.stream_id not in self.streams:
+            return
+        self.h2.acknowledge_received_data(length, stream.stream_id)
+        self.flush()
+
+    def close_stream(self, stream):
+        if self.streams.pop(stream.stream_id, None) is None:
+            return
+        if not (stream.ended or self.closed):
+            import h2.errors
+            try:
+                self.h2.reset_stream(stream.stream_id, h2.errors.ErrorCodes.CANCEL)
+                self.flush()
+            except Exception:
+                pass
+        self.client.stream_freed()
+
+    async def _read_loop(self):
+        import h2.events
+        error = HTTPError("HTTP/2 connection closed")
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                for event in self.h2.receive_data(data):
+                    stream = self.streams.get(getattr(event, 'stream_id', None))
+                    if isinstance(event, h2.events.ResponseReceived) and stream:
+                        for name, value in event.headers:
+                            if name == ':status':
+                                stream.status = int(value)
+                            else:
+                                stream.headers[name] = value
+                        stream._wake()
+                    elif isinstance(event, h2.events.DataReceived):
+                        if stream:
+                            stream.chunks.append([event.data, event.flow_controlled_length])
+                            stream._wake()
+                        else:
+                            # Late data for a stream we reset; give the window back
+                            self.h2.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                    elif isinstance(event, h2.events.StreamEnded) and stream:
+                        stream.ended = True
+                        stream._wake()
+                    elif isinstance(event, h2.events.StreamReset) and stream:
+                        stream.error = HTTPError(f"Stream reset ({event.error_code})")
+                        stream._wake()
+                    elif isinstance(event, h2.events.ConnectionTerminated):
+                        error = HTTPError(f"HTTP/2 connection closed by server ({event.error_code})")
+                        return
+                self.flush()
+        except Exception as e:
+            error = HTTPError(str(e) or type(e).__name__)
+        finally:
+            self.closed = True
+            self.writer.close()
+            self.client.h2_closed(self)
+            for stream in list(self.streams.values()):
+                if not stream.ended:
+                    stream.error = error
+                stream._wake()
+
+    def close(self):
+        self.task.cancel()
+
+class HttpClient:
+    MAX_REDIRECTS = 10
+    MAX_IDLE = 8  # Idle connections kept per origin
+    MAX_H2_CONNECTIONS = 4  # Per origin
+    READ_LIMIT = 262144  # Per-connection read buffer; asyncio buffers up to twice this
+
+    def __init__(self, user_agent='kdm', http2=False, cafile=None):
+        self.user_agent = user_agent
+        self.http2 = http2 and h2_available()
+        # Same lookup order as requests
+        self.cafile = (cafile or os.environ.get('REQUESTS_CA_BUNDLE') or os.environ.get('CURL_CA_BUNDLE')
+                       or DEFAULT_CA_BUNDLE_PATH)
+        self.idle = {}
+        self.h2 = {}  # Origin -> open HTTP/2 connections
+        self.protocols = {}  # Origin -> protocol picked in ALPN
+        self.connecting = {}  # Origin -> future of the connection that will tell
+        self.freed = None
+        self.contexts = {}
+
+    def _ssl(self, alpn=False):
+        context = self.contexts.get(alpn)
+        if context is None:
+            context = self.contexts[alpn] = ssl.create_default_context(cafile=self.cafile)
+            if alpn:
+                context.set_alpn_protocols(['h2', 'http/1.1'])
+        return context
+
+    def put(self, conn):
+        idle = self.idle.setdefault(conn.key, [])
+        if len(idle) < self.MAX_IDLE:
+            idle.append(conn)
+        else:
+            conn.close()
+
+    async def _connect(self, key, connect_timeout, alpn=False):
+        scheme, host, port = key
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(
+            host, port, ssl=self._ssl(alpn) if scheme == 'https' else None,
+            limit=self.READ_LIMIT), connect_timeout)
+        return _Connection(key, reader, writer)
+
+    async def _h2_connection(self, key, connect_timeout):
+        # An HTTP/2 connection with a free stream, or None when the origin speaks HTTP/1.1
+        while True:
+            if self.protocols.get(key) == 'http/1.1':
+                return None
+            connections = self.h2.get(key, [])
+            best = max(connections, key=lambda c: c.capacity, default=None)
+            if best is not None and best.capacity > 0:
+                return best
+            pending = self.connecting.get(key)
+            if pending is not None:
+                await pending
+                continue
+            if len(connections) >= self.MAX_H2_CONNECTIONS:
+                # Every stream is taken; wait for one to finish
+                if self.freed is None:
+                    self.freed = asyncio.Event()
+                self.freed.clear()
+                await self.freed.wait()
+                continue
+            pending = self.connecting[key] = asyncio.get_running_loop().create_future()
+            try:
+                conn = await self._connect(key, connect_timeout, alpn=True)
+                ssl_object = conn.writer.get_extra_info('ssl_object')
+                protocol = ssl_object.selected_alpn_protocol() if ssl_object else None
+                if protocol != 'h2':
+                    self.protocols[key] = 'http/1.1'
+                    self.put(conn)
+                    return None
+                self.protocols[key] = 'h2'
+                h2conn = _H2Connection(self, key, conn.reader, conn.writer)
+                self.h2.setdefault(key, []).append(h2conn)
+                return h2conn
+            finally:
+                del self.connecting[key]
+                pending.set_result(None)
+
+    def stream_freed(self):
+        if self.freed is not None:
+            self.freed.set()
+
+    def h2_closed(self, conn):
+        connections = self.h2.get(conn.key, [])
+        if conn in connections:
+            connections.remove(conn)
+        self.stream_freed()
+
+    async def get(self, url, headers=None, timeout=(10, 15)):
+        # Follows redirects; the caller reads the body and must call release()
+        connect_timeout, read_timeout = timeout
+        for _ in range(self.MAX_REDIRECTS + 1):
+            response = await self._request(url, headers or {}, connect_timeout, read_timeout)
+            location = response.headers.get('location')
+            if response.status not in (301, 302, 303, 307, 308) or not location:
+                return response
+            response.release()
+            url = urljoin(url, location)
+        raise HTTPError("Too many redirects")
+
+    def _target(self, url):
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ('http', 'https'):
+            raise HTTPError(f"Unsupported URL: {url}")
+        port = parts.port or (443 if scheme == 'https' else 80)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        host = parts.hostname if parts.port is None else f"{parts.hostname}:{parts.port}"
+        return (scheme, parts.hostname, port), path, host
+
+    def _request_head(self, path, host, headers):
+        lines = [f"GET {path} HTTP/1.1", f"Host: {host}", f"User-Agent: {self.user_agent}",
+                 "Accept-Encoding: identity", "Connection: keep-alive"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
+
+    def _response(self, conn, url, head):
+        status_line, *header_lines = head.decode('latin-1').split("\r\n")
+        try:
+            status = int(status_line.split()[1])
+        except (IndexError, ValueError):
+            conn.close()
+            raise HTTPError(f"Bad status line: {status_line!r}")
+        response_headers = {}
+        for line in header_lines:
+            name, sep, value = line.partition(':')
+            if sep:
+                response_headers[name.strip().lower()] = value.strip()
+        return Response(self, conn, url, status, response_headers)
+
+    async def _request(self, url, headers, connect_timeout, read_timeout):
+        key, path, host = self._target(url)
+        if key[0] == 'https' and self.http2:
+            h2conn = await self._h2_connection(key, connect_timeout)
+            if h2conn is not None:
+                stream = h2conn.request(url, path, host, headers)
+                try:
+                    await stream.wait_headers(read_timeout)
+                except BaseException:
+                    stream.release()
+                    raise
+                return stream
+        request = self._request_head(path, host, headers)
+
+        idle = self.idle.get(key)
+        while True:
+            reused = bool(idle)
+            conn = idle.pop() if reused else await self._connect(key, connect_timeout)
+            try:
+                conn.writer.write(request)
+                await conn.writer.drain()
+                head = await asyncio.wait_for(conn.reader.readuntil(b"\r\n\r\n"), read_timeout)
+                break
+            except (OSError, asyncio.IncompleteReadError):
+                conn.close()
+                # An idle keep-alive connection the server already closed; try a fresh one
+                if not reused:
+                    raise
+            except BaseException:
+                conn.close()
+                raise
+        return self._response(conn, url, head)
+
+    async def pipeline(self, requests, timeout=(10, 15)):
+        # Sends GETs for several (url, headers) of one origin back to back on one HTTP/1.1
+        # connection and yields the Responses in order. Each body has to be read to its
+        # end before the next response is taken, and release() is left to the pipeline.
+        # Ends early when the server closes the connection; the caller sends the rest
+        # again. Redirects are returned, not followed.
+        connect_timeout, read_timeout = timeout
+        key = self._target(requests[0][0])[0]
+        data = b''.join(self._request_head(*self._target(url)[1:], headers) for url, headers in requests)
+        idle = self.idle.get(key)
+        while True:
+            reused = bool(idle)
+            conn = idle.pop() if reused else await self._connect(key, connect_timeout)
+            try:
+                conn.writer.write(data)
+                await conn.writer.drain()
+                head = await asyncio.wait_for(conn.reader.readuntil(b"\r\n\r\n"), read_timeout)
+                break
+            except (OSError, asyncio.IncompleteReadError):
+                conn.close()
+                if not reused:
+                    raise
+            except BaseException:
+                conn.close()
+                raise
+        pooled = False
+        try:
+            for i, (url, _) in enumerate(requests):
+                if i:
+                    try:
+                        head = await asyncio.wait_for(conn.reader.readuntil(b"\r\n\r\n"), read_timeout)
+                    except asyncio.IncompleteReadError:
+                        return  # Closed between responses
+                response = self._response(conn, url, head)
+                yield response
+                response.conn = None
+                if not (response.done and response.keep_alive):
+                    return
+            self.put(conn)
+            pooled = True
+        finally:
+            if not pooled:
+                conn.close()
+
+    def close(self):
+        for idle in self.idle.values():
+            for conn in idle:
+                conn.close()
+        self.idle.clear()
+        for connections in self.h2.values():
+            for conn in connections:
+                conn.close()
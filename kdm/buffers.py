@@ -0,0 +1,67 @@
+import threading
+
+class BufferPool:
+    # Receive buffers shared by every connection of a downloader. Buffers are allocated
+    # on first use up to max_buffers and then recycled, so memory held for network reads
+    # is capped at buffer_size * max_buffers however many connections are configured.
+    BUFFER_SIZE = 131072
+    MAX_BYTES = 16777216
+
+    def __init__(self, buffer_size=None, max_bytes=None):
+        self.buffer_size = buffer_size or self.BUFFER_SIZE
+        self.max_buffers = max(1, (max_bytes or self.MAX_BYTES) // self.buffer_size)
+        self.free = []
+        self.allocated = 0
+        self.waits = 0  # Times a connection had to wait for a buffer
+        self.cond = threading.Condition()
+
+    def acquire(self, cancelled=None):
+        # Blocks while every buffer is in use; returns None if cancelled() turns true first
+        with self.cond:
+            while not self.free:
+                if self.allocated < self.max_buffers:
+                    self.allocated += 1
+                    return memoryview(bytearray(self.buffer_size))
+                if cancelled and cancelled():
+                    return None
+                self.waits += 1
+                self.cond.wait(0.25)
+            return self.free.pop()
+
+    def release(self, buf):
+        with self.cond:
+            self.free.append(buf)
+            self.cond.notify()
+
+    @property
+    def in_use(self):
+        return self.allocated - len(self.free)
+
+class BodyReader:
+    # Reads a streamed requests response into caller-owned buffers. Bodies without a
+    # Content-Encoding go straight from the socket's buffered reader into the buffer;
+    # compressed ones go through urllib3's decoder and cost one copy.
+    def __init__(self, response):
+        self.response = response
+        raw = response.raw
+        fp = getattr(raw, '_fp', None)
+        self.direct = (fp is not None and hasattr(fp, 'readinto')
+                       and not response.headers.get('content-encoding'))
+        self.fp = fp
+
+    def readinto(self, view):
+        if self.direct:
+            n = self.fp.readinto(view)
+        else:
+            data = self.response.raw.read(len(view), decode_content=True)
+            n = len(data)
+            view[:n] = data
+        return n
+
+    def close(self):
+        raw = self.response.raw
+        if self.direct and self.fp.isclosed():
+            # http.client closes its side once the whole body is read, which urllib3
+            # never saw; hand the connection back to the pool instead of dropping it
+            raw.release_conn()
+        self.response.close()
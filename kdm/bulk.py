@@ -0,0 +1,274 @@
+import asyncio
+import email.utils
+import hashlib
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from .asynchttp import HttpClient, HTTPError
+from .integrity import parse_checksum
+from .probe import FileInfo, _filename
+
+LARGE_FILE = 4194304  # Bigger files that accept ranges are handed to the segmented engine
+CHUNK = 262144
+FLUSH = 1048576  # Bodies are kept in memory up to this, then written as they come
+
+def url_filename(url):
+    # File name a bulk download is saved under; no probe, so only the URL tells
+    return _filename(url, {})
+
+def make_items(entries, directory):
+    # BulkItems for (url, checksum) pairs, saved in directory under the URL's file name;
+    # repeated names get " (n)" added. Returns the items and (url, error) for entries
+    # whose checksum can't be used.
+    items, rejected = [], []
+    taken = set()
+    for url, checksum in entries:
+        path = os.path.join(directory, url_filename(url))
+        root, ext = os.path.splitext(path)
+        n = 1
+        while path in taken:
+            path = f"{root} ({n}){ext}"
+            n += 1
+        try:
+            items.append(BulkItem(url, path, checksum))
+        except ValueError as e:
+            rejected.append((url, str(e)))
+            continue
+        taken.add(path)
+    return items, rejected
+
+class BulkItem:
+    def __init__(self, url, path, checksum=None):
+        self.url = url
+        self.path = path
+        self.checksum = parse_checksum(checksum) if checksum else None
+        self.status = "pending"  # Then "done", "unchanged", "failed" or "handed off"
+        self.error = None
+        self.attempts = 0
+
+class BulkDownloader:
+    # Fetches a batch of small files as one job. Nothing is probed: each file is one
+    # GET, sent a few at a time down every keep-alive connection (HTTP/1.1 pipelining),
+    # with a bounded number of connections per host and overall. Files already on disk
+    # are asked for with If-Modified-Since and left alone on 304. A file that turns out
+    # to be large and rangeable goes to handoff(item, FileInfo) when one is given, so
+    # the segmented engine takes it without probing it again. run() blocks until the
+    # batch is through; progress is counted in files.
+    def __init__(self, connections=4, depth=8, max_connections=64, large=LARGE_FILE, handoff=None,
+                 timeout=(10, 15), retries=3, user_agent='kdm'):
+        self.connections = connections  # Per host
+        self.depth = depth  # Requests in flight on one connection
+        self.max_connections = max_connections
+        self.large = large
+        self.handoff = handoff
+        self.timeout = timeout
+        self.retries = retries
+        self.user_agent = user_agent
+        self.items = []
+        self.done = 0
+        self.unchanged = 0
+        self.failed = 0
+        self.handed_off = 0
+        self.bytes = 0
+        self.started = None
+        self.finished = None
+        self.paused = False
+        self.cancel = False
+
+    @property
+    def total(self):
+        return len(self.items)
+
+    @property
+    def settled(self):
+        return self.done + self.unchanged + self.failed + self.handed_off
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    def files_per_second(self):
+        elapsed = self.elapsed()
+        return self.settled / elapsed if elapsed > 0 else 0.0
+
+    def run(self, items):
+        self.items = list(items)
+        asyncio.run(self._run())
+        return self
+
+    async def _run(self):
+        self.started = time.monotonic()
+        self.disk = ThreadPoolExecutor(max_workers=4)
+        client = HttpClient(user_agent=self.user_agent)
+        client.MAX_IDLE = max(client.MAX_IDLE, self.connections)
+        slots = asyncio.Semaphore(self.max_connections)
+        queues = {}
+        for item in self.items:
+            parts = urlsplit(item.url)
+            queues.setdefault((parts.scheme.lower(), parts.netloc.lower()), deque()).append(item)
+        workers = [self._worker(client, queue, slots) for queue in queues.values()
+                   for _ in range(min(self.connections, -(-len(queue) // self.depth)))]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            client.close()
+            self.disk.shutdown()
+            self.finished = time.monotonic()
+
+    async def _worker(self, client, queue, slots):
+        async with slots:
+            while queue and not self.cancel:
+                if self.paused:
+                    await asyncio.sleep(0.2)
+                    continue
+                batch = [queue.popleft() for _ in range(min(self.depth, len(queue)))]
+                requests = [(item.url, self._headers(item)) for item in batch]
+                error = bad = None
+                try:
+                    answered = 0
+                    async for response in client.pipeline(requests, self.timeout):
+                        item = batch[answered]
+                        answered += 1
+                        if not await self._handle(client, item, response):
+                            break  # Rest of this connection's body is not worth reading
+                except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, HTTPError) as e:
+                    error = str(e) or type(e).__name__
+                except (asyncio.LimitOverrunError, ValueError) as e:
+                    # A response that can't be parsed; asking again would get the same one
+                    bad = f"Bad response: {e}"
+                pending = [item for item in batch if item.status == "pending"]
+                if bad and pending:
+                    self._fail(pending[0], bad)
+                elif error and pending:
+                    # The request in flight takes the blame; the ones behind it go again as they are
+                    self._retry(pending[0], error)
+                    await asyncio.sleep(min(5, 0.5 * pending[0].attempts))
+                queue.extendleft(reversed([item for item in pending if item.status == "pending"]))
+
+    def _headers(self, item):
+        try:
+            mtime = os.path.getmtime(item.path)
+        except OSError:
+            return {}
+        return {'If-Modified-Since': email.utils.formatdate(mtime, usegmt=True)}
+
+    def _retry(self, item, error):
+        item.attempts += 1
+        item.error = error
+        if item.attempts >= self.retries:
+            self._fail(item, error)
+
+    def _fail(self, item, error):
+        item.status = "failed"
+        item.error = error
+        self.failed += 1
+
+    async def _handle(self, client, item, response):
+        # Returns False when the connection has to be dropped
+        status = response.status
+        if status == 304:
+            item.status = "unchanged"
+            self.unchanged += 1
+            return True
+        if status in (301, 302, 303, 307, 308) and response.headers.get('location'):
+            await self._drain(response)
+            # Followed on a connection of its own; the pipeline carries on meanwhile
+            redirected = await client.get(item.url, self._headers(item), self.timeout)
+            try:
+                if redirected.status == 304:
+                    item.status = "unchanged"
+                    self.unchanged += 1
+                elif redirected.status >= 400:
+                    self._retry_or_fail(item, redirected.status)
+                else:
+                    await self._save(item, redirected)
+            finally:
+                redirected.release()
+            return True
+        if status >= 400:
+            await self._drain(response)
+            self._retry_or_fail(item, status)
+            return True
+        length = response.headers.get('content-length', '')
+        size = int(length) if length.isdigit() else 0
+        if (self.handoff and size > self.large and status == 200
+                and response.headers.get('accept-ranges') == 'bytes'):
+            item.status = "handed off"
+            self.handed_off += 1
+            self.handoff(item, FileInfo(item.url, response.url, os.path.basename(item.path), size, True,
+                                        response.headers.get('etag'), response.headers.get('last-modified')))
+            return False
+        await self._save(item, response)
+        return True
+
+    def _retry_or_fail(self, item, status):
+        if status == 429 or status >= 500:
+            self._retry(item, f"HTTP {status}")
+        else:
+            self._fail(item, f"HTTP {status}")
+
+    async def _drain(self, response):
+        while await response.read(CHUNK, self.timeout[1]):
+            pass
+
+    async def _save(self, item, response):
+        loop = asyncio.get_running_loop()
+        digest = hashlib.new(item.checksum[0]) if item.checksum else None
+        temp = item.path + '.kdm'
+        parts, buffered, f = [], 0, None
+        try:
+            while True:
+                data = await response.read(CHUNK, self.timeout[1])
+                if not data:
+                    break
+                if digest:
+                    digest.update(data)
+                parts.append(data)
+                buffered += len(data)
+                self.bytes += len(data)
+                if buffered >= FLUSH:
+                    if f is None:
+                        f = await loop.run_in_executor(self.disk, open, temp, 'wb')
+                    await loop.run_in_executor(self.disk, f.writelines, parts)
+                    parts, buffered = [], 0
+            if digest and digest.hexdigest() != item.checksum[1]:
+                raise ValueError("Checksum mismatch")
+            await loop.run_in_executor(self.disk, self._finish, f, temp, item.path, parts,
+                                       self._mtime(response.headers.get('last-modified')))
+        except ValueError as e:
+            await loop.run_in_executor(self.disk, self._discard, f, temp)
+            self._fail(item, str(e))
+            return
+        except BaseException:
+            await asyncio.shield(loop.run_in_executor(self.disk, self._discard, f, temp))
+            raise
+        item.status = "done"
+        self.done += 1
+
+    def _mtime(self, modified):
+        try:
+            return email.utils.parsedate_to_datetime(modified).timestamp()
+        except (TypeError, ValueError):
+            return None
+
+    def _finish(self, f, temp, path, parts, mtime):
+        if f is None:
+            f = open(temp, 'wb')
+        with f:
+            f.writelines(parts)
+        os.replace(temp, path)
+        if mtime:
+            # So the next run's If-Modified-Since asks about the server's copy
+            os.utime(path, (mtime, mtime))
+
+    def _discard(self, f, temp):
+        if f is not None:
+            f.close()
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
@@ -0,0 +1,424 @@
+import argparse
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .downloader import MultiThreadDownloader
+from .mirrors import parse_sources
+from .ratelimit import RateSchedule, parse_schedule
+from .scheduler import DownloadScheduler
+from .task import DownloadTask
+
+def format_size(size):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024: return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+def parse_threads(value):
+    if value.lower() == "auto":
+        return 0
+    threads = int(value)
+    if not 1 <= threads <= 256:
+        raise argparse.ArgumentTypeError("threads must be 1-256 or 'auto'")
+    return threads
+
+def schedule_arg(value):
+    try:
+        return parse_schedule(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="kdm", description="Multi-threaded batch downloader")
+    parser.add_argument("urls", nargs="*", help="URLs to download")
+    parser.add_argument("-i", "--input",
+                        help="file with one URL per line, optionally followed by mirror URLs and a checksum ('-' for stdin)")
+    parser.add_argument("-c", "--checksum", help="expected digest of a single URL, e.g. sha256:<hex>")
+    parser.add_argument("-m", "--mirror", action="append", default=[],
+                        help="another URL serving the same file as a single URL; may be repeated")
+    parser.add_argument("-o", "--output-dir", default=".", help="directory to save files in")
+    parser.add_argument("-t", "--threads", type=parse_threads, default=0,
+                        help="connections per download, 1-256 or 'auto' (default)")
+    parser.add_argument("-j", "--parallel", type=int, default=3, help="downloads running at once")
+    parser.add_argument("--max-connections", type=int, default=128, help="connections across all downloads")
+    parser.add_argument("--per-host", type=int, default=64, help="connections per host")
+    parser.add_argument("--engine", choices=["threads", "async"], default="threads",
+                        help="one thread per connection, or all connections on one asyncio event loop")
+    parser.add_argument("--http2", action="store_true",
+                        help="fetch ranges as HTTP/2 streams where the server offers h2 (async engine, needs the h2 package)")
+    parser.add_argument("--writers", type=int, default=0,
+                        help="threads that write to disk on behalf of the connections (default: each connection writes)")
+    parser.add_argument("--limit", type=int, default=0, help="global speed limit in KB/s")
+    parser.add_argument("--task-limit", type=int, default=0, help="speed limit of each download in KB/s")
+    parser.add_argument("--schedule", type=schedule_arg,
+                        help="time-of-day global limits in KB/s overriding --limit, e.g. '09:00-18:00=512,23:00-07:00=0' "
+                             "(0 lifts the limit)")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve /metrics (Prometheus text) and /stats (JSON) on localhost while running")
+    parser.add_argument("--stats", help="write a JSON snapshot of connection metrics to this file at the end")
+    parser.add_argument("--stdout", action="store_true",
+                        help="also write a single URL's bytes to stdout in order while it downloads")
+    parser.add_argument("-x", "--extract", action="store_true",
+                        help="unpack .zip/.tar.*/.gz/.bz2/.xz downloads into the output directory while they download")
+    parser.add_argument("--delete-archive", action="store_true", help="with --extract, delete archives once unpacked")
+    parser.add_argument("--delta", metavar="OLD_FILE",
+                        help="older copy of a single URL's file; only blocks that changed are downloaded")
+    parser.add_argument("--delta-index", metavar="PATH_OR_URL",
+                        help="block index of the new file (default: the URL with .kdmsync appended)")
+    parser.add_argument("--make-index", action="store_true",
+                        help="write a .kdmsync block index next to each local file given instead of downloading")
+    parser.add_argument("--block-size", type=int, help="block size for --make-index (default 65536)")
+    parser.add_argument("--bulk", action="store_true",
+                        help="many small files: no probes, pipelined requests on a few keep-alive connections per host; "
+                             "files over 4 MB that accept ranges still use segments")
+    parser.add_argument("--daemon", action="store_true",
+                        help="run the engine as a long-lived background process that clients talk to")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="with --daemon, spread downloads over this many engine processes")
+    parser.add_argument("--state-dir", help="daemon state: socket details, history, host profiles "
+                                            "(default: ~/.kdownloadmanager)")
+    parser.add_argument("--enqueue", action="store_true",
+                        help="hand the URLs to the daemon (starting one if needed) and return")
+    parser.add_argument("--list", action="store_true", help="show the daemon's downloads")
+    parser.add_argument("--stop-daemon", action="store_true", help="pause the daemon's downloads and stop it")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print the summary")
+    return parser
+
+def read_urls(args):
+    # Returns (url, checksum or None, mirrors) triples
+    urls = [(url, None, []) for url in args.urls]
+    if args.input:
+        stream = sys.stdin if args.input == "-" else open(args.input)
+        with stream:
+            for line in stream:
+                parts = line.split()
+                if parts and not parts[0].startswith("#"):
+                    url, mirrors, checksum = parse_sources(parts)
+                    if url:
+                        urls.append((url, checksum, mirrors))
+    for option, value in (("--checksum", args.checksum), ("--mirror", args.mirror), ("--stdout", args.stdout),
+                          ("--delta", args.delta)):
+        if value and len(urls) != 1:
+            raise SystemExit(f"kdm: {option} needs exactly one URL")
+    if args.bulk and (args.stdout or args.delta):
+        raise SystemExit("kdm: --bulk can't be combined with --stdout or --delta")
+    if urls and (args.checksum or args.mirror):
+        url, checksum, mirrors = urls[0]
+        urls = [(url, args.checksum or checksum, mirrors + args.mirror)]
+    return urls
+
+def pipe_stream(stream, out):
+    # Copies the download to out in file order while the rest is still arriving
+    with stream:
+        try:
+            for data in stream.chunks():
+                out.write(data)
+                out.flush()
+        except OSError:
+            pass  # Download failed or the reader went away
+
+def unique_path(directory, filename, taken):
+    # Two URLs with the same file name must not share one output file
+    path = os.path.join(directory, filename)
+    root, ext = os.path.splitext(path)
+    n = 1
+    while path in taken:
+        path = f"{root} ({n}){ext}"
+        n += 1
+    taken.add(path)
+    return path
+
+class BatchRun:
+    def __init__(self, downloader, scheduler, quiet=False):
+        self.downloader = downloader
+        self.scheduler = scheduler
+        self.quiet = quiet
+        self.tasks = []
+        self.failed = {}
+        self.finished = threading.Event()
+        self.lock = threading.Lock()
+        self.pending = 0
+
+    def add(self, task):
+        self.tasks.append(task)
+        with self.lock:
+            self.pending += 1
+        self.scheduler.submit(task, self.on_progress, self.on_complete, self.on_error)
+
+    def _done(self):
+        with self.lock:
+            self.pending -= 1
+            if self.pending <= 0:
+                self.finished.set()
+
+    def on_progress(self, task, speed):
+        pass
+
+    def on_complete(self, task):
+        task.status = "completed"
+        if not self.quiet:
+            self._clear_line()
+            print(f"done    {os.path.basename(task.filename)} ({format_size(task.total_size)})", file=sys.stderr)
+        self._done()
+
+    def on_error(self, task, error):
+        task.status = "failed"
+        self.failed[task] = error
+        if not self.quiet:
+            self._clear_line()
+            print(f"failed  {task.url}: {error}", file=sys.stderr)
+        self._done()
+
+    def _clear_line(self):
+        if sys.stderr.isatty():
+            sys.stderr.write("\r\033[K")
+
+    def status_line(self):
+        running = [t for t in self.tasks if t.status == "downloading"]
+        done = sum(1 for t in self.tasks if t.status == "completed")
+        downloaded = sum(t.downloaded for t in self.tasks)
+        total = sum(t.total_size for t in self.tasks)
+        speed = sum(t.speed for t in running)
+        return (f"[{done}/{len(self.tasks)}] {format_size(downloaded)}/{format_size(total)} "
+                f"{format_size(speed)}/s, {len(running)} active")
+
+    def wait(self):
+        if not self.tasks:
+            return
+        while not self.finished.wait(0.5):
+            if not self.quiet and sys.stderr.isatty():
+                sys.stderr.write("\r\033[K" + self.status_line())
+                sys.stderr.flush()
+        self._clear_line()
+
+    def pause_all(self):
+        # Workers stop at their next read and the resume journal is written on the way out
+        for task in self.tasks:
+            task.paused = True
+        deadline = time.time() + 5
+        while self.scheduler.running and time.time() < deadline:
+            time.sleep(0.1)
+
+def queue_tasks(args, urls, downloader, run):
+    # Probes every URL and queues it; returns the thread piping to stdout, if any
+    pipe = None
+    with ThreadPoolExecutor(max_workers=8) as probes:
+        infos = probes.map(downloader.get_file_info, [url for url, _, _ in urls])
+        taken = set()
+        for (url, checksum, mirrors), (filename, total_size, _) in zip(urls, infos):
+            if not filename:
+                run.failed[url] = "Failed to get file info"
+                print(f"failed  {url}: Failed to get file info", file=sys.stderr)
+                continue
+            task = DownloadTask(url, unique_path(args.output_dir, filename, taken), total_size)
+            task.mirrors = mirrors
+            try:
+                task.set_checksum(checksum)
+            except ValueError as e:
+                run.failed[url] = str(e)
+                print(f"failed  {url}: {e}", file=sys.stderr)
+                continue
+            task.start_time = time.time()
+            if args.task_limit:
+                downloader.limiter.set_task_limit(task, args.task_limit * 1024)
+            if args.delta:
+                task.delta_source = args.delta
+                task.delta_index = args.delta_index
+            if args.extract:
+                task.extract_to = args.output_dir
+                task.keep_archive = not args.delete_archive
+            if args.stdout:
+                # Opened before the download starts so its first ranges are the ones in front
+                pipe = threading.Thread(target=pipe_stream, args=(task.open_stream(), sys.stdout.buffer),
+                                        daemon=True)
+                pipe.start()
+            run.add(task)
+    return pipe
+
+def run_bulk(args, urls, downloader, run):
+    # Small files go through BulkDownloader; large ones it comes across join the
+    # normal queue, with what their GET told it standing in for the probe
+    from .bulk import BulkDownloader, make_items
+
+    def handoff(item, info):
+        downloader.probes.put(info)
+        task = DownloadTask(item.url, item.path, info.size)
+        task.checksum = item.checksum
+        task.start_time = time.time()
+        if args.task_limit:
+            downloader.limiter.set_task_limit(task, args.task_limit * 1024)
+        run.add(task)
+
+    bulk = BulkDownloader(max_connections=args.max_connections, handoff=handoff)
+    items, rejected = make_items([(url, checksum) for url, checksum, _ in urls], args.output_dir)
+    for url, error in rejected:
+        run.failed[url] = error
+        print(f"failed  {url}: {error}", file=sys.stderr)
+    worker = threading.Thread(target=bulk.run, args=(items,), daemon=True)
+    worker.start()
+    try:
+        while worker.is_alive():
+            worker.join(0.5)
+            if not args.quiet and sys.stderr.isatty():
+                sys.stderr.write(f"\r\033[K[{bulk.settled}/{bulk.total}] {format_size(bulk.bytes)} "
+                                 f"{bulk.files_per_second():.0f} files/s")
+                sys.stderr.flush()
+    except KeyboardInterrupt:
+        bulk.cancel = True
+        raise
+    run._clear_line()
+    for item in items:
+        if item.status == "failed":
+            run.failed[item.url] = item.error
+            if not args.quiet:
+                print(f"failed  {item.url}: {item.error}", file=sys.stderr)
+    return bulk
+
+def make_indexes(paths, block_size):
+    from . import delta
+    block_size = block_size or delta.BLOCK_SIZE
+    for path in paths:
+        index = delta.make_index(path, block_size)
+        with open(path + delta.INDEX_SUFFIX, 'w') as f:
+            json.dump(index, f, separators=(',', ':'))
+        print(f"{path}{delta.INDEX_SUFFIX}: {len(index['blocks'])} blocks of {block_size} bytes")
+    return 0
+
+def run_daemon(args):
+    from .daemon import DaemonError, DownloadDaemon
+    options = {'engine': args.engine, 'http2': args.http2, 'threads': args.threads, 'max_active': args.parallel,
+               'max_connections': args.max_connections, 'per_host': args.per_host, 'writers': args.writers}
+    try:
+        daemon = DownloadDaemon(options, args.state_dir, workers=args.workers)
+    except DaemonError as e:
+        print(f"kdm: {e}", file=sys.stderr)
+        return 1
+    if args.limit or args.schedule:
+        daemon.dispatch(None, 'configure', {'limit': args.limit * 1024, 'schedule': args.schedule})
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    print(f"kdm daemon listening on 127.0.0.1:{daemon.port}", file=sys.stderr)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        daemon.close_hosts()
+    return 0
+
+def run_client(args):
+    from .daemon import DaemonError, connect
+    try:
+        client = connect(args.state_dir, spawn=args.enqueue)
+    except DaemonError as e:
+        print(f"kdm: {e}", file=sys.stderr)
+        return 1
+    failed = 0
+    try:
+        if args.limit or args.schedule:
+            client.configure(limit=args.limit * 1024 or None, schedule=args.schedule)
+        if args.enqueue and args.bulk:
+            job = client.bulk([(url, checksum) for url, checksum, _ in read_urls(args)],
+                              directory=os.path.abspath(args.output_dir))
+            print(f"queued  #{job['id']} {job['total_size']} files")
+        elif args.enqueue:
+            for url, checksum, mirrors in read_urls(args):
+                try:
+                    task = client.add(url, directory=os.path.abspath(args.output_dir), checksum=checksum,
+                                      mirrors=mirrors, extract=args.extract, limit=args.task_limit * 1024)
+                    print(f"queued  #{task['id']} {os.path.basename(task['filename'])}")
+                except DaemonError as e:
+                    failed += 1
+                    print(f"failed  {url}: {e}", file=sys.stderr)
+        if args.list:
+            for task in client.list():
+                done = f"{task['downloaded'] * 100 // task['total_size']}%" if task['total_size'] else "?"
+                status = "paused" if task['paused'] and task['status'] != "completed" else task['status']
+                if task.get('files'):
+                    # A bulk job counts files, not bytes
+                    size, speed = f"{task['total_size']} files", f"{task['speed']:.0f} files/s"
+                else:
+                    size, speed = format_size(task['total_size']), f"{format_size(task['speed'])}/s"
+                print(f"#{task['id']:<5} {status:<12} {done:>4} {size:>10} {speed:>12}  "
+                      f"{os.path.basename(task['filename'])}")
+        if args.stop_daemon:
+            client.shutdown()
+    finally:
+        client.close()
+    return 1 if failed else 0
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.make_index:
+        return make_indexes(args.urls, args.block_size)
+    if args.daemon:
+        return run_daemon(args)
+    if args.enqueue or args.list or args.stop_daemon:
+        return run_client(args)
+    urls = read_urls(args)
+    if not urls:
+        print("kdm: no URLs given", file=sys.stderr)
+        return 2
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    if args.engine == "async" or args.http2:
+        from .asyncengine import AsyncDownloader
+        downloader = AsyncDownloader(num_threads=args.threads or 64, auto_threads=not args.threads, http2=args.http2,
+                                     writer_threads=args.writers)
+    else:
+        downloader = MultiThreadDownloader(num_threads=args.threads or 64, auto_threads=not args.threads,
+                                           writer_threads=args.writers)
+    downloader.limiter.set_rate(args.limit * 1024)
+    if args.schedule:
+        downloader.limiter.set_schedule(RateSchedule(args.schedule))
+    scheduler = DownloadScheduler(downloader, max_active=args.parallel,
+                                  max_connections=args.max_connections, per_host_connections=args.per_host)
+    if args.metrics_port:
+        downloader.serve_metrics(args.metrics_port)
+    run = BatchRun(downloader, scheduler, quiet=args.quiet)
+    pipe = None
+    bulk = None
+    start_time = time.time()
+
+    try:
+        if args.bulk:
+            bulk = run_bulk(args, urls, downloader, run)
+        else:
+            pipe = queue_tasks(args, urls, downloader, run)
+        run.wait()
+        if pipe:
+            pipe.join()
+    except KeyboardInterrupt:
+        run._clear_line()
+        print("interrupted, saving resume state...", file=sys.stderr)
+        run.pause_all()
+        return 130
+
+    elapsed = time.time() - start_time
+    if args.stats:
+        with open(args.stats, 'w') as f:
+            json.dump(downloader.stats(), f, indent=2)
+    completed = [t for t in run.tasks if t.status == "completed"]
+    total_bytes = sum(t.total_size or t.downloaded for t in completed)
+    downloaded = len(completed)
+    reused = sum(t.reused for t in completed)
+    if reused:
+        print(f"{format_size(reused)} reused from the old copy, {format_size(total_bytes - reused)} downloaded",
+              file=sys.stderr)
+    rate = ""
+    if bulk:
+        total_bytes += bulk.bytes
+        downloaded += bulk.done + bulk.unchanged
+        if bulk.unchanged:
+            print(f"{bulk.unchanged} unchanged since the last download", file=sys.stderr)
+        rate = f", {downloaded / elapsed if elapsed > 0 else 0:.0f} files/s"
+    print(f"{downloaded}/{len(urls)} downloaded, {format_size(total_bytes)} in {elapsed:.1f}s "
+          f"({format_size(total_bytes / elapsed if elapsed > 0 else 0)}/s{rate})",
+          file=sys.stderr if args.stdout else sys.stdout)
+    return 0 if downloaded == len(urls) else 1
@@ -0,0 +1,151 @@
+import os
+import json
+import threading
+import time
+
+class ConnectionController:
+    # Tracks the segment workers of one download against a target. In adaptive mode it
+    # hill-climbs the target on measured throughput and halves it when connections fail.
+    INTERVAL = 1.5
+    GAIN = 1.05
+    
+    def __init__(self, initial, cap, adaptive=True):
+        self.cap = max(1, cap)
+        self.target = max(1, min(initial, self.cap))
+        self.adaptive = adaptive
+        self.may_grow = True
+        self.active = 0
+        self.retiring = 0  # Surplus workers told to stop mid-range that have yet to retire
+        self.direction = 1
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.last_time = None
+        self.last_bytes = 0
+        self.last_rate = 0.0
+        self.best_rate = 0.0
+        self.best_target = self.target
+    
+    def enlist(self):
+        with self.lock:
+            if self.active >= self.target:
+                return False
+            self.active += 1
+            return True
+    
+    def leave(self):
+        with self.lock:
+            self.active -= 1
+    
+    def claim(self):
+        # Asked by a worker in the middle of a range; only as many as the target is
+        # exceeded by get True, hand their range back and retire() next
+        with self.lock:
+            if self.active - self.retiring > self.target:
+                self.retiring += 1
+                return True
+            return False
+    
+    def retire(self):
+        with self.lock:
+            if self.retiring:
+                self.retiring -= 1
+                self.active -= 1
+                return True
+            if self.active > self.target:
+                self.active -= 1
+                return True
+            return False
+    
+    def record_error(self):
+        with self.lock:
+            self.errors += 1
+    
+    def sample(self, downloaded, now):
+        # Once per window; stops starting new connections if they only fail
+        if self.last_time is None:
+            self.last_time, self.last_bytes = now, downloaded
+            return
+        elapsed = now - self.last_time
+        if elapsed < self.INTERVAL:
+            return
+        rate = (downloaded - self.last_bytes) / elapsed
+        with self.lock:
+            errors, self.errors = self.errors, 0
+            self.may_grow = rate > 0 or not errors
+            if rate > self.best_rate:
+                self.best_rate, self.best_target = rate, self.target
+            
+            step = max(1, self.target // 4)
+            if not self.adaptive:
+                pass
+            elif errors:
+                # Multiplicative decrease: the server is rejecting or resetting connections
+                self.target = max(1, self.target // 2)
+                self.direction = 1
+            elif rate >= self.last_rate * self.GAIN:
+                self.target += step * self.direction
+            elif rate * self.GAIN < self.last_rate:
+                self.direction = -self.direction
+                self.target += step * self.direction
+            self.target = max(1, min(self.target, self.cap))
+        
+        self.last_time, self.last_bytes, self.last_rate = now, downloaded, rate
+
+class HostProfiles:
+    # Best connection count seen per host, persisted between runs
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, 'r') as f:
+                self.hosts = json.load(f)
+        except (OSError, ValueError):
+            self.hosts = {}
+    
+    def best_threads(self, host):
+        entry = self.hosts.get(host)
+        return entry['threads'] if entry else None
+    
+    def remember(self, host, threads, rate):
+        if not host or rate <= 0:
+            return
+        with self.lock:
+            self.hosts[host] = {'threads': threads, 'rate': int(rate), 'updated': int(time.time())}
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                temp_path = f"{self.path}.tmp"
+                with open(temp_path, 'w') as f:
+                    json.dump(self.hosts, f)
+                os.replace(temp_path, self.path)
+            except OSError:
+                pass
+
+class ConnectionBudget:
+    # Connection slots shared by every download: one global cap plus a cap per host
+    def __init__(self, total, per_host):
+        self.total = max(1, total)
+        self.per_host = max(1, min(per_host, self.total))
+        self.used = 0
+        self.hosts = {}
+        self.lock = threading.Lock()
+    
+    def resize(self, total, per_host):
+        # Slots in use stay counted; past a lower cap nothing is handed out until enough return
+        with self.lock:
+            self.total = max(1, total)
+            self.per_host = max(1, min(per_host, self.total))
+    
+    def acquire(self, host):
+        with self.lock:
+            if self.used >= self.total or self.hosts.get(host, 0) >= self.per_host:
+                return False
+            self.used += 1
+            self.hosts[host] = self.hosts.get(host, 0) + 1
+            return True
+    
+    def release(self, host):
+        with self.lock:
+            self.used -= 1
+            self.hosts[host] -= 1
+            if not self.hosts[host]:
+                del self.hosts[host]
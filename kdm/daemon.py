@@ -0,0 +1,725 @@
+import contextlib
+import itertools
+import json
+import multiprocessing
+import os
+import secrets
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # Windows; concurrent spawns are not serialized there
+    fcntl = None
+
+from .downloader import MultiThreadDownloader
+from .history import UNFINISHED, DownloadHistory
+from .mirrors import parse_sources
+from .ratelimit import RateSchedule
+from .scheduler import DownloadScheduler
+from .task import DownloadTask
+
+# Runs the engine as its own long-lived process, so downloads don't compete with a UI
+# for the GIL and survive the window closing. Clients talk JSON lines over a localhost
+# socket: {"id": n, "cmd": ..., "args": {...}} in, {"id": n, "result"/"error": ...} out,
+# plus {"event": "progress", ...} batches after "subscribe". daemon.json in the state
+# directory holds the port and the token a client must present first.
+STATE_FILE = 'daemon.json'
+LOCK_FILE = 'daemon.lock'
+BATCH_INTERVAL = 0.5
+REQUEST_THREADS = 16  # Requests of all clients run on this many threads
+MAX_IN_FLIGHT = 32  # Per connection; reading stops until some of them are answered
+DEFAULT_OPTIONS = {
+    'engine': 'threads',
+    'http2': False,
+    'threads': 0,  # 0 tunes the connection count per host
+    'max_active': 3,
+    'max_connections': 128,
+    'per_host': 64,
+    'writers': 0,
+    'history': True,
+}
+
+def default_state_dir():
+    return os.path.join(os.path.expanduser('~'), '.kdownloadmanager')
+
+def snapshot(task, error=None):
+    return {
+        'id': task.id,
+        'url': task.url,
+        'filename': task.filename,
+        'total_size': task.total_size,
+        'downloaded': task.downloaded,
+        'speed': task.speed,
+        'status': task.status,
+        'paused': task.paused,
+        'limit': task.rate_limit,
+        'error': error,
+    }
+
+def job_snapshot(job):
+    # A bulk job is listed like a task with negative id whose sizes count files
+    return {
+        'id': job.id,
+        'url': None,
+        'filename': os.path.join(job.directory, f"{job.total} files"),
+        'total_size': job.total,
+        'downloaded': job.settled,
+        'speed': job.files_per_second(),
+        'status': "downloading" if job.finished is None else "completed",
+        'paused': job.paused,
+        'error': f"{job.failed} failed" if job.failed else None,
+        'files': True,
+    }
+
+class DaemonError(RuntimeError):
+    pass
+
+class EngineHost:
+    # One engine, its scheduler and its tasks, addressed by task id. Lives in the daemon
+    # itself or in one of its shard processes; shard k of n restores the unfinished
+    # downloads whose id is k mod n.
+    def __init__(self, options, state_dir, shard=0, shards=1):
+        self.shard = shard
+        self.shards = shards
+        threads = options['threads']
+        common = dict(num_threads=threads or 64, auto_threads=not threads,
+                      profile_path=os.path.join(state_dir, 'hosts.json'))
+        if options['engine'] == 'async' or options['http2']:
+            from .asyncengine import AsyncDownloader
+            self.downloader = AsyncDownloader(http2=options['http2'], writer_threads=options['writers'], **common)
+        else:
+            self.downloader = MultiThreadDownloader(writer_threads=options['writers'], **common)
+        self.history = DownloadHistory(os.path.join(state_dir, 'downloads.db')) if options['history'] else None
+        # Connection caps are shared out between the shards
+        self.scheduler = DownloadScheduler(self.downloader, max_active=options['max_active'],
+                                           max_connections=max(1, options['max_connections'] // shards),
+                                           per_host_connections=max(1, options['per_host'] // shards),
+                                           history=self.history)
+        self.tasks = {}
+        self.errors = {}
+        self.ids = itertools.count(shards + shard, shards)
+        self.jobs = {}  # Bulk jobs by (negative) id
+        self.job_ids = itertools.count(-1 - shard, -shards)
+        self.lock = threading.Lock()
+
+    def call(self, name, *args):
+        return getattr(self, name)(*args)
+
+    def restore(self):
+        # Puts this shard's unfinished downloads from the history back in the queue
+        if not self.history:
+            return
+        for row in self.history.unfinished():
+            if row['id'] % self.shards != self.shard:
+                continue
+            task = self.history.restore(row)
+            self.tasks[task.id] = task
+            if not task.paused:
+                self._submit(task)
+
+    def _submit(self, task, priority=0):
+        self.errors.pop(task.id, None)
+        self.scheduler.submit(task, self._on_progress, self._on_complete, self._on_error, priority)
+
+    def _on_progress(self, task, speed):
+        pass  # Clients poll snapshots in batches
+
+    def _on_complete(self, task):
+        task.status = "completed"
+
+    def _on_error(self, task, error):
+        task.status = "failed"
+        self.errors[task.id] = error
+
+    def add(self, url, directory='.', checksum=None, mirrors=(), priority=0, extract=False, limit=0):
+        with self.lock:
+            for task in self.tasks.values():
+                if task.url == url and task.status in UNFINISHED:
+                    raise DaemonError("Already downloading")
+        if self.history:
+            if self.history.find(url, UNFINISHED):
+                raise DaemonError("Already downloading")
+            done = self.history.find(url, ["completed"])
+            if done and os.path.exists(done['filename']):
+                raise DaemonError(f"Already downloaded: {os.path.basename(done['filename'])}")
+        filename, total_size, _ = self.downloader.get_file_info(url)
+        if not filename:
+            raise DaemonError("Failed to get file info")
+        os.makedirs(directory, exist_ok=True)
+        task = DownloadTask(url, os.path.join(directory, filename), total_size)
+        task.mirrors = list(mirrors)
+        try:
+            task.set_checksum(checksum)
+        except ValueError as e:
+            raise DaemonError(str(e))
+        if extract:
+            task.extract_to = directory
+        if limit:
+            self.downloader.limiter.set_task_limit(task, limit)
+        task.start_time = time.time()
+        if self.history:
+            self.history.save(task)  # Ids come from the database, unique across shards
+        else:
+            task.id = next(self.ids)
+        with self.lock:
+            self.tasks[task.id] = task
+        self._submit(task, priority)
+        return snapshot(task)
+
+    def bulk(self, entries, directory='.'):
+        # Many small files as one job with one entry; large ones among them become
+        # downloads of their own
+        from .bulk import BulkDownloader, make_items
+        os.makedirs(directory, exist_ok=True)
+        items, rejected = make_items(entries, directory)
+        if rejected:
+            raise DaemonError("{}: {}".format(*rejected[0]))
+        job = BulkDownloader(handoff=self._take_over)
+        job.id = next(self.job_ids)
+        job.directory = directory
+        job.items = items
+        with self.lock:
+            self.jobs[job.id] = job
+        threading.Thread(target=job.run, args=(items,), name="kdm-bulk", daemon=True).start()
+        return job_snapshot(job)
+
+    def _take_over(self, item, info):
+        self.downloader.probes.put(info)  # What the bulk GET saw stands in for a probe
+        task = DownloadTask(item.url, item.path, info.size)
+        task.checksum = item.checksum
+        task.start_time = time.time()
+        if self.history:
+            self.history.save(task)
+        else:
+            task.id = next(self.ids)
+        with self.lock:
+            self.tasks[task.id] = task
+        self._submit(task)
+
+    def pause(self, task_id):
+        if task_id < 0:
+            job = self.jobs[task_id]
+            job.paused = True
+            return job_snapshot(job)
+        task = self.tasks[task_id]
+        if task.status != "completed":
+            task.paused = True
+            task.status = "paused"
+            if self.history:
+                self.history.save(task)
+        return snapshot(task, self.errors.get(task_id))
+
+    def resume(self, task_id):
+        if task_id < 0:
+            job = self.jobs[task_id]
+            job.paused = False
+            return job_snapshot(job)
+        task = self.tasks[task_id]
+        if task.status != "completed":
+            task.paused = False
+            self._submit(task)
+        return snapshot(task)
+
+    def cancel(self, task_id):
+        if task_id < 0:
+            with self.lock:
+                self.jobs.pop(task_id).cancel = True
+            return True
+        with self.lock:
+            task = self.tasks.pop(task_id)
+        task.cancel = True
+        task.paused = True
+        self.scheduler.remove(task)
+        self.errors.pop(task_id, None)
+        return True
+
+    def configure(self, threads=None, limit=None, schedule=None):
+        # threads: 0 for automatic; limit: bytes per second for this shard, 0 for none;
+        # schedule: RateSchedule entries for this shard, [] for none
+        if threads is not None:
+            self.downloader.auto_threads = not threads
+            if threads:
+                self.downloader.num_threads = threads
+        if limit is not None:
+            self.downloader.limiter.set_rate(limit)
+        if schedule is not None:
+            self.downloader.limiter.set_schedule(RateSchedule(schedule))
+        return True
+
+    def snapshots(self):
+        with self.lock:
+            tasks = list(self.tasks.values())
+            jobs = list(self.jobs.values())
+        return [snapshot(task, self.errors.get(task.id)) for task in tasks] + [job_snapshot(job) for job in jobs]
+
+    def stats(self):
+        return self.downloader.stats()
+
+    def counts(self):
+        return self.history.counts() if self.history else {}
+
+    def close(self):
+        # Pausing writes every journal on the way out; what the user had not paused is
+        # recorded as queued again, so the next daemon picks it up
+        with self.lock:
+            stopping = [task for task in self.tasks.values()
+                        if not task.paused and task.status not in ("completed", "failed")]
+        for task in stopping:
+            task.paused = True
+        deadline = time.time() + 5
+        while self.scheduler.running and time.time() < deadline:
+            time.sleep(0.1)
+        if self.history:
+            for task in stopping:
+                task.paused = False
+                task.status = "queued"
+                self.history.save(task, segments=True)
+        return True
+
+def _shard_main(conn, options, state_dir, shard, shards):
+    # Entry point of a shard process: runs requests from the daemon on a small pool
+    host = EngineHost(options, state_dir, shard, shards)
+    host.restore()
+    send_lock = threading.Lock()
+    pool = ThreadPoolExecutor(max_workers=8)
+
+    def run(request_id, name, args):
+        try:
+            reply = (request_id, True, host.call(name, *args))
+        except Exception as e:
+            reply = (request_id, False, str(e) or type(e).__name__)
+        with send_lock:
+            conn.send(reply)
+
+    while True:
+        try:
+            request_id, name, args = conn.recv()
+        except (EOFError, OSError):
+            host.close()
+            return
+        if name == 'close':
+            run(request_id, name, args)
+            return
+        pool.submit(run, request_id, name, args)
+
+class ShardProxy:
+    # EngineHost.call() for a host running in a shard process
+    def __init__(self, context, options, state_dir, shard, shards):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_shard_main, args=(child, options, state_dir, shard, shards),
+                                       name=f"kdm-shard-{shard}", daemon=True)
+        self.process.start()
+        child.close()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.ids = itertools.count()
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def call(self, name, *args):
+        slot = [threading.Event(), False, "Shard process exited"]
+        with self.lock:
+            request_id = next(self.ids)
+            self.pending[request_id] = slot
+            self.conn.send((request_id, name, args))
+        slot[0].wait()
+        if not slot[1]:
+            raise DaemonError(slot[2])
+        return slot[2]
+
+    def _read(self):
+        while True:
+            try:
+                request_id, ok, result = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                slot = self.pending.pop(request_id, None)
+            if slot:
+                slot[1], slot[2] = ok, result
+                slot[0].set()
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for slot in pending.values():
+            slot[0].set()
+
+class _Connection:
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.lock = threading.Lock()
+        self.sent = {}  # Last snapshot sent per task id, for subscribers
+        self.in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+
+    def send(self, message):
+        data = json.dumps(message, separators=(',', ':')).encode() + b'\n'
+        with self.lock:
+            self.wfile.write(data)
+            self.wfile.flush()
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        daemon = self.server.kdm
+        client = _Connection(self.wfile)
+        try:
+            hello = json.loads(self.rfile.readline() or b'null')
+            if not isinstance(hello, dict) or not secrets.compare_digest(str(hello.get('token')), daemon.token):
+                return
+            client.send({'event': 'hello', 'pid': os.getpid()})
+            for line in self.rfile:
+                # Requests run side by side, so a slow probe in "add" holds nothing up
+                request = json.loads(line)
+                client.in_flight.acquire()
+                future = daemon.requests.submit(daemon.handle, client, request)
+                future.add_done_callback(lambda _: client.in_flight.release())
+        except (OSError, ValueError):
+            pass
+        finally:
+            daemon.unsubscribe(client)
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class DownloadDaemon:
+    # Serves the engine to clients. With workers > 1 the tasks are spread over that many
+    # shard processes, each with its own engine, so byte moving uses several cores.
+    def __init__(self, options=None, state_dir=None, workers=0, port=0):
+        self.options = dict(DEFAULT_OPTIONS, **(options or {}))
+        self.state_dir = state_dir or default_state_dir()
+        os.makedirs(self.state_dir, exist_ok=True)
+        try:
+            connect(self.state_dir).close()
+        except DaemonError:
+            pass
+        else:
+            raise DaemonError(f"A download daemon is already running for {self.state_dir}")
+        if workers > 1:
+            context = multiprocessing.get_context('spawn')
+            self.hosts = [ShardProxy(context, self.options, self.state_dir, i, workers) for i in range(workers)]
+        else:
+            host = EngineHost(self.options, self.state_dir)
+            host.restore()
+            self.hosts = [host]
+        self.owner = {}  # Task id -> host
+        for host in self.hosts:
+            for task in host.call('snapshots'):
+                self.owner[task['id']] = host
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.requests = ThreadPoolExecutor(max_workers=REQUEST_THREADS, thread_name_prefix="kdm-request")
+        self.token = secrets.token_hex(16)
+        self.server = _Server(('127.0.0.1', port), _Handler)
+        self.server.kdm = self
+        self.port = self.server.server_address[1]
+        self.state_path = os.path.join(self.state_dir, STATE_FILE)
+        fd = os.open(self.state_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'port': self.port, 'token': self.token, 'pid': os.getpid()}, f)
+        self.stopped = threading.Event()
+
+    def serve_forever(self):
+        threading.Thread(target=self._broadcast, daemon=True).start()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.stopped.set()
+            self.requests.shutdown(wait=False)
+            try:
+                os.remove(self.state_path)
+            except OSError:
+                pass
+
+    def handle(self, client, request):
+        try:
+            result = self.dispatch(client, request.get('cmd'), request.get('args') or {})
+            reply = {'id': request.get('id'), 'result': result}
+        except KeyError as e:
+            reply = {'id': request.get('id'), 'error': f"Unknown task {e}"}
+        except Exception as e:
+            reply = {'id': request.get('id'), 'error': str(e) or type(e).__name__}
+        try:
+            client.send(reply)
+        except OSError:
+            pass
+
+    def dispatch(self, client, cmd, args):
+        if cmd == 'add':
+            host = self._least_loaded()
+            url, mirrors, checksum = parse_sources(args['url'].split())
+            task = host.call('add', url, args.get('directory', '.'), args.get('checksum') or checksum,
+                             list(args.get('mirrors', ())) + mirrors, args.get('priority', 0),
+                             args.get('extract', False), args.get('limit', 0))
+            with self.lock:
+                self.owner[task['id']] = host
+            return task
+        if cmd == 'bulk':
+            host = self._least_loaded()
+            job = host.call('bulk', [tuple(entry) for entry in args['entries']], args.get('directory', '.'))
+            with self.lock:
+                self.owner[job['id']] = host
+            return job
+        if cmd in ('pause', 'resume'):
+            return self._owner(args['id']).call(cmd, args['id'])
+        if cmd == 'cancel':
+            host = self._owner(args['id'])
+            with self.lock:
+                self.owner.pop(args['id'], None)
+            return host.call('cancel', args['id'])
+        if cmd == 'list':
+            return self.snapshots()
+        if cmd == 'stats':
+            stats = [host.call('stats') for host in self.hosts]
+            return stats[0] if len(stats) == 1 else {'shards': stats}
+        if cmd == 'counts':
+            # Shards share one history database
+            return self.hosts[0].call('counts')
+        if cmd == 'configure':
+            limit = args.get('limit')
+            if limit:
+                limit = max(1, limit // len(self.hosts))
+            schedule = args.get('schedule')
+            if schedule is not None:
+                schedule = [(start, end, max(1, rate // len(self.hosts)) if rate else 0)
+                            for start, end, rate in schedule]
+            for host in self.hosts:
+                host.call('configure', args.get('threads'), limit, schedule)
+            return True
+        if cmd == 'subscribe':
+            tasks = self.snapshots()
+            client.sent = {task['id']: task for task in tasks}
+            with self.lock:
+                self.subscribers.add(client)
+            return tasks
+        if cmd == 'shutdown':
+            threading.Thread(target=self.shutdown, daemon=True).start()
+            return True
+        raise DaemonError(f"Unknown command {cmd!r}")
+
+    def _owner(self, task_id):
+        with self.lock:
+            host = self.owner.get(task_id)
+        if host is None:
+            # Started inside a host, e.g. a large file a bulk job came across
+            for candidate in self.hosts:
+                for task in candidate.call('snapshots'):
+                    with self.lock:
+                        self.owner.setdefault(task['id'], candidate)
+            with self.lock:
+                host = self.owner[task_id]
+        return host
+
+    def _least_loaded(self):
+        # Host with the fewest tasks; a bulk job counts as one however many files it has
+        with self.lock:
+            load = {host: 0 for host in self.hosts}
+            for host in self.owner.values():
+                load[host] += 1
+        return min(self.hosts, key=load.get)
+
+    def snapshots(self):
+        return [task for host in self.hosts for task in host.call('snapshots')]
+
+    def unsubscribe(self, client):
+        with self.lock:
+            self.subscribers.discard(client)
+
+    def _broadcast(self):
+        # One batch per interval with the tasks that changed since the last one
+        while not self.stopped.wait(BATCH_INTERVAL):
+            with self.lock:
+                subscribers = list(self.subscribers)
+            if not subscribers:
+                continue
+            try:
+                tasks = self.snapshots()
+            except DaemonError:
+                continue
+            current = {task['id']: task for task in tasks}
+            for client in subscribers:
+                changed = [task for task in tasks if client.sent.get(task['id']) != task]
+                removed = [task_id for task_id in client.sent if task_id not in current]
+                if not (changed or removed):
+                    continue
+                client.sent = current
+                try:
+                    client.send({'event': 'progress', 'tasks': changed, 'removed': removed})
+                except OSError:
+                    self.unsubscribe(client)
+
+    def close_hosts(self):
+        for host in self.hosts:
+            try:
+                host.call('close')
+            except DaemonError:
+                pass
+
+    def shutdown(self):
+        self.close_hosts()
+        self.server.shutdown()
+
+class DaemonClient:
+    # Connection to a DownloadDaemon. Calls block until their reply arrives; events
+    # (progress batches after subscribe()) go to on_event on the reader thread.
+    HANDSHAKE_TIMEOUT = 5
+
+    def __init__(self, port, token, on_event=None, host='127.0.0.1', timeout=30):
+        # A listener that is not a daemon, or a hung one, fails the handshake in time
+        self.sock = socket.create_connection((host, port), timeout=min(timeout, self.HANDSHAKE_TIMEOUT))
+        self.rfile = self.sock.makefile('rb')
+        self.on_event = on_event
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.ids = itertools.count()
+        try:
+            self._send({'token': token})
+            hello = json.loads(self.rfile.readline() or b'null')
+        except (OSError, ValueError):
+            self.close()
+            raise DaemonError("No answer from the daemon")
+        if not isinstance(hello, dict) or hello.get('event') != 'hello':
+            self.close()
+            raise DaemonError("Daemon refused the connection")
+        self.sock.settimeout(None)
+        self.pid = hello.get('pid')
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _send(self, message):
+        self.sock.sendall(json.dumps(message, separators=(',', ':')).encode() + b'\n')
+
+    def _read(self):
+        try:
+            for line in self.rfile:
+                message = json.loads(line)
+                if 'event' in message:
+                    if self.on_event:
+                        self.on_event(message)
+                    continue
+                with self.lock:
+                    slot = self.pending.pop(message.get('id'), None)
+                if slot:
+                    slot[1] = message
+                    slot[0].set()
+        except (OSError, ValueError):
+            pass
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for slot in pending.values():
+            slot[0].set()
+
+    def call(self, cmd, **args):
+        slot = [threading.Event(), None]
+        with self.lock:
+            request_id = next(self.ids)
+            self.pending[request_id] = slot
+            self._send({'id': request_id, 'cmd': cmd, 'args': args})
+        # Adding probes the server first, which may take a while
+        if not slot[0].wait(self.timeout + 60 if cmd == 'add' else self.timeout):
+            raise DaemonError(f"No reply to {cmd}")
+        reply = slot[1]
+        if reply is None:
+            raise DaemonError("Connection to the daemon closed")
+        if 'error' in reply:
+            raise DaemonError(reply['error'])
+        return reply['result']
+
+    def add(self, url, **options):
+        return self.call('add', url=url, **options)
+
+    def bulk(self, entries, **options):
+        # entries: (url, checksum or None) pairs
+        return self.call('bulk', entries=[list(entry) for entry in entries], **options)
+
+    def pause(self, task_id):
+        return self.call('pause', id=task_id)
+
+    def resume(self, task_id):
+        return self.call('resume', id=task_id)
+
+    def cancel(self, task_id):
+        return self.call('cancel', id=task_id)
+
+    def list(self):
+        return self.call('list')
+
+    def stats(self):
+        return self.call('stats')
+
+    def counts(self):
+        return self.call('counts')
+
+    def configure(self, threads=None, limit=None, schedule=None):
+        # schedule: (start, end, bytes per second) entries as from parse_schedule
+        return self.call('configure', threads=threads, limit=limit,
+                         schedule=[list(entry) for entry in schedule] if schedule is not None else None)
+
+    def subscribe(self):
+        return self.call('subscribe')
+
+    def shutdown(self):
+        return self.call('shutdown')
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+def _open(path, on_event):
+    # Client for the daemon recorded in path; ConnectionRefusedError means it is gone
+    try:
+        with open(path) as f:
+            state = json.load(f)
+        port, token = state['port'], state['token']
+    except (OSError, ValueError, KeyError, TypeError):
+        raise DaemonError("No daemon state")
+    return DaemonClient(port, token, on_event)
+
+@contextlib.contextmanager
+def _spawn_lock(state_dir):
+    # Held while a client starts a daemon, so the others wait for it instead of starting
+    # their own; the lock goes with the process if it dies
+    with open(os.path.join(state_dir, LOCK_FILE), 'a') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+def connect(state_dir=None, on_event=None, spawn=False, args=(), timeout=10):
+    # Client for the daemon of state_dir. With spawn=True a daemon is started in the
+    # background when none answers (args go to its command line).
+    state_dir = state_dir or default_state_dir()
+    path = os.path.join(state_dir, STATE_FILE)
+    try:
+        return _open(path, on_event)
+    except (DaemonError, OSError):
+        if not spawn:
+            raise DaemonError(f"No download daemon running for {state_dir}")
+    os.makedirs(state_dir, exist_ok=True)
+    with _spawn_lock(state_dir):
+        try:
+            return _open(path, on_event)  # Started by another client while we waited
+        except ConnectionRefusedError:
+            try:
+                os.remove(path)  # Left behind by a daemon that died
+            except OSError:
+                pass
+        except (DaemonError, OSError):
+            pass
+        subprocess.Popen([sys.executable, '-m', 'kdm', '--daemon', '--state-dir', state_dir, *args],
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                         start_new_session=True)
+        deadline = time.time() + timeout
+        while True:
+            try:
+                return _open(path, on_event)
+            except (DaemonError, OSError):
+                pass
+            if time.time() >= deadline:
+                raise DaemonError("Download daemon did not start")
+            time.sleep(0.1)
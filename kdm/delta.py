@@ -0,0 +1,166 @@
+import hashlib
+import json
+import mmap
+import os
+from itertools import accumulate
+
+from .segments import Segment
+from .storage import OutputFile
+
+# Block index published next to a file (<url>.kdmsync) so a client holding an older
+# copy only downloads the blocks that changed, in the spirit of zsync. Real .zsync files
+# use MD4, which hashlib no longer offers everywhere, hence a format of our own.
+INDEX_SUFFIX = '.kdmsync'
+INDEX_VERSION = 1
+BLOCK_SIZE = 65536
+# The byte-by-byte scan runs at a few MB/s, so it stops once SCAN_PROBE bytes were rolled
+# over and they are more than MAX_UNMATCHED of what was scanned, or after SCAN_SHARE of
+# the old copy (at least SCAN_LIMIT) was rolled over in any case; whatever was found by
+# then is still used
+SCAN_PROBE = 8388608
+MAX_UNMATCHED = 0.5
+SCAN_LIMIT = 33554432
+SCAN_SHARE = 0.05
+COPY_CHUNK = 4194304
+
+def weak_checksum(block):
+    # rsync's rolling checksum: a = sum of bytes, b = sum of the running sums
+    a = sum(block) & 0xFFFF
+    b = sum(accumulate(block)) & 0xFFFF
+    return a | (b << 16)
+
+def strong_checksum(block):
+    return hashlib.blake2b(block, digest_size=16).hexdigest()
+
+def make_index(path, block_size=BLOCK_SIZE):
+    digest = hashlib.sha256()
+    blocks = []
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            digest.update(block)
+            # The short last block is hashed padded, like every block of the old copy
+            block = block.ljust(block_size, b'\0')
+            blocks.append([weak_checksum(block), strong_checksum(block)])
+    return {
+        'version': INDEX_VERSION,
+        'size': os.path.getsize(path),
+        'block_size': block_size,
+        'sha256': digest.hexdigest(),
+        'blocks': blocks,
+    }
+
+def load_index(source, session=None, timeout=None):
+    # source is a local path or an http(s) URL
+    if '://' in source:
+        response = session.get(source, timeout=timeout)
+        response.raise_for_status()
+        index = response.json()
+    else:
+        with open(source) as f:
+            index = json.load(f)
+    if index.get('version') != INDEX_VERSION:
+        raise ValueError(f"Unsupported block index version {index.get('version')}")
+    return index
+
+def match_blocks(index, old_path):
+    # Returns {block number: offset in the old copy} for every block of the new file
+    # found there. A block that follows a match is looked for right behind it first,
+    # which is a single strong hash, and so is the one after it, which skips a block
+    # edited in place; only where both fail does the checksum roll byte by byte, so the
+    # slow path costs what moved, not the file size.
+    block_size = index['block_size']
+    blocks = index['blocks']
+    by_strong = {}
+    by_weak = {}
+    for i, (weak, strong) in enumerate(blocks):
+        by_strong.setdefault(strong, []).append(i)
+        by_weak.setdefault(weak, []).append(i)
+    found = {}
+    size = os.path.getsize(old_path)
+    if size < block_size:
+        return found
+    with open(old_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as old:
+        offset = 0
+        rolled = 0
+        limit = max(SCAN_LIMIT, int(size * SCAN_SHARE))
+        last = size - block_size
+        while offset <= last:
+            at = offset
+            indices = by_strong.get(strong_checksum(old[at:at + block_size]))
+            if not indices and offset + block_size <= last:
+                at = offset + block_size
+                indices = by_strong.get(strong_checksum(old[at:at + block_size]))
+            if indices:
+                for i in indices:
+                    found.setdefault(i, at)
+                offset = at + block_size
+                continue
+            # Roll until some block matches again
+            window = old[offset:offset + block_size]
+            a = sum(window) & 0xFFFF
+            b = sum(accumulate(window)) & 0xFFFF
+            while True:
+                candidates = by_weak.get(a | (b << 16))
+                if candidates and any(blocks[i][1] == strong_checksum(old[offset:offset + block_size])
+                                      for i in candidates):
+                    break
+                if offset >= last:
+                    offset += 1
+                    break
+                out, new = old[offset], old[offset + block_size]
+                a = (a - out + new) & 0xFFFF
+                b = (b - block_size * out + a) & 0xFFFF
+                offset += 1
+                rolled += 1
+                if rolled >= SCAN_PROBE and (rolled > MAX_UNMATCHED * offset or rolled >= limit):
+                    return found  # Too little in common to be worth scanning on
+    return found
+
+def plan(task, index, old_path):
+    # Copies the blocks found in the old copy into the task's temp file and turns the
+    # rest into segments, so the normal download fetches only those. Returns the number
+    # of bytes reused.
+    block_size = index['block_size']
+    size = index['size']
+    found = match_blocks(index, old_path)
+    if not found:
+        return 0
+    count = len(index['blocks'])
+    output = OutputFile(task.temp_filename, size, truncate=True)
+    segments = []
+    reused = 0
+    try:
+        with open(old_path, 'rb') as old:
+            i = 0
+            while i < count:
+                # Run of blocks that are all found, or all missing
+                j = i + 1
+                if i in found:
+                    while j < count and found.get(j) == found[i] + (j - i) * block_size:
+                        j += 1
+                else:
+                    while j < count and j not in found:
+                        j += 1
+                start = i * block_size
+                end = min(j * block_size, size) - 1
+                if i in found:
+                    old.seek(found[i])
+                    pos = start
+                    while pos <= end:
+                        data = old.read(min(COPY_CHUNK, end - pos + 1))
+                        output.write_at(pos, data)
+                        pos += len(data)
+                    reused += end - start + 1
+                    segments.append(Segment(start, end, end + 1))
+                else:
+                    segments.append(Segment(start, end))
+                i = j
+        output.sync()
+    finally:
+        output.close()
+    task.segments = segments
+    task.piece_hashes = {}
+    return reused
@@ -0,0 +1,687 @@
+import os
+import time
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .buffers import BodyReader, BufferPool
+from .integrity import PIECE_SIZE, PieceHasher, StreamingDigest, find_bad_pieces, piece_ranges
+from .control import ConnectionBudget, ConnectionController, HostProfiles
+from .metrics import MetricsRegistry, serve_metrics
+from .mirrors import Mirror, MirrorSet, same_file
+from .probe import FileInfo, ProbeCache, probe
+from .ratelimit import BandwidthLimiter
+from .retry import RETRYABLE_STATUS, RetryBudget, RetryPolicy, parse_retry_after
+from .segments import Segment, SegmentScheduler
+from .storage import OutputFile, ResumeJournal, validators_match
+from .writer import WriterStage, WriteTicket
+
+class MultiThreadDownloader:
+    AUTO_START_THREADS = 8
+    DIGEST_CATCH_UP = 67108864  # Bytes read back per progress tick at most
+    MAX_REPAIRS = 2
+    
+    def __init__(self, num_threads=64, auto_threads=False, max_threads=256, profile_path=None, buffer_memory=None,
+                 writer_threads=0):
+        self.num_threads = num_threads
+        self.auto_threads = auto_threads
+        self.max_threads = max_threads
+        if profile_path is None:
+            profile_path = os.path.join(os.path.expanduser('~'), '.kdownloadmanager', 'hosts.json')
+        self.host_profiles = HostProfiles(profile_path)
+        self.limiter = BandwidthLimiter()
+        self.metrics = MetricsRegistry()
+        self.retry = RetryPolicy()
+        self.probes = ProbeCache()
+        self.buffers = BufferPool(max_bytes=buffer_memory)
+        # Optional stage that takes disk writes off the segment workers
+        self.writer = WriterStage(writer_threads) if writer_threads else None
+        self.session = requests.Session()
+        self.budget = None
+        self.worker_pool = None
+        self.set_budget(ConnectionBudget(max_threads, max_threads))
+    
+    def _mount(self, per_host):
+        # The HTTP pool keeps at most one idle socket per connection slot of a host
+        adapter = HTTPAdapter(pool_connections=100, pool_maxsize=per_host)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+    
+    def set_budget(self, budget):
+        # The first budget is kept for good; later ones only change its limits, so the
+        # slots running workers hold count against the new caps too
+        if self.budget is None:
+            self.budget = budget
+            changed = True
+        else:
+            changed = self.budget.per_host != budget.per_host
+            self.budget.resize(budget.total, budget.per_host)
+        self._size_pool(self.budget.total)
+        if changed:
+            self._mount(self.budget.per_host)
+    
+    def _size_pool(self, total):
+        # Segment workers of every download run on one pool. Workers only start with a
+        # budget slot, so a larger pool never runs more of them than the budget allows;
+        # it only has to grow.
+        if self.worker_pool is None:
+            self.worker_pool = ThreadPoolExecutor(max_workers=total)
+        elif total > self.worker_pool._max_workers:
+            self.worker_pool._max_workers = total
+    
+    def stats(self):
+        # JSON-ready snapshot of connection metrics per task and per host
+        stats = self.metrics.snapshot()
+        buffers = self.buffers
+        stats['buffers'] = {
+            'size': buffers.buffer_size,
+            'allocated': buffers.allocated,
+            'limit': buffers.max_buffers,
+            'in_use': buffers.in_use,
+            'waits': buffers.waits,
+        }
+        if self.writer:
+            stats['writer'] = self.writer.snapshot()
+        return stats
+    
+    def serve_metrics(self, port=9464, host='127.0.0.1'):
+        # Local endpoint with /metrics in Prometheus text format and /stats as JSON
+        return serve_metrics(self.metrics, port, host)
+    
+    def get_file_info(self, url):
+        # Probes a new download; start_download reuses the result instead of asking again
+        try:
+            info = self.file_info(url, refresh=True)
+        except Exception:
+            return None, 0, False
+        return info.filename, info.size, info.accept_ranges
+    
+    def file_info(self, url, refresh=False):
+        info = None if refresh else self.probes.get(url)
+        if info is None:
+            info = probe(self.session, url)
+            self.probes.put(info)
+        return info
+
+    def _mirror_set(self, task, info):
+        # Probes the task's mirrors and keeps the ones serving the same file as its URL
+        urls = [url for url in dict.fromkeys(task.mirrors) if url != task.url]
+        if not urls:
+            return None
+        mirrors = [Mirror(task.url, info.resolved_url, info.etag, info.last_modified)]
+        with ThreadPoolExecutor(max_workers=min(8, len(urls))) as probes:
+            for url, other in zip(urls, probes.map(self._try_file_info, urls)):
+                if other is not None and same_file(info, other):
+                    mirrors.append(Mirror(url, other.resolved_url, other.etag, other.last_modified))
+        return MirrorSet(mirrors) if len(mirrors) > 1 else None
+    
+    def _resumed_info(self, task):
+        # A download restored with its segments, size and validators skips the probe and
+        # goes straight to where its redirects ended; the first range response revalidates
+        if not (task.segments and task.total_size and (task.etag or task.last_modified)):
+            return None
+        info = FileInfo(task.url, task.download_url, os.path.basename(task.filename), task.total_size, True,
+                        task.etag, task.last_modified)
+        self.probes.put(info)
+        return info
+
+    def _try_file_info(self, url):
+        try:
+            return self.file_info(url)
+        except Exception:
+            return None
+
+    def download_chunk(self, task, scheduler, output, seg, cursor, mirror=None, cell=None):
+        # Fetches seg from the cursor's position; a hedged duplicate may run the same segment.
+        # With mirrors, the worker's mirror serves the range and cell counts its bytes.
+        start = cursor[0]
+        end = seg.end
+        if start > end:
+            return True
+        
+        headers = {'Range': f'bytes={start}-{end}'}
+        source = mirror or task
+        conn = task.metrics.open(start, end, retry=seg.failures > 0, host=mirror.host if mirror else None)
+        result, error, retry_after = 'error', None, None
+        # Taken before connecting, so a connection waiting for a buffer holds no socket
+        stopped = lambda: task.paused or task.cancel or task.failure
+        buf = self.buffers.acquire(stopped)
+        ticket = WriteTicket(cursor, self.buffers) if self.writer else None
+        try:
+            if buf is None:
+                result = 'stopped'
+                return False
+            url = source.download_url
+            response = self.session.get(url, headers=headers, stream=True, timeout=self.retry.timeout)
+            conn.response(response.status_code)
+            error, retry_after = self._check_response(task, mirror, url, response.status_code, response.headers, start)
+            if error:
+                response.close()
+                return False
+            
+            offset = start
+            pieces = PieceHasher(task.piece_hashes, task.total_size) if task.checksum else None
+            body = BodyReader(response)
+            try:
+                while True:
+                    if task.paused or task.cancel or task.failure:
+                        result = 'stopped'
+                        return False
+                    if ((scheduler.controller and scheduler.controller.claim()) or (mirror and mirror.evict)
+                            or seg.preempted):
+                        # Hand the rest of the segment back so the connection can be dropped
+                        # or start again nearer a stream reader
+                        result = 'stopped'
+                        return True
+                    # Never read past the end, which moves when the tail is split off
+                    want = min(len(buf), seg.end - offset + 1)
+                    if want <= 0:
+                        break
+                    data_len = body.readinto(buf[:want])
+                    if not data_len:
+                        break
+                    data = buf[:data_len]
+                    written = conn.received(data_len)
+                    if pieces:
+                        pieces.feed(offset, data)
+                        task.digest.feed_at(offset, data)
+                    if ticket:
+                        # The writer advances the cursor once the bytes are on disk;
+                        # the time spent here is time the disk held the network up
+                        self.writer.submit(output, offset, data, buf, ticket)
+                        conn.wrote(written)
+                        buf = self.buffers.acquire(stopped)
+                        if buf is None:
+                            result = 'stopped'
+                            return False
+                    else:
+                        output.write_at(offset, data)
+                        conn.wrote(written)
+                        cursor[0] = offset + data_len
+                    offset += data_len
+                    if cell:
+                        cell[0] += data_len
+                    throttled = time.perf_counter()
+                    self.limiter.throttle(task, data_len)
+                    conn.throttled(throttled)
+                    # Stop once the tail was split off or a hedged copy already finished it
+                    if offset > seg.end or seg.complete:
+                        break
+            finally:
+                body.close()
+            if ticket:
+                failed = ticket.wait()
+                if failed is not None:
+                    raise failed
+            done = offset > end or seg.complete
+            result = 'ok' if done else 'error'
+            if not done:
+                error = "Connection closed early"
+            elif mirror:
+                task.mirror_set.succeeded(mirror)
+            return done
+        except Exception as e:
+            error = str(e)
+            return False
+        finally:
+            if ticket:
+                ticket.wait()
+            if buf is not None:
+                self.buffers.release(buf)
+            if result == 'error':
+                seg.failures += 1
+                if not (task.paused or task.cancel or task.invalidated or task.failure):
+                    self._schedule_retry(task, scheduler, seg, conn.bytes, error, retry_after, mirror)
+            task.metrics.close(conn, result, error)
+
+    def _check_response(self, task, mirror, url, status, headers, start):
+        # Returns (error, retry_after) when a range response can't be used, else (None, None)
+        source = mirror or task
+        # A 200 means the server ignored the Range header; only usable from offset 0
+        if status != 206 and not (status == 200 and start == 0):
+            error = f"HTTP {status}"
+            if status in (429, 503):
+                return error, parse_retry_after(headers.get('retry-after'))
+            if 400 <= status < 500 and status not in RETRYABLE_STATUS:
+                if url != source.url:
+                    # Redirect targets such as signed CDN links expire; go back through
+                    # the original URL and let the retry follow the redirects again
+                    source.resolved_url = None
+                    self.probes.forget(source.url)
+                elif not (mirror and task.mirror_set.drop(mirror)):
+                    # Asking again won't change the answer
+                    task.failure = error
+            return error, None
+        total = headers.get('content-range', '').rpartition('/')[2]
+        if (not validators_match(headers.get('etag'), headers.get('last-modified'), source.etag, source.last_modified)
+                or (status == 206 and total.isdigit() and int(total) != task.total_size)):
+            # A mirror out of step with the others is dropped; when the task's own URL
+            # changed, bytes from it must not be spliced into this file
+            if mirror is None or mirror.url == task.url or not task.mirror_set.drop(mirror):
+                task.invalidated = True
+            return "File changed on server", None
+        return None, None
+
+    def _schedule_retry(self, task, scheduler, seg, received, error, retry_after, mirror=None):
+        # A connection that broke after delivering bytes reconnects at once from the last
+        # byte; one that got nothing backs off and uses up part of the task's retry budget
+        if received and retry_after is None:
+            seg.backoff = 0
+            return
+        seg.backoff += 1
+        delay = self.retry.delay(seg.backoff, retry_after)
+        # With mirrors, the failing one sits out the delay and the range is free for the
+        # others at once
+        if not (mirror and task.mirror_set.failed(mirror, delay)):
+            seg.retry_at = time.monotonic() + delay
+            if retry_after is not None:
+                # 429/503: the server wants the whole download to slow down, not just this range
+                scheduler.hold(delay)
+        if not task.retry_budget.spend():
+            task.failure = f"Too many errors ({error})"
+
+    def _segment_worker(self, task, scheduler, output, budget, host, mirror=None):
+        controller = scheduler.controller
+        cell = task.mirror_set.enlist(mirror) if mirror else None
+        try:
+            while not (task.paused or task.cancel or task.failure):
+                if controller.retire():
+                    return
+                if mirror and mirror.evict:
+                    # Demoted or dropped; the supervisor starts a worker on another mirror
+                    break
+                attempt = scheduler.acquire()
+                if attempt is None:
+                    # Everything left is either taken or backing off after an error
+                    delay = scheduler.next_retry()
+                    if delay is None:
+                        break
+                    time.sleep(min(delay, 0.25))
+                    continue
+                seg, cursor = attempt
+                try:
+                    ok = self.download_chunk(task, scheduler, output, seg, cursor, mirror, cell)
+                finally:
+                    scheduler.release(seg, cursor)
+                if not ok and not (task.paused or task.cancel):
+                    # The failed segment waits out its backoff; meanwhile this worker
+                    # moves on to another one
+                    controller.record_error()
+            controller.leave()
+        finally:
+            if cell:
+                task.mirror_set.leave(mirror, cell)
+            budget.release(host)
+
+    def _spawn_workers(self, task, scheduler, output, host, futures):
+        # Start workers up to the task's target as far as the shared budget allows. With
+        # mirrors, each goes to the usable mirror furthest below its speed-weighted share
+        # that still has a free slot, so per-host caps add up across mirrors.
+        controller = scheduler.controller
+        budget = self.budget
+        spare = scheduler.spare()
+        while (spare > 0 and not (task.paused or task.invalidated or task.failure)
+               and controller.may_grow and controller.enlist()):
+            spare -= 1
+            mirror = None
+            if task.mirror_set:
+                mirror = next((m for m in task.mirror_set.candidates() if budget.acquire(m.host)), None)
+                acquired = mirror is not None
+            else:
+                acquired = budget.acquire(host)
+            if not acquired:
+                controller.leave()
+                return
+            futures.add(self.worker_pool.submit(self._segment_worker, task, scheduler, output, budget,
+                                                mirror.host if mirror else host, mirror))
+
+    def start_download(self, task, on_progress, on_complete, on_error):
+        report_error = on_error
+        def on_error(task, error):
+            # Tells a stream reader the run is over, which a pause is not
+            task.status = "failed"
+            report_error(task, error)
+        task.status = "downloading"
+        task.paused = False
+        task.retry_budget = RetryBudget(self.retry.budget)
+        task.failure = None
+        
+        # Usually answered from the probe made when the download was added. Range
+        # responses are checked against the validators, so a change is still caught.
+        task.mirror_set = None
+        try:
+            info = self.probes.get(task.url) or self._resumed_info(task) or self.file_info(task.url)
+            supports_range = info.accept_ranges
+            etag = info.etag
+            last_modified = info.last_modified
+            task.resolved_url = info.resolved_url if info.resolved_url != task.url else None
+            if supports_range and task.mirrors:
+                task.mirror_set = self._mirror_set(task, info)
+        except Exception:
+            supports_range = False
+            etag = last_modified = None
+            task.resolved_url = None
+        task.metrics = self.metrics.track(task, urlparse(task.download_url).hostname)
+        
+        if task.segments and not validators_match(task.etag, task.last_modified, etag, last_modified):
+            task.segments = []
+        task.etag = etag
+        task.last_modified = last_modified
+        if task.delta_source and supports_range and not task.segments and task.total_size > 102400:
+            self._plan_delta(task)
+        if task.checksum and (task.digest is None or not task.segments):
+            task.digest = StreamingDigest(*task.checksum)
+        task.invalidated = False
+        
+        extractor = self._extractor(task)
+        finished = []
+        report_complete = on_complete
+        if extractor:
+            # Reported below, once the extractor has caught up
+            on_complete = finished.append
+        if task.total_size > 102400 and supports_range:
+            self._multi_thread_download(task, on_progress, on_complete, on_error)
+        else:
+            self._single_thread_download(task, on_progress, on_complete, on_error)
+        if finished:
+            error = extractor.wait()
+            if error:
+                on_error(task, f"Extraction failed: {error}")
+                return
+            if not task.keep_archive:
+                os.remove(task.filename)
+            report_complete(task)
+    
+    def _plan_delta(self, task):
+        # Reuses blocks of an older copy; any problem with the index or the copy just
+        # means a full download. An interrupted delta download resumes from its journal.
+        if ResumeJournal(task).load() is not None or not os.path.exists(task.delta_source):
+            return
+        from . import delta  # Only loaded for delta downloads
+        try:
+            index = delta.load_index(task.delta_index or task.download_url + delta.INDEX_SUFFIX,
+                                     self.session, self.retry.timeout)
+            if index['size'] != task.total_size:
+                return
+            task.reused = delta.plan(task, index, task.delta_source)
+        except Exception:
+            task.segments = []
+            return
+        if task.reused and not task.checksum:
+            # Catches an index that doesn't belong to what the server sends
+            task.checksum = ('sha256', index['sha256'])
+    
+    def _extractor(self, task):
+        # One per download; it carries on across pauses and is replaced after a failure
+        if not task.extract_to:
+            return None
+        if task.extractor is None or task.extractor.done.is_set():
+            from .extract import ArchiveExtractor  # Only loaded when something is unpacked
+            task.extractor = ArchiveExtractor(self, task, task.extract_to)
+        return task.extractor
+
+    def _multi_thread_download(self, task, on_progress, on_complete, on_error):
+        while self._supervise(task, on_progress, on_complete, on_error):
+            pass  # Corrupted pieces were turned back into segments; fetch them
+
+    def _prepare_run(self, task):
+        # Shared by both engines. Segments live on the task so pause/resume continues
+        # from the same offsets; after a restart they come back from the journal.
+        # Returns (journal, fresh, host, scheduler).
+        journal = ResumeJournal(task)
+        if not task.segments:
+            task.segments = journal.restore(journal.load()) or []
+        fresh = not task.segments
+        if fresh:
+            task.piece_hashes = {}
+        
+        host = urlparse(task.download_url).hostname
+        if self.auto_threads:
+            initial = self.host_profiles.best_threads(host) or self.AUTO_START_THREADS
+            controller = ConnectionController(initial, self.max_threads)
+        else:
+            controller = ConnectionController(self.num_threads, self.num_threads, adaptive=False)
+        threads = controller.target
+        
+        if fresh:
+            chunk_size = task.total_size // threads
+            if chunk_size >= PIECE_SIZE:
+                chunk_size -= chunk_size % PIECE_SIZE
+            for i in range(threads):
+                start = i * chunk_size
+                end = start + chunk_size - 1 if i < threads - 1 else task.total_size - 1
+                task.segments.append(Segment(start, end))
+        scheduler = SegmentScheduler(task, controller)
+        task.downloaded = scheduler.confirmed()
+        return journal, fresh, host, scheduler
+
+    def _finish_run(self, task, scheduler, host, journal, output, on_complete, on_error):
+        # Shared by both engines once no connection is left. Blocks on the disk and, for a
+        # repair, the network. Returns True when the run should go again to fetch pieces
+        # that failed the checksum.
+        controller = scheduler.controller
+        task.downloaded = scheduler.confirmed()
+        if self.auto_threads:
+            self.host_profiles.remember(host, controller.best_target, controller.best_rate)
+        
+        if task.invalidated:
+            task.segments = []
+            journal.remove()
+            self.probes.forget(task.url)
+            on_error(task, "File changed on server")
+            return False
+        
+        journal.save(output)
+        if task.paused or task.cancel:
+            return False
+        
+        if task.failure:
+            # What was downloaded stays in the journal, so resuming picks up from here
+            on_error(task, task.failure)
+            return False
+        
+        if not scheduler.finished():
+            on_error(task, "Incomplete chunks")
+            return False
+        
+        if task.digest:
+            task.digest.catch_up(output.read_at, task.total_size)
+            if not task.digest.matches():
+                if self._repair_pieces(task, output, journal):
+                    return True
+                # Data and journal stay; nothing pointed at a piece to fetch again
+                on_error(task, "Checksum mismatch")
+                return False
+        
+        output.finalize(task.filename)
+        journal.remove()
+        task.status = "completed"
+        on_complete(task)
+        return False
+
+    def _supervise(self, task, on_progress, on_complete, on_error):
+        journal, fresh, host, scheduler = self._prepare_run(task)
+        controller = scheduler.controller
+        
+        last_update = time.time()
+        last_downloaded = task.downloaded
+        
+        try:
+            output = OutputFile(task.temp_filename, task.total_size, truncate=fresh)
+        except OSError as e:
+            task.status = "failed"
+            on_error(task, str(e))
+            return False
+        
+        try:
+            futures = set()
+            self._spawn_workers(task, scheduler, output, host, futures)
+            
+            while True:
+                if task.cancel:
+                    for f in futures: f.cancel()
+                    wait(futures)
+                    return False
+                
+                # Wake up when a worker exits or the next progress sample is due
+                if futures:
+                    _, futures = wait(futures, timeout=0.25, return_when=FIRST_COMPLETED)
+                elif (task.paused or task.invalidated or task.failure or scheduler.finished()
+                      or not controller.may_grow):
+                    break
+                else:
+                    # Only waiting for a connection slot
+                    time.sleep(0.25)
+                
+                current_time = time.time()
+                if not task.paused and current_time - last_update >= 0.25:
+                    task.downloaded = scheduler.confirmed()
+                    elapsed = current_time - last_update
+                    speed = (task.downloaded - last_downloaded) / elapsed if elapsed > 0 else 0
+                    task.speed = speed
+                    task.metrics.sample(current_time, speed, controller.active)
+                    on_progress(task, speed)
+                    last_update = current_time
+                    last_downloaded = task.downloaded
+                    journal.maybe_save(output)
+                    if task.digest:
+                        task.digest.catch_up(output.read_at, scheduler.contiguous(), limit=self.DIGEST_CATCH_UP)
+                    
+                    controller.sample(task.downloaded, current_time)
+                    if task.mirror_set:
+                        task.mirror_set.sample()
+                    scheduler.steer()
+                    if not scheduler.finished():
+                        self._spawn_workers(task, scheduler, output, host, futures)
+            
+            return self._finish_run(task, scheduler, host, journal, output, on_complete, on_error)
+            
+        except Exception as e:
+            on_error(task, str(e))
+            return False
+        finally:
+            output.close()
+
+    def _repair_pieces(self, task, output, journal):
+        # Re-checks the pieces against the hashes taken while they streamed in and turns
+        # the ones that no longer match back into segments; everything else is kept
+        if task.repairs >= self.MAX_REPAIRS:
+            return False
+        bad = find_bad_pieces(output.read_at, task.piece_hashes, task.total_size)
+        if not any(index in task.piece_hashes for index in bad):
+            # The disk holds what arrived, so it was wrong on arrival
+            bad = self._recheck_pieces(task, output)
+        if not bad:
+            return False
+        task.repairs += 1
+        
+        segments = []
+        pos = 0
+        for start, end in piece_ranges(bad, task.total_size):
+            if start > pos:
+                segments.append(Segment(pos, start - 1, start))
+            segments.append(Segment(start, end))
+            pos = end + 1
+            for index in range(start // PIECE_SIZE, end // PIECE_SIZE + 1):
+                task.piece_hashes.pop(index, None)
+        if pos < task.total_size:
+            segments.append(Segment(pos, task.total_size - 1, task.total_size))
+        task.segments = segments
+        task.digest = StreamingDigest(*task.checksum)
+        journal.save(output)
+        return True
+
+    def _recheck_pieces(self, task, output):
+        # Fetches every piece again and returns those that come back different from the
+        # copy on disk. Costs a second pass over the file, but only after a mismatch.
+        def differs(index):
+            if task.paused or task.cancel:
+                return False
+            start = index * PIECE_SIZE
+            end = min(start + PIECE_SIZE, task.total_size) - 1
+            response = self.session.get(task.download_url, headers={'Range': f'bytes={start}-{end}'},
+                                   timeout=self.retry.timeout)
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise OSError("Server ignored the range request")
+            self.limiter.throttle(task, len(response.content))
+            return response.content != output.read_at(start, end - start + 1)
+        
+        count = (task.total_size + PIECE_SIZE - 1) // PIECE_SIZE
+        with ThreadPoolExecutor(max_workers=min(8, self.num_threads)) as pool:
+            return [index for index, bad in enumerate(pool.map(differs, range(count))) if bad]
+
+    def _single_thread_download(self, task, on_progress, on_complete, on_error):
+        headers = {}
+        file_size = 0
+        if os.path.exists(task.filename):
+            file_size = os.path.getsize(task.filename)
+            headers['Range'] = f'bytes={file_size}-'
+            task.downloaded = file_size
+        if task.digest and task.digest.pos != file_size:
+            # Hash state doesn't survive a restart, so hash what is already on disk once
+            task.digest = StreamingDigest(*task.checksum)
+            with open(task.filename, 'rb') as f:
+                task.digest.catch_up(lambda offset, size: f.read(size), file_size)
+        
+        last_update = time.time()
+        last_downloaded = task.downloaded
+        
+        conn = task.metrics.open(file_size, max(task.total_size - 1, file_size))
+        result, error = 'stopped', None
+        buf = self.buffers.acquire(lambda: task.paused or task.cancel)
+        body = None
+        try:
+            if buf is None:
+                return
+            response = self.session.get(task.download_url, headers=headers, stream=True, timeout=self.retry.timeout)
+            body = BodyReader(response)
+            conn.response(response.status_code)
+            if task.total_size == 0:
+                task.total_size = int(response.headers.get('content-length', 0)) + file_size
+            
+            mode = 'ab' if file_size else 'wb'
+            with open(task.filename, mode, buffering=1048576) as f:
+                while True:
+                    if task.paused or task.cancel: return
+                    n = body.readinto(buf)
+                    if not n:
+                        break
+                    chunk = buf[:n]
+                    written = conn.received(n)
+                    f.write(chunk)
+                    conn.wrote(written)
+                    if task.digest:
+                        task.digest.feed_at(task.downloaded, chunk)
+                    task.downloaded += n
+                    throttled = time.perf_counter()
+                    self.limiter.throttle(task, n)
+                    conn.throttled(throttled)
+                    current_time = time.time()
+                    if current_time - last_update >= 0.25:
+                        speed = (task.downloaded - last_downloaded) / (current_time - last_update)
+                        task.speed = speed
+                        task.metrics.sample(current_time, speed, 1)
+                        on_progress(task, speed)
+                        last_update = current_time
+                        last_downloaded = task.downloaded
+            
+            if not task.paused and not task.cancel:
+                result = 'ok'
+                if task.digest and not task.digest.matches():
+                    task.status = "failed"
+                    on_error(task, "Checksum mismatch")
+                    return
+                task.status = "completed"
+                on_complete(task)
+        except Exception as e:
+            result, error = 'error', str(e)
+            task.status = "failed"
+            on_error(task, str(e))
+        finally:
+            if body is not None:
+                body.close()
+            if buf is not None:
+                self.buffers.release(buf)
+            task.metrics.close(conn, result, error)
@@ -0,0 +1,264 @@
+import bisect
+import importlib
+import io
+import os
+import shutil
+import struct
+import tarfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+# Modules are imported when such a file is opened; bz2 and lzma may be missing on Android
+COMPRESSED = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'lzma'}
+EOCD_SEARCH = 65557  # End of central directory record plus the longest comment
+
+def archive_kind(filename):
+    name = filename.lower()
+    if name.endswith('.zip'):
+        return 'zip'
+    if name.endswith(TAR_SUFFIXES):
+        return 'tar'
+    if os.path.splitext(name)[1] in COMPRESSED:
+        return 'compressed'
+    return None
+
+def written_ranges(segments):
+    # Sorted (start, end) ranges that are on disk, adjacent ones merged
+    ranges = []
+    for seg in sorted(list(segments), key=lambda s: s.start):
+        pos = seg.pos
+        if pos <= seg.start:
+            continue
+        if ranges and ranges[-1][1] == seg.start:
+            ranges[-1][1] = pos
+        else:
+            ranges.append([seg.start, pos])
+    return ranges
+
+class ArchiveExtractor:
+    # Unpacks a download into a directory while it is still arriving. Tarballs and
+    # single compressed files are read in order through a DownloadStream, which also
+    # steers connections to the front of the file. For zips the central directory is
+    # fetched first with a Range request; each member is then extracted on a small pool
+    # as soon as its bytes are on disk. wait() returns the error that stopped it, if any.
+    POLL = 0.1
+
+    def __init__(self, downloader, task, directory, threads=4):
+        self.downloader = downloader
+        self.task = task
+        self.directory = directory
+        self.threads = threads
+        self.kind = archive_kind(task.filename)
+        self.error = None
+        self.members = 0
+        self.done = threading.Event()
+        # Opened now so the first ranges handed out are the ones the extractor needs
+        self.stream = task.open_stream() if self.kind in ('tar', 'compressed') else None
+        threading.Thread(target=self._run, name="kdm-extract", daemon=True).start()
+
+    def wait(self):
+        self.done.wait()
+        return self.error
+
+    def _run(self):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            if self.kind == 'tar':
+                self._extract_tar()
+            elif self.kind == 'compressed':
+                self._extract_compressed()
+            elif self.kind == 'zip':
+                self._extract_zip()
+            else:
+                self.error = f"Not an archive: {os.path.basename(self.task.filename)}"
+        except Exception as e:
+            self.error = str(e) or type(e).__name__
+        finally:
+            if self.stream:
+                self.stream.close()
+            self.done.set()
+
+    def _extract_tar(self):
+        with tarfile.open(fileobj=io.BufferedReader(self.stream, 1048576), mode='r|*') as tar:
+            for member in tar:
+                if hasattr(tarfile, 'data_filter'):
+                    tar.extract(member, self.directory, filter='data')
+                elif not (member.name.startswith(('/', '\\')) or '..' in member.name.split('/')):
+                    tar.extract(member, self.directory)
+                self.members += 1
+
+    def _extract_compressed(self):
+        name = os.path.splitext(os.path.basename(self.task.filename))[0]
+        module = COMPRESSED[os.path.splitext(self.task.filename.lower())[1]]
+        try:
+            opener = importlib.import_module(module).open
+        except ImportError:
+            raise OSError(f"This Python has no {module} support")
+        with opener(io.BufferedReader(self.stream, 1048576)) as source, \
+                open(os.path.join(self.directory, name), 'wb') as target:
+            shutil.copyfileobj(source, target, 1048576)
+        self.members = 1
+
+    def _extract_zip(self):
+        task = self.task
+        view = None
+        try:
+            view = self._zip_view()
+        except Exception:
+            pass  # No ranges or an odd layout; unpack the finished file instead
+        if view is None:
+            self._wait_finished()
+            with zipfile.ZipFile(task.filename) as archive:
+                for info in archive.infolist():
+                    archive.extract(info, self.directory)
+                    self.members += 1
+            return
+        with view, zipfile.ZipFile(view) as archive:
+            members = sorted(archive.infolist(), key=lambda info: info.header_offset)
+            # A member's local header and data end where the next member starts
+            ends = [info.header_offset for info in members[1:]] + [view.tail_start]
+            pending = list(zip(members, ends))
+            with ThreadPoolExecutor(max_workers=self.threads) as pool:
+                futures = []
+                while pending:
+                    ready, pending = self._split_ready(pending, view.tail_start)
+                    futures += [pool.submit(self._extract_member, archive, info) for info, _ in ready]
+                    if pending:
+                        self._check_alive()
+                        time.sleep(self.POLL)
+                for future in futures:
+                    future.result()
+                    self.members += 1
+
+    def _extract_member(self, archive, info):
+        try:
+            archive.extract(info, self.directory)
+        except FileExistsError:
+            # Another member created the same parent directory in between; try again
+            archive.extract(info, self.directory)
+
+    def _split_ready(self, pending, tail_start):
+        # Members whose bytes are all on disk (or in the fetched tail), and the rest
+        task = self.task
+        if task.status == "completed":
+            return pending, []
+        ranges = written_ranges(task.segments)
+        starts = [r[0] for r in ranges]
+        ready, waiting = [], []
+        for info, end in pending:
+            end = min(end, tail_start)
+            i = bisect.bisect_right(starts, info.header_offset) - 1
+            if info.header_offset >= end or i >= 0 and ranges[i][1] >= end:
+                ready.append((info, end))
+            else:
+                waiting.append((info, end))
+        return ready, waiting
+
+    def _check_alive(self):
+        if self.task.cancel:
+            raise OSError("Download cancelled")
+        if self.task.status == "failed":
+            raise OSError(self.task.failure or "Download failed")
+
+    def _wait_finished(self):
+        while self.task.status != "completed":
+            self._check_alive()
+            time.sleep(self.POLL)
+
+    def _zip_view(self):
+        # Fetches the end of the archive up to the start of the central directory
+        task = self.task
+        size = task.total_size
+        if not size:
+            return None
+        tail_start = max(0, size - EOCD_SEARCH)
+        tail = self._fetch(tail_start, size - 1)
+        i = tail.rfind(b'PK\x05\x06')
+        if i < 0:
+            return None
+        cd_size, cd_offset = struct.unpack('<II', tail[i + 12:i + 20])
+        cd_end = tail_start + i
+        if 0xFFFFFFFF in (cd_size, cd_offset) and i >= 20 and tail[i - 20:i - 16] == b'PK\x06\x07':
+            record = struct.unpack('<Q', tail[i - 12:i - 4])[0]
+            if record < tail_start:
+                tail = self._fetch(record, tail_start - 1) + tail
+                i += tail_start - record
+                tail_start = record
+            r = record - tail_start
+            cd_size = struct.unpack('<Q', tail[r + 40:r + 48])[0]
+            cd_end = record
+        # Found from where the directory ends rather than cd_offset, which is off by any
+        # bytes in front of the archive (self-extracting stubs)
+        cd_start = cd_end - cd_size
+        if cd_start < tail_start:
+            tail = self._fetch(cd_start, tail_start - 1) + tail
+            tail_start = cd_start
+        return ZipView(task, size, tail_start, tail)
+
+    def _fetch(self, start, end):
+        response = self.downloader.session.get(self.task.download_url, headers={'Range': f'bytes={start}-{end}'},
+                                               timeout=self.downloader.retry.timeout)
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise OSError("Server ignored the range request")
+        return response.content
+
+class ZipView(io.RawIOBase):
+    # The archive as zipfile sees it: the central directory from memory, everything
+    # before it from the file being downloaded
+    def __init__(self, task, size, tail_start, tail):
+        super().__init__()
+        self.task = task
+        self.size = size
+        self.tail_start = tail_start
+        self.tail = tail
+        self.pos = 0
+        self.file = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.pos = max(0, offset)
+        return self.pos
+
+    def readinto(self, b):
+        # Fills b completely unless the end is reached; zipfile treats short reads as damage
+        view = memoryview(b)
+        total = 0
+        while total < len(view) and self.pos < self.size:
+            if self.pos >= self.tail_start:
+                data = self.tail[self.pos - self.tail_start:self.pos - self.tail_start + len(view) - total]
+                view[total:total + len(data)] = data
+                n = len(data)
+            else:
+                if self.file is None:
+                    # Stays valid when the finished file is renamed into place
+                    path = self.task.filename if self.task.status == "completed" else self.task.temp_filename
+                    self.file = open(path, 'rb', buffering=0)
+                self.file.seek(self.pos)
+                n = self.file.readinto(view[total:total + min(len(view) - total, self.tail_start - self.pos)])
+            if not n:
+                break
+            self.pos += n
+            total += n
+        return total
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        super().close()
@@ -0,0 +1,190 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from .segments import Segment
+from .storage import ResumeJournal
+from .task import DownloadTask
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS downloads (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    total_size INTEGER NOT NULL DEFAULT 0,
+    downloaded INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    mirrors TEXT,
+    checksum TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    resolved_url TEXT,
+    rate_limit INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    completed REAL
+);
+CREATE INDEX IF NOT EXISTS downloads_url ON downloads (url);
+CREATE INDEX IF NOT EXISTS downloads_status ON downloads (status);
+CREATE INDEX IF NOT EXISTS downloads_completed ON downloads (completed);
+CREATE TABLE IF NOT EXISTS segments (
+    download_id INTEGER NOT NULL REFERENCES downloads (id) ON DELETE CASCADE,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    pos INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS segments_download ON segments (download_id);
+"""
+
+# Statuses of downloads that still have work to do
+UNFINISHED = ('pending', 'queued', 'downloading', 'paused')
+
+class DownloadHistory:
+    # Every download and its last known state in one SQLite file, so the queue survives
+    # a restart and duplicates are found across sessions. Queries go through indexes
+    # and return plain rows; only downloads being worked on become DownloadTasks.
+    def __init__(self, path):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("PRAGMA foreign_keys=ON")
+            self.db.executescript(SCHEMA)
+            # Databases from before redirect targets and per-task limits were kept
+            columns = {row['name'] for row in self.db.execute("PRAGMA table_info(downloads)")}
+            for name, definition in (('resolved_url', "TEXT"), ('rate_limit', "INTEGER NOT NULL DEFAULT 0")):
+                if name not in columns:
+                    self.db.execute(f"ALTER TABLE downloads ADD COLUMN {name} {definition}")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def save(self, task, segments=False):
+        # Inserts the task on first call (setting task.id), updates it afterwards
+        now = time.time()
+        status = task.status
+        if task.paused and status not in ('completed', 'failed'):
+            status = 'paused'
+        checksum = f"{task.checksum[0]}:{task.checksum[1]}" if task.checksum else None
+        fields = {
+            'url': task.url,
+            'filename': task.filename,
+            'total_size': task.total_size,
+            'downloaded': task.downloaded,
+            'status': status,
+            'mirrors': json.dumps(task.mirrors) if task.mirrors else None,
+            'checksum': checksum,
+            'etag': task.etag,
+            'last_modified': task.last_modified,
+            'resolved_url': task.resolved_url,
+            'rate_limit': task.rate_limit,
+            'error': task.failure if status == 'failed' else None,
+            'updated': now,
+        }
+        with self.lock, self.db:
+            if task.id is None:
+                fields['created'] = now
+                cursor = self.db.execute(
+                    f"INSERT INTO downloads ({', '.join(fields)}) VALUES ({', '.join('?' * len(fields))})",
+                    list(fields.values()))
+                task.id = cursor.lastrowid
+            else:
+                self.db.execute(
+                    f"UPDATE downloads SET {', '.join(f'{name} = ?' for name in fields)}, "
+                    f"completed = CASE WHEN ? = 'completed' THEN coalesce(completed, ?) ELSE NULL END "
+                    f"WHERE id = ?", list(fields.values()) + [status, now, task.id])
+            if segments:
+                self.db.execute("DELETE FROM segments WHERE download_id = ?", (task.id,))
+                if status != 'completed':
+                    with task.lock:
+                        rows = [(task.id, s.start, s.end, s.pos) for s in task.segments]
+                    self.db.executemany("INSERT INTO segments VALUES (?, ?, ?, ?)", rows)
+
+    def remove(self, task_id):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM downloads WHERE id = ?", (task_id,))
+
+    def get(self, task_id):
+        with self.lock:
+            return self.db.execute("SELECT * FROM downloads WHERE id = ?", (task_id,)).fetchone()
+
+    def find(self, url, statuses=None):
+        # Most recent download of url, optionally only among the given statuses
+        query = "SELECT * FROM downloads WHERE url = ?"
+        params = [url]
+        if statuses:
+            query += f" AND status IN ({', '.join('?' * len(statuses))})"
+            params += list(statuses)
+        with self.lock:
+            return self.db.execute(query + " ORDER BY id DESC LIMIT 1", params).fetchone()
+
+    def unfinished(self):
+        with self.lock:
+            return self.db.execute(
+                f"SELECT * FROM downloads WHERE status IN ({', '.join('?' * len(UNFINISHED))}) ORDER BY id",
+                UNFINISHED).fetchall()
+
+    def completed(self, limit=100, before=None):
+        # Finished downloads, newest first; pass the last row's completed time as
+        # before to page further back
+        query = "SELECT * FROM downloads WHERE completed IS NOT NULL"
+        params = []
+        if before is not None:
+            query += " AND completed < ?"
+            params.append(before)
+        with self.lock:
+            return self.db.execute(query + " ORDER BY completed DESC LIMIT ?", params + [limit]).fetchall()
+
+    def counts(self):
+        with self.lock:
+            return {row[0]: row[1] for row in
+                    self.db.execute("SELECT status, count(*) FROM downloads GROUP BY status")}
+
+    def segments(self, task_id):
+        with self.lock:
+            return [Segment(row['start'], row['end'], row['pos']) for row in self.db.execute(
+                "SELECT start, end, pos FROM segments WHERE download_id = ? ORDER BY start", (task_id,))]
+
+    def restore(self, row):
+        # DownloadTask for an unfinished row. The resume journal next to the file is
+        # preferred; the segments saved here are the fallback when it is gone.
+        task = DownloadTask(row['url'], row['filename'], row['total_size'])
+        task.id = row['id']
+        task.status = row['status']
+        task.paused = row['status'] == 'paused'
+        task.mirrors = json.loads(row['mirrors']) if row['mirrors'] else []
+        task.etag = row['etag']
+        task.last_modified = row['last_modified']
+        task.resolved_url = row['resolved_url']
+        task.rate_limit = row['rate_limit']
+        task.downloaded = row['downloaded']
+        if row['checksum']:
+            try:
+                task.set_checksum(row['checksum'])
+            except ValueError:
+                pass
+        journal = ResumeJournal(task)
+        state = journal.load()
+        segments = journal.restore(state)
+        if segments:
+            task.resolved_url = state.get('resolved_url')
+        else:
+            try:
+                on_disk = os.path.getsize(task.temp_filename)
+            except OSError:
+                on_disk = 0
+            # Only bytes the file still holds count
+            segments = [Segment(s.start, s.end, max(s.start, min(s.pos, on_disk)))
+                        for s in self.segments(task.id)] if on_disk else []
+            task.piece_hashes = {}
+        task.segments = segments or []
+        return task
@@ -0,0 +1,119 @@
+import hashlib
+import threading
+
+PIECE_SIZE = 1048576
+CHUNK = 1048576
+
+DIGEST_LENGTHS = {32: 'md5', 40: 'sha1', 64: 'sha256', 128: 'sha512'}
+
+def parse_checksum(value):
+    # "sha256:<hex>", or a bare hex digest whose length picks the algorithm
+    value = value.strip()
+    if ':' in value:
+        algorithm, digest = value.split(':', 1)
+    else:
+        algorithm, digest = DIGEST_LENGTHS.get(len(value)), value
+    algorithm = (algorithm or '').lower().replace('-', '')
+    if algorithm not in hashlib.algorithms_available:
+        raise ValueError(f"Unknown checksum: {value}")
+    return algorithm, digest.lower()
+
+class StreamingDigest:
+    # Whole-file digest built in file order while segments arrive out of order. The
+    # worker writing at the hashed position feeds it directly; anything that landed
+    # ahead of it is read back from the (still cached) output file once it is contiguous.
+    def __init__(self, algorithm, expected):
+        self.algorithm = algorithm
+        self.expected = expected
+        self.hasher = hashlib.new(algorithm)
+        self.pos = 0
+        self.lock = threading.Lock()
+
+    def feed_at(self, offset, data):
+        if offset > self.pos or offset + len(data) <= self.pos:
+            return
+        # Never make a network worker wait on the digest; the supervisor catches up
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            if offset <= self.pos < offset + len(data):
+                view = memoryview(data)[self.pos - offset:]
+                self.hasher.update(view)
+                self.pos += len(view)
+        finally:
+            self.lock.release()
+
+    def catch_up(self, read_at, upto, limit=None):
+        with self.lock:
+            while self.pos < upto:
+                n = min(upto - self.pos, CHUNK)
+                if limit is not None:
+                    if limit <= 0:
+                        return
+                    limit -= n
+                data = read_at(self.pos, n)
+                if not data:
+                    return
+                self.hasher.update(data)
+                self.pos += len(data)
+
+    def matches(self):
+        return self.hasher.hexdigest() == self.expected
+
+class PieceHasher:
+    # Hashes the fixed-size pieces one attempt writes from their first byte to their
+    # last, so a later mismatch can be narrowed down to pieces. Pieces an attempt joins
+    # halfway through are left to whoever started them.
+    def __init__(self, pieces, total_size):
+        self.pieces = pieces
+        self.total_size = total_size
+        self.hasher = None
+        self.index = 0
+        self.pos = -1
+
+    def feed(self, offset, data):
+        view = memoryview(data)
+        while view:
+            if self.hasher is None or offset != self.pos:
+                misaligned = offset % PIECE_SIZE
+                if misaligned:
+                    skip = PIECE_SIZE - misaligned
+                    if skip >= len(view):
+                        self.hasher = None
+                        return
+                    view = view[skip:]
+                    offset += skip
+                self.index = offset // PIECE_SIZE
+                self.hasher = hashlib.md5()
+            piece_end = min((self.index + 1) * PIECE_SIZE, self.total_size)
+            n = min(len(view), piece_end - offset)
+            self.hasher.update(view[:n])
+            view = view[n:]
+            offset += n
+            self.pos = offset
+            if offset == piece_end:
+                self.pieces[self.index] = self.hasher.hexdigest()
+                self.hasher = None
+
+def find_bad_pieces(read_at, pieces, total_size):
+    # Pieces whose bytes on disk no longer match what was received, plus pieces that
+    # were never hashed while streaming and so cannot be vouched for
+    bad = []
+    for index in range((total_size + PIECE_SIZE - 1) // PIECE_SIZE):
+        expected = pieces.get(index)
+        start = index * PIECE_SIZE
+        if expected is None or hashlib.md5(read_at(start, min(PIECE_SIZE, total_size - start))).hexdigest() != expected:
+            bad.append(index)
+    return bad
+
+def piece_ranges(indices, total_size):
+    # Merges piece indices into inclusive (start, end) byte ranges
+    ranges = []
+    for index in sorted(indices):
+        start = index * PIECE_SIZE
+        end = min(start + PIECE_SIZE, total_size) - 1
+        if ranges and ranges[-1][1] + 1 == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
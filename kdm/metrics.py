@@ -0,0 +1,322 @@
+import itertools
+import json
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STALL_SECONDS = 1.0  # A gap this long between reads counts as a stall
+
+class ConnectionStats:
+    # One HTTP request for one range. Written only by the worker that owns it, so the
+    # hot path takes no locks; readers get a slightly stale but consistent-enough view.
+    def __init__(self, host, start, end, retry=False):
+        self.host = host
+        self.start = start
+        self.end = end
+        self.retry = retry
+        self.opened = time.time()
+        self.began = time.perf_counter()
+        self.ttfb = None
+        self.status = None
+        self.bytes = 0
+        self.write_time = 0.0
+        self.throttle_time = 0.0
+        self.stalls = 0
+        self.longest_gap = 0.0
+        self.last_read = None
+        self.duration = None
+        self.result = None  # "ok", "stopped" or "error"; None while running
+        self.error = None
+
+    def response(self, status):
+        self.status = status
+
+    def received(self, n):
+        now = time.perf_counter()
+        if self.ttfb is None:
+            self.ttfb = now - self.began
+        elif self.last_read is not None:
+            gap = now - self.last_read
+            if gap > self.longest_gap:
+                self.longest_gap = gap
+            if gap >= STALL_SECONDS:
+                self.stalls += 1
+        self.bytes += n
+        return now
+
+    def wrote(self, since):
+        self.write_time += time.perf_counter() - since
+
+    def throttled(self, since):
+        # Time asleep in the rate limiter is neither a stall nor network time
+        now = time.perf_counter()
+        self.throttle_time += now - since
+        self.last_read = now
+
+    def finish(self, result, error=None):
+        self.duration = time.perf_counter() - self.began
+        self.result = result
+        self.error = error
+
+    def snapshot(self):
+        duration = self.duration if self.duration is not None else time.perf_counter() - self.began
+        busy = duration - self.throttle_time
+        return {
+            'host': self.host,
+            'range': [self.start, self.end],
+            'opened': self.opened,
+            'status': self.status,
+            'ttfb': self.ttfb,
+            'bytes': self.bytes,
+            'seconds': duration,
+            'throughput': self.bytes / busy if busy > 0 else 0.0,
+            'write_seconds': self.write_time,
+            'throttle_seconds': self.throttle_time,
+            'stalls': self.stalls,
+            'longest_gap': self.longest_gap,
+            'retry': self.retry,
+            'result': self.result,
+            'error': self.error,
+        }
+
+class Totals:
+    # Counters shared by the task and host roll-ups
+    def __init__(self):
+        self.bytes = 0
+        self.connections = 0
+        self.errors = 0
+        self.retries = 0
+        self.stalls = 0
+        self.write_time = 0.0
+        self.ttfb_sum = 0.0
+        self.ttfb_count = 0
+        self.statuses = Counter()
+
+    def add(self, conn):
+        self.bytes += conn.bytes
+        self.connections += 1
+        self.errors += conn.result == 'error'
+        self.retries += conn.retry
+        self.stalls += conn.stalls
+        self.write_time += conn.write_time
+        if conn.ttfb is not None:
+            self.ttfb_sum += conn.ttfb
+            self.ttfb_count += 1
+        if conn.status is not None:
+            self.statuses[conn.status] += 1
+
+    def snapshot(self, active=()):
+        # Running connections are counted as they stand
+        totals = Totals()
+        totals.merge(self)
+        for conn in active:
+            totals.add(conn)
+        return {
+            'bytes': totals.bytes,
+            'connections': totals.connections,
+            'active': len(active),
+            'errors': totals.errors,
+            'retries': totals.retries,
+            'stalls': totals.stalls,
+            'write_seconds': totals.write_time,
+            'ttfb_avg': totals.ttfb_sum / totals.ttfb_count if totals.ttfb_count else None,
+            'ttfb_sum': totals.ttfb_sum,
+            'ttfb_count': totals.ttfb_count,
+            'statuses': {str(k): v for k, v in totals.statuses.items()},
+        }
+
+    def merge(self, other):
+        self.bytes += other.bytes
+        self.connections += other.connections
+        self.errors += other.errors
+        self.retries += other.retries
+        self.stalls += other.stalls
+        self.write_time += other.write_time
+        self.ttfb_sum += other.ttfb_sum
+        self.ttfb_count += other.ttfb_count
+        self.statuses.update(other.statuses)
+
+class TaskMetrics:
+    HISTORY = 240  # Speed samples kept, one per progress tick
+    RECENT = 64  # Finished connections kept in full
+
+    def __init__(self, registry, task, host, number):
+        self.registry = registry
+        self.task = task
+        self.host = host
+        self.number = number  # Stands in for task.id while the task has no history row
+        self.lock = threading.Lock()
+        self.active = set()
+        self.recent = deque(maxlen=self.RECENT)
+        self.totals = Totals()
+        self.history = deque(maxlen=self.HISTORY)
+
+    def open(self, start, end, retry=False, host=None):
+        conn = ConnectionStats(host or self.host, start, end, retry)
+        with self.lock:
+            self.active.add(conn)
+        return conn
+
+    def close(self, conn, result, error=None):
+        conn.finish(result, error)
+        with self.lock:
+            self.active.discard(conn)
+            self.recent.append(conn)
+            self.totals.add(conn)
+        self.registry.closed(conn)
+
+    def sample(self, now, speed, connections):
+        self.history.append((now, speed, connections))
+
+    def snapshot(self):
+        with self.lock:
+            active = list(self.active)
+            recent = list(self.recent)
+            totals = self.totals.snapshot(active)
+        task = self.task
+        mirrors = task.mirror_set
+        return {
+            'id': task.id if task.id is not None else self.number,
+            'url': task.url,
+            'filename': task.filename,
+            'host': self.host,
+            'status': task.status,
+            'size': task.total_size,
+            'downloaded': task.downloaded,
+            'speed': task.speed,
+            'totals': totals,
+            'history': [{'time': t, 'speed': s, 'connections': c} for t, s, c in self.history],
+            'connections': [c.snapshot() for c in active + recent],
+            'mirrors': mirrors.snapshot() if mirrors else [],
+        }
+
+class MetricsRegistry:
+    # Per task and per host telemetry for every download of one downloader
+    MAX_TASKS = 100  # Finished tasks are dropped oldest first past this
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tasks = OrderedDict()
+        self.hosts = {}
+        self.numbers = itertools.count(1)
+
+    def track(self, task, host):
+        with self.lock:
+            metrics = self.tasks.get(task)
+            if metrics is None:
+                metrics = self.tasks[task] = TaskMetrics(self, task, host, next(self.numbers))
+            self.tasks.move_to_end(task)
+            excess = len(self.tasks) - self.MAX_TASKS
+            if excess > 0:
+                # Downloads still queued, running or paused keep their metrics however many there are
+                finished = [t for t in self.tasks if t.cancel or t.status in ("completed", "failed")]
+                for old in finished[:excess]:
+                    del self.tasks[old]
+        return metrics
+
+    def closed(self, conn):
+        with self.lock:
+            self.hosts.setdefault(conn.host, Totals()).add(conn)
+
+    def snapshot(self):
+        with self.lock:
+            tasks = list(self.tasks.values())
+        active = {}
+        for metrics in tasks:
+            with metrics.lock:
+                for conn in metrics.active:
+                    active.setdefault(conn.host, []).append(conn)
+        with self.lock:
+            names = sorted(set(self.hosts) | set(active), key=str)
+            hosts = {host: self.hosts.get(host, Totals()).snapshot(active.get(host, ())) for host in names}
+        return {
+            'time': time.time(),
+            'hosts': hosts,
+            'tasks': [metrics.snapshot() for metrics in tasks],
+        }
+
+    def to_json(self):
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self):
+        return prometheus_text(self.snapshot())
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def prometheus_text(snapshot):
+    # Prometheus text exposition format, version 0.0.4
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            text = ','.join(f'{k}="{_label(v)}"' for k, v in labels.items())
+            lines.append(f"{name}{{{text}}} {value}")
+
+    hosts = snapshot['hosts'].items()
+    family('kdm_host_bytes_total', 'counter', 'Bytes received per host.',
+           [({'host': h}, t['bytes']) for h, t in hosts])
+    family('kdm_host_connections_total', 'counter', 'Range requests made per host.',
+           [({'host': h}, t['connections']) for h, t in hosts])
+    family('kdm_host_connections_active', 'gauge', 'Range requests running per host.',
+           [({'host': h}, t['active']) for h, t in hosts])
+    family('kdm_host_errors_total', 'counter', 'Range requests that failed per host.',
+           [({'host': h}, t['errors']) for h, t in hosts])
+    family('kdm_host_retries_total', 'counter', 'Ranges fetched again after a failure per host.',
+           [({'host': h}, t['retries']) for h, t in hosts])
+    family('kdm_host_stalls_total', 'counter', f'Reads that took {STALL_SECONDS:g}s or longer per host.',
+           [({'host': h}, t['stalls']) for h, t in hosts])
+    family('kdm_host_write_seconds_total', 'counter', 'Time spent writing to disk per host.',
+           [({'host': h}, t['write_seconds']) for h, t in hosts])
+    family('kdm_host_ttfb_seconds_sum', 'counter', 'Sum of times to first byte per host.',
+           [({'host': h}, t['ttfb_sum']) for h, t in hosts])
+    family('kdm_host_ttfb_seconds_count', 'counter', 'Requests that received a first byte per host.',
+           [({'host': h}, t['ttfb_count']) for h, t in hosts])
+    family('kdm_host_responses_total', 'counter', 'HTTP responses per host and status.',
+           [({'host': h, 'status': s}, n) for h, t in hosts for s, n in t['statuses'].items()])
+
+    tasks = snapshot['tasks']
+    family('kdm_task_size_bytes', 'gauge', 'Size of each download.',
+           [({'id': t['id'], 'file': t['filename']}, t['size']) for t in tasks])
+    family('kdm_task_downloaded_bytes', 'gauge', 'Bytes confirmed on disk per download.',
+           [({'id': t['id'], 'file': t['filename']}, t['downloaded']) for t in tasks])
+    family('kdm_task_speed_bytes_per_second', 'gauge', 'Current speed per download.',
+           [({'id': t['id'], 'file': t['filename']}, t['speed']) for t in tasks])
+    family('kdm_task_connections_active', 'gauge', 'Range requests running per download.',
+           [({'id': t['id'], 'file': t['filename']}, t['totals']['active']) for t in tasks])
+    return '\n'.join(lines) + '\n'
+
+class _StatsHandler(BaseHTTPRequestHandler):
+    registry = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/metrics':
+            body = self.registry.to_prometheus().encode()
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif path in ('/stats', '/stats.json'):
+            body = self.registry.to_json().encode()
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def serve_metrics(registry, port=9464, host='127.0.0.1'):
+    # Serves /metrics (Prometheus text) and /stats (JSON) from a daemon thread. Binds to
+    # localhost by default since URLs and file names show up in the output.
+    handler = type('StatsHandler', (_StatsHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,173 @@
+import threading
+import time
+from urllib.parse import urlparse
+
+def parse_sources(parts):
+    # Splits "url [mirror ...] [checksum]" into (url, mirrors, checksum)
+    urls = [part for part in parts if '://' in part]
+    rest = [part for part in parts if '://' not in part]
+    if not urls:
+        return None, [], None
+    return urls[0], urls[1:], rest[0] if rest else None
+
+def same_file(info, other):
+    # Whether a mirror's probe describes the same file as the primary's. Mirrors mint
+    # their own ETags, so only matching ETags prove anything; a Last-Modified both
+    # sides report has to agree.
+    if other.size != info.size or not other.accept_ranges:
+        return False
+    if info.etag and info.etag == other.etag:
+        return True
+    if info.last_modified and other.last_modified:
+        return info.last_modified == other.last_modified
+    return True
+
+class Mirror:
+    # One source of a task's bytes. Workers bound to it count what they receive in their
+    # own [bytes] cell, so the hot path stays lock-free like segment cursors.
+    def __init__(self, url, resolved_url=None, etag=None, last_modified=None):
+        self.url = url
+        self.resolved_url = resolved_url
+        self.etag = etag
+        self.last_modified = last_modified
+        self.rate = None  # Smoothed bytes per second per connection, None until measured
+        self.failures = 0  # Failed requests in a row
+        self.demoted_until = 0.0
+        self.evict = False  # Tells workers on this mirror to hand their range back
+        self.dead = False
+        self.done = 0  # Bytes from workers that have left
+        self.cells = []
+        self.last_bytes = 0
+
+    @property
+    def download_url(self):
+        return self.resolved_url or self.url
+
+    @property
+    def host(self):
+        return urlparse(self.download_url).hostname
+
+    @property
+    def active(self):
+        return len(self.cells)
+
+    def received(self):
+        return self.done + sum(cell[0] for cell in self.cells)
+
+class MirrorSet:
+    # Spreads a task's connections over its mirrors in proportion to their measured
+    # per-connection speed. Mirrors that keep failing, or fall far behind the fastest,
+    # are demoted for a while and their connections move elsewhere.
+    SAMPLE_INTERVAL = 1.0
+    SMOOTHING = 0.5
+    SLOW_RATIO = 0.2  # Demote a mirror slower than this fraction of the fastest
+    DEMOTE_SECONDS = 30.0
+    MAX_FAILURES = 5  # Failures in a row before a mirror is dropped for this run
+
+    def __init__(self, mirrors):
+        self.mirrors = list(mirrors)
+        self.lock = threading.Lock()
+        self.last_sample = None
+
+    def __len__(self):
+        return len(self.mirrors)
+
+    def _usable(self, now):
+        self._restore(now)
+        alive = [m for m in self.mirrors if not m.dead]
+        ready = [m for m in alive if m.demoted_until <= now]
+        # With everything demoted, waiting helps nobody; use whatever is alive
+        return ready or alive
+
+    def _restore(self, now):
+        for m in self.mirrors:
+            if m.evict and not m.dead and m.demoted_until <= now:
+                # Back on probation; its speed is measured afresh
+                m.evict = False
+                m.rate = None
+
+    def candidates(self):
+        # Usable mirrors, the one most short of its share of connections first
+        with self.lock:
+            usable = self._usable(time.monotonic())
+            rates = [m.rate for m in usable if m.rate]
+            # Unmeasured mirrors are assumed average so they get tried
+            default = sum(rates) / len(rates) if rates else 1.0
+            return sorted(usable, key=lambda m: (m.active + 1) / (m.rate or default))
+
+    def enlist(self, mirror):
+        cell = [0]
+        with self.lock:
+            mirror.cells = mirror.cells + [cell]
+        return cell
+
+    def leave(self, mirror, cell):
+        with self.lock:
+            mirror.cells = [c for c in mirror.cells if c is not cell]
+            mirror.done += cell[0]
+
+    def succeeded(self, mirror):
+        mirror.failures = 0
+
+    def failed(self, mirror, delay):
+        # Keeps new connections off the mirror for delay seconds, or for good after
+        # repeated failures. Returns False when no other mirror could take over.
+        with self.lock:
+            mirror.failures += 1
+            others = [m for m in self.mirrors if m is not mirror and not m.dead]
+            if not others:
+                return False
+            if mirror.failures >= self.MAX_FAILURES:
+                mirror.dead = True
+                mirror.evict = True
+            mirror.demoted_until = max(mirror.demoted_until, time.monotonic() + delay)
+            return True
+
+    def drop(self, mirror):
+        # For answers that won't change, like a 404; returns False for the last mirror
+        with self.lock:
+            if not [m for m in self.mirrors if m is not mirror and not m.dead]:
+                return False
+            mirror.dead = True
+            mirror.evict = True
+            return True
+
+    def sample(self, now=None):
+        # Called from the supervisor loop: updates speeds and demotes slow mirrors
+        now = time.monotonic() if now is None else now
+        if self.last_sample is None:
+            self.last_sample = now
+            return
+        elapsed = now - self.last_sample
+        if elapsed < self.SAMPLE_INTERVAL:
+            return
+        self.last_sample = now
+        with self.lock:
+            for m in self.mirrors:
+                received = m.received()
+                if m.active:
+                    rate = (received - m.last_bytes) / elapsed / m.active
+                    m.rate = rate if m.rate is None else m.rate + self.SMOOTHING * (rate - m.rate)
+                m.last_bytes = received
+            self._restore(now)
+
+            live = [m for m in self.mirrors if not m.dead and m.demoted_until <= now and m.rate]
+            if len(live) < 2:
+                return
+            best = max(m.rate for m in live)
+            for m in live:
+                if m.active and m.rate < best * self.SLOW_RATIO:
+                    m.demoted_until = now + self.DEMOTE_SECONDS
+                    m.evict = True
+
+    def snapshot(self):
+        now = time.monotonic()
+        return [{
+            'url': m.url,
+            'rate': m.rate,
+            'connections': m.active,
+            'bytes': m.received(),
+            'failures': m.failures,
+            'demoted': m.demoted_until > now,
+            'dead': m.dead,
+        } for m in self.mirrors]
@@ -0,0 +1,88 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+class FileInfo:
+    # What one probe learned about a URL
+    def __init__(self, url, resolved_url, filename, size, accept_ranges, etag=None, last_modified=None):
+        self.url = url
+        self.resolved_url = resolved_url  # Where the redirect chain ends
+        self.filename = filename
+        self.size = size
+        self.accept_ranges = accept_ranges
+        self.etag = etag
+        self.last_modified = last_modified
+        self.probed = time.time()
+
+def _filename(url, headers):
+    cd = headers.get('content-disposition')
+    filename = None
+    if cd:
+        fname = re.findall('filename="?([^"]+)"?', cd)
+        filename = fname[0] if fname else None
+
+    if not filename:
+        filename = url.split("/")[-1].split("?")[0] or "download"
+
+    return re.sub(r'[\\/*?:"<>|]', '_', filename)
+
+def probe(session, url, timeout=15):
+    # One HEAD, following redirects. Servers that reject HEAD or leave out the size get a
+    # one-byte ranged GET instead, which also answers whether ranges work.
+    try:
+        head = session.head(url, allow_redirects=True, timeout=timeout)
+        if head.status_code < 400 and head.headers.get('content-length'):
+            return FileInfo(url, head.url, _filename(url, head.headers),
+                            int(head.headers['content-length']),
+                            head.headers.get('accept-ranges', 'none') == 'bytes',
+                            head.headers.get('etag'), head.headers.get('last-modified'))
+    except Exception:
+        pass
+
+    response = session.get(url, headers={'Range': 'bytes=0-0'}, stream=True, allow_redirects=True, timeout=timeout)
+    try:
+        response.raise_for_status()
+        headers = response.headers
+        if response.status_code == 206:
+            # Content-Range: bytes 0-0/<size>, with "*" when the size is unknown
+            total = headers.get('content-range', '').rpartition('/')[2]
+            size = int(total) if total.isdigit() else 0
+            accept_ranges = size > 0
+        else:
+            size = int(headers.get('content-length', 0))
+            accept_ranges = False
+        return FileInfo(url, response.url, _filename(url, headers), size, accept_ranges,
+                        headers.get('etag'), headers.get('last-modified'))
+    finally:
+        # Don't read the body of a server that ignored the Range header
+        response.close()
+
+class ProbeCache:
+    # Probe results by URL, so starting, pausing and resuming a download costs no extra
+    # round trips. Entries go stale after MAX_AGE and are probed again.
+    MAX_AGE = 600
+    MAX_ENTRIES = 256
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        with self.lock:
+            info = self.entries.get(url)
+            if info is None or time.time() - info.probed > self.MAX_AGE:
+                return None
+            self.entries.move_to_end(url)
+            return info
+
+    def put(self, info):
+        with self.lock:
+            self.entries[info.url] = info
+            self.entries.move_to_end(info.url)
+            while len(self.entries) > self.MAX_ENTRIES:
+                self.entries.popitem(last=False)
+
+    def forget(self, url):
+        with self.lock:
+            self.entries.pop(url, None)
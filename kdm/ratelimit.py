@@ -0,0 +1,113 @@
+import re
+import threading
+import time
+
+class TokenBucket:
+    # Virtual-time token bucket: a caller reserves its bytes in O(1) under the lock and
+    # is told how long to sleep, so lowering the rate never makes workers spin.
+    BURST_SECONDS = 0.5
+    
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.tat = 0.0  # Time at which everything reserved so far has been "paid for"
+        self.lock = threading.Lock()
+    
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.tat = 0.0
+    
+    def reserve(self, n, now, rate=None):
+        with self.lock:
+            if rate is None:
+                rate = self.rate
+            if rate <= 0:
+                return 0.0
+            self.tat = max(self.tat, now) + n / rate
+            return max(0.0, self.tat - self.BURST_SECONDS - now)
+
+class RateSchedule:
+    # Time-of-day overrides for the global limit, e.g. [("09:00", "18:00", 512000)].
+    # Ranges may wrap past midnight; the first matching entry wins.
+    def __init__(self, entries=()):
+        self.entries = [(self._minutes(start), self._minutes(end), rate) for start, end, rate in entries]
+    
+    def _minutes(self, hhmm):
+        hours, minutes = hhmm.split(':')
+        return int(hours) * 60 + int(minutes)
+    
+    def rate_at(self, when):
+        minute = when.tm_hour * 60 + when.tm_min
+        for start, end, rate in self.entries:
+            if start <= minute < end or (end <= start and (minute >= start or minute < end)):
+                return rate
+        return None
+
+def parse_schedule(value):
+    # "09:00-18:00=512 23:00-07:00=0" (KB/s, comma or space separated) into RateSchedule
+    # entries in bytes per second
+    entries = []
+    for part in value.replace(',', ' ').split():
+        match = re.fullmatch(r'(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(\d+)', part)
+        if not match or int(match[1]) > 23 or int(match[3]) > 24 or int(match[2]) > 59 or int(match[4]) > 59:
+            raise ValueError(f"Bad schedule entry: {part}")
+        entries.append((f"{match[1]}:{match[2]}", f"{match[3]}:{match[4]}", int(match[5]) * 1024))
+    return entries
+
+class BandwidthLimiter:
+    # Global cap shared by every worker plus optional per-task caps (task.rate_limit)
+    def __init__(self, rate=0, schedule=None):
+        self.bucket = TokenBucket(rate)
+        self.schedule = schedule or RateSchedule()
+        self.wakeup = threading.Event()
+        self.scheduled_rate = None
+        self.schedule_checked = 0.0
+    
+    def set_rate(self, rate):
+        self.bucket.set_rate(rate)
+        self._wake()
+    
+    def set_schedule(self, schedule):
+        self.schedule = schedule
+        self.schedule_checked = 0.0
+        self._wake()
+    
+    def set_task_limit(self, task, rate):
+        task.rate_limit = rate
+        if task.bucket is None:
+            task.bucket = TokenBucket(rate)
+        else:
+            task.bucket.set_rate(rate)
+        self._wake()
+    
+    def _wake(self):
+        # Cut short sleeps that were computed under the old limit
+        wakeup, self.wakeup = self.wakeup, threading.Event()
+        wakeup.set()
+    
+    def global_rate(self, now):
+        if now - self.schedule_checked >= 30:
+            self.scheduled_rate = self.schedule.rate_at(time.localtime())
+            self.schedule_checked = now
+        return self.bucket.rate if self.scheduled_rate is None else self.scheduled_rate
+    
+    def reserve(self, task, n):
+        # Seconds the caller should wait before taking n more bytes
+        if not (self.bucket.rate or self.schedule.entries or task.rate_limit):
+            return 0.0
+        now = time.monotonic()
+        delay = self.bucket.reserve(n, now, self.global_rate(now))
+        if task.rate_limit:
+            if task.bucket is None:
+                task.bucket = TokenBucket(task.rate_limit)
+            delay = max(delay, task.bucket.reserve(n, now))
+        return delay
+    
+    def throttle(self, task, n):
+        delay = self.reserve(task, n)
+        # Sleep in short slices so pause and cancel still take effect quickly
+        deadline = time.monotonic() + delay
+        while delay > 0 and not (task.paused or task.cancel):
+            if self.wakeup.wait(min(delay, 0.25)):
+                return
+            delay = deadline - time.monotonic()
@@ -0,0 +1,61 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+# Statuses worth asking again for; any other 4xx fails the download right away
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+def parse_retry_after(value, now=None):
+    # Seconds to wait from a Retry-After header, which holds either seconds or an HTTP date
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+    return max(0.0, when - (time.time() if now is None else now))
+
+class RetryPolicy:
+    # How failed range requests are retried. A request that delivered bytes before it
+    # broke reconnects at once from the last byte; one that got nothing backs off
+    # exponentially with jitter and is charged to the task's retry budget.
+    BASE_DELAY = 0.5
+    MAX_DELAY = 30.0
+    MAX_RETRY_AFTER = 300.0
+    CONNECT_TIMEOUT = 10
+    STALL_TIMEOUT = 15  # Seconds without a byte before the connection is dropped and reopened
+    BUDGET = 32
+
+    def __init__(self, budget=None, stall_timeout=None):
+        self.budget = self.BUDGET if budget is None else budget
+        self.stall_timeout = self.STALL_TIMEOUT if stall_timeout is None else stall_timeout
+
+    @property
+    def timeout(self):
+        # requests applies the read timeout to every socket read, which is what turns a
+        # stalled connection into an exception
+        return (self.CONNECT_TIMEOUT, self.stall_timeout)
+
+    def delay(self, failures, retry_after=None):
+        # "Equal jitter": half the exponential step is fixed, half random, so retries of
+        # many segments spread out without ever collapsing to zero
+        step = min(self.MAX_DELAY, self.BASE_DELAY * 2 ** max(0, failures - 1))
+        delay = step / 2 + random.uniform(0, step / 2)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.MAX_RETRY_AFTER))
+        return delay
+
+class RetryBudget:
+    # Failed requests one run of a task may absorb before it gives up
+    def __init__(self, limit):
+        self.remaining = limit
+        self.lock = threading.Lock()
+
+    def spend(self):
+        with self.lock:
+            self.remaining -= 1
+            return self.remaining >= 0
@@ -0,0 +1,72 @@
+import heapq
+import itertools
+import threading
+
+from .control import ConnectionBudget
+
+class DownloadScheduler:
+    # Priority queue of tasks with a cap on how many run at once; segment workers of
+    # all running tasks draw from the downloader's shared ConnectionBudget. With a
+    # DownloadHistory, every task is recorded when queued and again when its run ends.
+    def __init__(self, downloader, max_active=3, max_connections=128, per_host_connections=64, history=None):
+        self.downloader = downloader
+        self.history = history
+        self.max_active = max_active
+        self.queue = []
+        self.running = set()
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        downloader.set_budget(ConnectionBudget(max_connections, per_host_connections))
+    
+    def submit(self, task, on_progress, on_complete, on_error, priority=0):
+        task.status = "queued"
+        task.paused = False
+        if self.history:
+            self.history.save(task)
+        with self.lock:
+            heapq.heappush(self.queue, (-priority, next(self.counter), task, (on_progress, on_complete, on_error)))
+        self._dispatch()
+    
+    def remove(self, task):
+        with self.lock:
+            self.queue = [entry for entry in self.queue if entry[2] is not task]
+            heapq.heapify(self.queue)
+        # Cancelled downloads leave no trace; finished ones stay in the history
+        if self.history and task.cancel and task.id is not None and task.status != "completed":
+            self.history.remove(task.id)
+    
+    def queued_count(self):
+        with self.lock:
+            return len(self.queue)
+    
+    def _dispatch(self):
+        with self.lock:
+            deferred = []
+            while len(self.running) < self.max_active and self.queue:
+                entry = heapq.heappop(self.queue)
+                task, callbacks = entry[2], entry[3]
+                # Paused or cancelled while waiting; resuming submits it again
+                if task.paused or task.cancel:
+                    continue
+                # Resumed before its previous run wound down; it goes again once that ends
+                if task in self.running:
+                    deferred.append(entry)
+                    continue
+                self.running.add(task)
+                threading.Thread(target=self._run, args=(task, callbacks), daemon=True).start()
+            for entry in deferred:
+                heapq.heappush(self.queue, entry)
+    
+    def _run(self, task, callbacks):
+        try:
+            self.downloader.start_download(task, *callbacks)
+        finally:
+            if self.history:
+                if task.cancel and task.status != "completed":
+                    if task.id is not None:
+                        self.history.remove(task.id)
+                else:
+                    self.history.save(task, segments=True)
+            with self.lock:
+                self.running.discard(task)
+            self._dispatch()
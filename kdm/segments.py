@@ -0,0 +1,195 @@
+import time
+
+from .integrity import PIECE_SIZE
+
+def written_until(segments, start=0):
+    # End of the run of written bytes that begins at start
+    end = start
+    for seg in sorted(list(segments), key=lambda s: s.start):
+        if seg.end < end:
+            continue
+        if seg.start > end or seg.pos <= end:
+            break
+        end = seg.pos
+        if not seg.complete:
+            break
+    return end
+
+class Segment:
+    def __init__(self, start, end, pos=None):
+        self.start = start
+        self.end = end  # Inclusive; shrinks when the tail is handed to another worker
+        self.base = start if pos is None else pos  # Progress of attempts that have ended
+        # One [pos] cell per running attempt, written only by its own worker. The list is
+        # replaced rather than mutated so readers never need a lock.
+        self.cursors = []
+        self.failures = 0  # Attempts that ended in an error
+        self.backoff = 0  # Failures in a row that delivered no bytes
+        self.retry_at = 0.0  # time.monotonic() before which the segment is not handed out
+        self.preempted = False  # Its connections should stop and start again nearer a stream reader
+    
+    @property
+    def pos(self):
+        # First byte not yet written
+        pos = self.base
+        for cursor in self.cursors:
+            if cursor[0] > pos:
+                pos = cursor[0]
+        return min(pos, self.end + 1)
+    
+    @property
+    def workers(self):
+        return len(self.cursors)
+    
+    @property
+    def remaining(self):
+        return max(0, self.end - self.pos + 1)
+    
+    @property
+    def complete(self):
+        return self.pos > self.end
+
+class SegmentScheduler:
+    # Hands out byte ranges to free workers: untouched segments first, then the tail half
+    # of the largest in-flight segment, and at the very end a duplicate of a straggler.
+    # Only handing out and returning segments takes the lock; progress is lock-free.
+    # While a DownloadStream reads the task, ranges just ahead of its read head go first.
+    MIN_PIECE = 262144
+    MAX_HEDGES = 1
+    STREAM_WINDOW = 16777216  # Bytes past the read head that count as near it
+    STREAM_PIECE = 4194304  # Largest range split off next to the read head
+    
+    def __init__(self, task, controller=None):
+        self.task = task
+        self.segments = task.segments
+        self.lock = task.lock
+        self.controller = controller
+        self.not_before = 0.0  # Set when the server asks the whole download to back off
+        for seg in self.segments:
+            seg.base = seg.pos
+            seg.cursors = []
+    
+    def acquire(self):
+        # Returns (segment, cursor) or None when there is nothing left to hand out
+        with self.lock:
+            now = time.monotonic()
+            if now < self.not_before:
+                return None
+            # Segments backing off after a failure are skipped, and not split either
+            ready = [s for s in self.segments if not s.complete and (s.workers or s.retry_at <= now)]
+            head = self.task.read_head
+            if head is not None:
+                attempt = self._near_head(ready, head)
+                if attempt:
+                    return attempt
+            idle = [s for s in ready if s.workers == 0]
+            if idle:
+                return self._attach(max(idle, key=lambda s: s.remaining))
+            
+            active = ready
+            if not active:
+                return None
+            
+            largest = max(active, key=lambda s: s.remaining)
+            if largest.remaining >= 2 * self.MIN_PIECE:
+                mid = largest.pos + largest.remaining // 2
+                # Keep split points on hash piece boundaries while they are far apart
+                if largest.remaining >= 4 * PIECE_SIZE:
+                    mid -= mid % PIECE_SIZE
+                seg = Segment(mid, largest.end)
+                largest.end = mid - 1
+                self.segments.append(seg)
+                return self._attach(seg)
+            
+            # End game: nothing left worth splitting, so race a second connection on a straggler
+            stragglers = [s for s in active if s.workers <= self.MAX_HEDGES]
+            if stragglers:
+                return self._attach(max(stragglers, key=lambda s: s.remaining))
+            return None
+    
+    def _near_head(self, ready, head):
+        # Idle work closest to the reader, else a piece split off right behind the cursor
+        # of the nearest busy segment
+        near = sorted((s for s in ready if s.end >= head and s.pos < head + self.STREAM_WINDOW),
+                      key=lambda s: s.pos)
+        for seg in near:
+            if seg.workers == 0:
+                return self._attach(seg)
+            if seg.remaining >= 2 * self.MIN_PIECE:
+                mid = seg.pos + min(seg.remaining // 2, self.STREAM_PIECE)
+                if seg.remaining >= 4 * PIECE_SIZE:
+                    mid -= mid % PIECE_SIZE
+                piece = Segment(mid, seg.end)
+                seg.end = mid - 1
+                self.segments.append(piece)
+                return self._attach(piece)
+        return None
+    
+    def steer(self):
+        # Called on each progress tick. While the stream reader is waiting and there is work
+        # near it to hand out, the connection furthest ahead stops and takes that instead.
+        if self.task.read_head is None or not self.task.read_waiting:
+            return
+        with self.lock:
+            head = self.task.read_head
+            window = head + self.STREAM_WINDOW
+            now = time.monotonic()
+            waiting = any(s.end >= head and s.pos < window and not s.complete
+                          and (s.workers == 0 and s.retry_at <= now or s.remaining >= 2 * self.MIN_PIECE)
+                          for s in self.segments)
+            far = [s for s in self.segments
+                   if s.workers and not s.complete and not s.preempted and s.pos >= window]
+            if waiting and far:
+                max(far, key=lambda s: s.pos).preempted = True
+    
+    def _attach(self, seg):
+        cursor = [seg.pos]
+        seg.cursors = seg.cursors + [cursor]
+        return seg, cursor
+    
+    def hold(self, delay):
+        with self.lock:
+            self.not_before = max(self.not_before, time.monotonic() + delay)
+    
+    def next_retry(self):
+        # Seconds until a segment that is backing off can be tried again, or None when
+        # nothing is waiting for a retry
+        with self.lock:
+            waiting = [s.retry_at for s in self.segments
+                       if not s.complete and s.workers == 0 and s.retry_at]
+            if not waiting:
+                return None
+            return max(0.0, min(waiting) - time.monotonic(), self.not_before - time.monotonic())
+    
+    def spare(self):
+        # Roughly how many more workers acquire() can keep busy, now or once a backoff runs
+        # out, so the supervisor doesn't start workers that would find nothing and exit
+        with self.lock:
+            n = 0
+            for s in self.segments:
+                if s.complete:
+                    continue
+                if s.workers == 0:
+                    n += max(1, s.remaining // self.MIN_PIECE)
+                elif s.remaining >= 2 * self.MIN_PIECE:
+                    n += s.remaining // self.MIN_PIECE - 1
+                else:
+                    n += max(0, self.MAX_HEDGES + 1 - s.workers)
+            return n
+    
+    def release(self, seg, cursor):
+        with self.lock:
+            seg.base = max(seg.base, min(cursor[0], seg.end + 1))
+            seg.cursors = [c for c in seg.cursors if c is not cursor]
+            if not seg.cursors:
+                seg.preempted = False
+    
+    def confirmed(self):
+        return sum(s.pos - s.start for s in list(self.segments))
+    
+    def contiguous(self):
+        # End of the prefix of the file that has been written without gaps
+        return written_until(self.segments)
+    
+    def finished(self):
+        return all(s.complete for s in list(self.segments))
@@ -0,0 +1,172 @@
+import os
+import errno
+import json
+import threading
+import time
+
+from .segments import Segment
+
+class OutputFile:
+    # Single preallocated output file that segment workers write into at their own offsets
+    def __init__(self, path, size, truncate=False):
+        self.path = path
+        self.size = size
+        self.lock = threading.Lock()
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        if truncate:
+            flags |= os.O_TRUNC
+        self.fd = os.open(path, flags, 0o644)
+        try:
+            self.preallocate()
+        except OSError:
+            os.close(self.fd)
+            raise
+    
+    def preallocate(self):
+        if os.fstat(self.fd).st_size == self.size:
+            return
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.fd, 0, self.size)
+                return
+            except OSError as e:
+                # Out of space is a real error; anything else means the filesystem can't fallocate
+                if e.errno == errno.ENOSPC:
+                    raise
+        # Sparse file fallback
+        os.ftruncate(self.fd, self.size)
+    
+    def write_at(self, offset, data):
+        view = memoryview(data)
+        if hasattr(os, 'pwrite'):
+            while view:
+                written = os.pwrite(self.fd, view, offset)
+                view = view[written:]
+                offset += written
+        else:
+            with self.lock:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                while view:
+                    written = os.write(self.fd, view)
+                    view = view[written:]
+    
+    def write_many(self, offset, buffers):
+        # Writes buffers back to back from offset, with one syscall where pwritev exists
+        if not hasattr(os, 'pwritev'):
+            for data in buffers:
+                self.write_at(offset, data)
+                offset += len(data)
+            return
+        views = [memoryview(data) for data in buffers]
+        while views:
+            written = os.pwritev(self.fd, views, offset)
+            offset += written
+            while views and written >= len(views[0]):
+                written -= len(views[0])
+                views.pop(0)
+            if views and written:
+                views[0] = views[0][written:]
+    
+    def read_at(self, offset, size):
+        if hasattr(os, 'pread'):
+            return os.pread(self.fd, size, offset)
+        with self.lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, size)
+    
+    def sync(self):
+        if self.fd is not None:
+            os.fsync(self.fd)
+    
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+    
+    def finalize(self, target):
+        self.close()
+        os.replace(self.path, target)
+
+class ResumeJournal:
+    # Sidecar manifest next to the .kdm file. Data is fsynced before the manifest is
+    # replaced, so every byte it claims is on disk after a crash.
+    SYNC_INTERVAL = 2.0
+    VERSION = 1
+    
+    def __init__(self, task):
+        self.task = task
+        self.path = f"{task.filename}.kdm.json"
+        self.last_sync = 0.0
+    
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state.get('version') != self.VERSION:
+            return None
+        return state
+    
+    def restore(self, state):
+        # Returns the segments that are still trustworthy, or None to start over
+        task = self.task
+        if not state or state.get('total_size') != task.total_size:
+            return None
+        if not validators_match(state.get('etag'), state.get('last_modified'), task.etag, task.last_modified):
+            return None
+        try:
+            on_disk = os.path.getsize(task.temp_filename)
+        except OSError:
+            return None
+        
+        segments = []
+        for start, end, pos in state.get('segments', []):
+            if start < 0 or end >= task.total_size or not start <= pos <= end + 1:
+                return None
+            # A truncated temp file only invalidates the bytes it no longer holds
+            segments.append(Segment(start, end, max(start, min(pos, on_disk))))
+        if segments and task.checksum:
+            task.piece_hashes = {int(index): digest for index, digest in state.get('pieces', {}).items()}
+        return segments or None
+    
+    def save(self, output):
+        task = self.task
+        with task.lock:
+            segments = [[s.start, s.end, s.pos] for s in task.segments]
+        # Flush the data first so the manifest never claims bytes that could be lost
+        output.sync()
+        state = {
+            'version': self.VERSION,
+            'url': task.url,
+            'resolved_url': task.resolved_url,
+            'total_size': task.total_size,
+            'etag': task.etag,
+            'last_modified': task.last_modified,
+            'segments': segments,
+            'pieces': dict(task.piece_hashes),
+        }
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self.last_sync = time.time()
+    
+    def maybe_save(self, output):
+        if time.time() - self.last_sync >= self.SYNC_INTERVAL:
+            self.save(output)
+    
+    def remove(self):
+        for path in (self.path, f"{self.path}.tmp"):
+            if os.path.exists(path):
+                os.remove(path)
+
+def validators_match(etag, last_modified, other_etag, other_last_modified):
+    # Only a validator both sides know about can prove the file changed
+    if etag and other_etag:
+        return etag == other_etag
+    if last_modified and other_last_modified:
+        return last_modified == other_last_modified
+    return True
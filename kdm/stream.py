@@ -0,0 +1,97 @@
+import io
+import os
+import time
+
+from .segments import written_until
+
+class DownloadStream(io.RawIOBase):
+    # File-like view of a download that returns bytes in file order as soon as they are
+    # on disk, while later ranges are still being fetched. While it is open the segment
+    # scheduler hands out ranges near its position first. read() blocks until bytes are
+    # there (also across a pause), returns b'' at the end of the file and raises OSError
+    # once the download fails or is cancelled. Downloads without range support only
+    # become readable when they finish.
+    POLL = 0.05
+
+    def __init__(self, task, timeout=None):
+        super().__init__()
+        self.task = task
+        self.timeout = timeout  # Seconds a read may wait for new bytes, None for no limit
+        self.pos = 0
+        self.file = None
+        task.read_head = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            if not self.task.total_size:
+                raise io.UnsupportedOperation("Size of the download is not known")
+            offset += self.task.total_size
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self.pos = offset
+        self.task.read_head = offset
+        return offset
+
+    def _available(self):
+        # (bytes readable at pos, file holding them)
+        task = self.task
+        if task.status == "completed":
+            size = task.total_size or os.path.getsize(task.filename)
+            return size - self.pos, task.filename
+        if task.segments:
+            return written_until(task.segments, self.pos) - self.pos, task.temp_filename
+        return 0, None
+
+    def readinto(self, b):
+        task = self.task
+        deadline = time.monotonic() + self.timeout if self.timeout is not None else None
+        while True:
+            if task.cancel:
+                raise OSError("Download cancelled")
+            available, path = self._available()
+            if available > 0:
+                break
+            if task.status == "completed":
+                return 0
+            if task.status == "failed":
+                raise OSError(task.failure or "Download failed")
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError(f"No data at offset {self.pos} for {self.timeout}s")
+            task.read_waiting = True
+            time.sleep(self.POLL)
+        task.read_waiting = False
+        if self.file is None:
+            # Stays valid when the finished file is renamed into place
+            self.file = open(path, 'rb', buffering=0)
+        self.file.seek(self.pos)
+        n = self.file.readinto(memoryview(b)[:min(available, len(b))])
+        self.pos += n
+        task.read_head = self.pos
+        return n
+
+    def chunks(self, size=1048576):
+        # Iterates over the rest of the file in pieces of at most size bytes
+        while True:
+            data = self.read(size)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        if not self.closed:
+            self.task.read_head = None
+            self.task.read_waiting = False
+            if self.file is not None:
+                self.file.close()
+        super().close()
@@ -0,0 +1,59 @@
+import threading
+
+from .integrity import parse_checksum
+from .stream import DownloadStream
+
+class DownloadTask:
+    def __init__(self, url, filename, total_size=0, ui_item=None):
+        self.id = None  # Row in DownloadHistory, once recorded
+        self.url = url
+        self.resolved_url = None  # End of the redirect chain, when it differs from url
+        self.mirrors = []  # Other URLs serving the same file
+        self.mirror_set = None  # MirrorSet of the current run, when mirrors agreed with url
+        self.filename = filename
+        self.total_size = total_size
+        self.downloaded = 0
+        self.status = "pending"
+        self.paused = False
+        self.cancel = False
+        self.segments = []
+        self.etag = None
+        self.last_modified = None
+        self.invalidated = False
+        self.speed = 0.0
+        self.rate_limit = 0  # Bytes per second, 0 for no per-task cap
+        self.bucket = None
+        self.checksum = None  # (algorithm, hex digest) to verify against, see set_checksum
+        self.digest = None
+        self.piece_hashes = {}
+        self.repairs = 0
+        self.failure = None  # Error that ends the current run, set by a segment worker
+        self.retry_budget = None
+        self.metrics = None  # TaskMetrics, attached by the downloader
+        self.read_head = None  # Position of an open DownloadStream
+        self.read_waiting = False  # The stream is blocked on bytes not written yet
+        self.extract_to = None  # Directory to unpack the archive into while it downloads
+        self.keep_archive = True  # False deletes the archive once it is unpacked
+        self.extractor = None
+        self.delta_source = None  # Older copy of the file to take unchanged blocks from
+        self.delta_index = None  # Path or URL of the new file's block index, default url + ".kdmsync"
+        self.reused = 0  # Bytes taken from delta_source instead of the network
+        self.lock = threading.Lock()
+        self.start_time = 0.0
+        self.ui_item = ui_item  # Reference to the Kivy Widget
+    
+    @property
+    def download_url(self):
+        return self.resolved_url or self.url
+    
+    @property
+    def temp_filename(self):
+        return f"{self.filename}.kdm"
+    
+    def set_checksum(self, value):
+        # Accepts "sha256:<hex>" or a bare md5/sha1/sha256/sha512 hex digest
+        self.checksum = parse_checksum(value) if value else None
+    
+    def open_stream(self, timeout=None):
+        # Reads the file in order while it downloads; one stream per task at a time
+        return DownloadStream(self, timeout)
@@ -0,0 +1,132 @@
+import queue
+import threading
+import time
+
+class WriteTicket:
+    # Writes of one connection that are still queued. Each file is written by a single
+    # writer thread in submission order, so the cursor only ever advances over bytes
+    # that are on disk and the resume journal can trust it as before.
+    def __init__(self, cursor, pool):
+        self.cursor = cursor
+        self.pool = pool
+        self.pending = 0
+        self.error = None
+        self.cond = threading.Condition()
+
+    def add(self):
+        with self.cond:
+            self.pending += 1
+
+    def done(self, end, buf, error=None):
+        self.pool.release(buf)
+        with self.cond:
+            if error is not None:
+                self.error = self.error or error
+            elif self.error is None:
+                self.cursor[0] = end
+            self.pending -= 1
+            self.cond.notify_all()
+
+    def wait(self):
+        # Returns the first write error, if any
+        with self.cond:
+            while self.pending:
+                self.cond.wait()
+            return self.error
+
+class WriterStage:
+    # Writer threads between the network workers and the disk. Workers hand over filled
+    # buffers through a bounded queue and go back to reading; when the disk falls behind
+    # the queue fills up and they wait in submit(). Each pass a writer takes everything
+    # queued, sorts it by offset and writes adjacent buffers with one pwritev.
+    DEPTH = 32
+    MAX_BATCH = 64
+
+    def __init__(self, threads=1, depth=None):
+        self.queues = [queue.Queue(maxsize=depth or self.DEPTH) for _ in range(max(1, threads))]
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.writes = 0  # pwritev calls
+        self.buffers = 0
+        self.busy_time = 0.0
+        self.idle_time = 0.0
+        self.blocked_time = 0.0  # Time network workers waited for room in a queue
+        for q in self.queues:
+            threading.Thread(target=self._run, args=(q,), daemon=True).start()
+
+    def submit(self, output, offset, data, buf, ticket):
+        # Queues data (a view into buf) for output at offset; buf goes back to its pool
+        # once written. Returns the seconds spent waiting for room.
+        ticket.add()
+        q = self.queues[hash(output.path) % len(self.queues)]
+        item = (output, offset, data, buf, ticket)
+        try:
+            q.put_nowait(item)
+            return 0.0
+        except queue.Full:
+            pass
+        began = time.perf_counter()
+        q.put(item)
+        blocked = time.perf_counter() - began
+        with self.lock:
+            self.blocked_time += blocked
+        return blocked
+
+    def _run(self, q):
+        while True:
+            began = time.perf_counter()
+            batch = [q.get()]
+            waited = time.perf_counter() - began
+            while len(batch) < self.MAX_BATCH:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            began = time.perf_counter()
+            writes = 0
+            batch.sort(key=lambda item: (id(item[0]), item[1]))
+            run = [batch[0]]
+            for item in batch[1:]:
+                last = run[-1]
+                if item[0] is last[0] and item[1] == last[1] + len(last[2]):
+                    run.append(item)
+                else:
+                    self._write(run)
+                    writes += 1
+                    run = [item]
+            self._write(run)
+            writes += 1
+            with self.lock:
+                self.busy_time += time.perf_counter() - began
+                self.idle_time += waited
+                self.writes += writes
+                self.buffers += len(batch)
+
+    def _write(self, run):
+        output, offset = run[0][0], run[0][1]
+        error = None
+        try:
+            output.write_many(offset, [item[2] for item in run])
+        except Exception as e:
+            error = e
+        else:
+            with self.lock:
+                self.bytes += sum(len(item[2]) for item in run)
+        for _, start, data, buf, ticket in run:
+            ticket.done(start + len(data), buf, error)
+
+    def queued(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'threads': len(self.queues),
+                'queued': self.queued(),
+                'bytes': self.bytes,
+                'buffers': self.buffers,
+                'writes': self.writes,
+                'busy_seconds': self.busy_time,
+                'idle_seconds': self.idle_time,
+                'blocked_seconds': self.blocked_time,
+            }
@@ -1,18 +1,18 @@
 import threading
 import os
-import time
-import hashlib
-import re
-import requests
-from requests.adapters import HTTPAdapter
-from concurrent.futures import ThreadPoolExecutor
+
+from kdm import DaemonClient, DaemonError, DownloadDaemon
+from kdm.daemon import connect
+from kdm.mirrors import parse_sources
+from kdm.ratelimit import parse_schedule
 
 from kivy.lang import Builder
 from kivy.core.window import Window
-from kivy.properties import StringProperty, NumericProperty, BooleanProperty, ObjectProperty
+from kivy.properties import StringProperty, NumericProperty, BooleanProperty, ObjectProperty, ListProperty
 from kivy.clock import Clock
 from kivy.metrics import dp
 from kivy.utils import platform
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
 
 from kivymd.app import MDApp
 from kivymd.uix.screen import MDScreen
@@ -24,252 +24,6 @@ from kivymd.uix.label import MDLabel
 from kivymd.uix.progressbar import MDProgressBar
 from kivymd.uix.snackbar import Snackbar
 
-# --- Downloader Logic (Adapted for Kivy) ---
-
-session = requests.Session()
-adapter = HTTPAdapter(pool_connections=100, pool_maxsize=100)
-session.mount('http://', adapter)
-session.mount('https://', adapter)
-
-class DownloadTask:
-    def __init__(self, url, filename, total_size=0, ui_item=None):
-        self.url = url
-        self.filename = filename
-        self.total_size = total_size
-        self.downloaded = 0
-        self.status = "pending"
-        self.paused = False
-        self.cancel = False
-        self.chunks_done = set()
-        self.lock = threading.Lock()
-        self.start_time = 0.0
-        self.ui_item = ui_item  # Reference to the Kivy Widget
-
-class MultiThreadDownloader:
-    def __init__(self, num_threads=64):
-        self.num_threads = num_threads
-        self.active_downloads = {}
-    
-    def get_url_hash(self, url):
-        return hashlib.md5(url.encode()).hexdigest()[:12]
-    
-    def get_file_info(self, url):
-        try:
-            head = session.head(url, allow_redirects=True, timeout=15)
-            total_size = int(head.headers.get('content-length', 0))
-            accept_ranges = head.headers.get('accept-ranges', 'none') == 'bytes'
-            
-            cd = head.headers.get('content-disposition')
-            filename = None
-            if cd:
-                fname = re.findall('filename="?([^"]+)"?', cd)
-                filename = fname[0] if fname else None
-            
-            if not filename:
-                filename = url.split("/")[-1].split("?")[0] or "download"
-            
-            filename = re.sub(r'[\\/*?:"<>|]', '_', filename)
-            return filename, total_size, accept_ranges
-        except Exception:
-            return None, 0, False
-
-    def download_chunk(self, task, chunk_id, start, end):
-        chunk_file = f"{task.filename}.part{chunk_id}"
-        expected_size = end - start + 1
-        current_size = 0
-        
-        if os.path.exists(chunk_file):
-            current_size = os.path.getsize(chunk_file)
-            if current_size >= expected_size:
-                return current_size
-            start += current_size
-        
-        headers = {'Range': f'bytes={start}-{end}'}
-        try:
-            CHUNK_SIZE = 524288
-            response = session.get(task.url, headers=headers, stream=True, timeout=60)
-            if response.status_code not in [200, 206]:
-                return current_size
-            
-            mode = 'ab' if current_size > 0 else 'wb'
-            with open(chunk_file, mode, buffering=CHUNK_SIZE) as f:
-                for data in response.iter_content(chunk_size=CHUNK_SIZE):
-                    if task.paused or task.cancel:
-                        f.flush()
-                        return current_size
-                    if data:
-                        f.write(data)
-                        data_len = len(data)
-                        current_size += data_len
-                        with task.lock:
-                            task.downloaded += data_len
-                f.flush()
-            return current_size
-        except Exception:
-            return current_size
-
-    def merge_chunks(self, task, num_chunks, expected_sizes):
-        temp_filename = f"{task.filename}.tmp"
-        try:
-            with open(temp_filename, 'wb', buffering=1048576) as outfile:
-                for i in range(num_chunks):
-                    chunk_file = f"{task.filename}.part{i}"
-                    if os.path.exists(chunk_file):
-                        with open(chunk_file, 'rb', buffering=1048576) as infile:
-                            expected = expected_sizes.get(i, 0)
-                            bytes_read = 0
-                            while bytes_read < expected:
-                                to_read = min(1048576, expected - bytes_read)
-                                data = infile.read(to_read)
-                                if not data: break
-                                outfile.write(data)
-                                bytes_read += len(data)
-                outfile.flush()
-            
-            if os.path.exists(task.filename):
-                try:
-                    os.remove(task.filename)
-                except OSError:
-                    pass
-            os.rename(temp_filename, task.filename)
-            
-            for i in range(num_chunks):
-                chunk_file = f"{task.filename}.part{i}"
-                if os.path.exists(chunk_file):
-                    os.remove(chunk_file)
-        except Exception as e:
-            if os.path.exists(temp_filename):
-                os.remove(temp_filename)
-            raise e
-
-    def start_download(self, task, on_progress, on_complete, on_error):
-        task.status = "downloading"
-        task.paused = False
-        
-        try:
-            test = session.head(task.url, allow_redirects=True, timeout=10)
-            supports_range = test.headers.get('accept-ranges', 'none') == 'bytes'
-        except:
-            supports_range = False
-        
-        if task.total_size > 102400 and supports_range:
-            self._multi_thread_download(task, on_progress, on_complete, on_error)
-        else:
-            self._single_thread_download(task, on_progress, on_complete, on_error)
-
-    def _multi_thread_download(self, task, on_progress, on_complete, on_error):
-        chunk_size = task.total_size // self.num_threads
-        chunks = []
-        chunk_expected_sizes = {}
-        
-        for i in range(self.num_threads):
-            start = i * chunk_size
-            end = start + chunk_size - 1 if i < self.num_threads - 1 else task.total_size - 1
-            chunks.append((i, start, end))
-            chunk_expected_sizes[i] = end - start + 1
-        
-        task.downloaded = 0
-        for i, start, end in chunks:
-            chunk_file = f"{task.filename}.part{i}"
-            if os.path.exists(chunk_file):
-                task.downloaded += os.path.getsize(chunk_file)
-        
-        last_update = time.time()
-        last_downloaded = task.downloaded
-        
-        try:
-            with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
-                futures = {
-                    executor.submit(self.download_chunk, task, i, start, end): (i, start, end)
-                    for i, start, end in chunks
-                }
-                
-                while futures:
-                    if task.cancel:
-                        for f in futures: f.cancel()
-                        return
-                    if task.paused:
-                        time.sleep(0.1)
-                        continue
-                    
-                    current_time = time.time()
-                    if current_time - last_update >= 0.25:
-                        elapsed = current_time - last_update
-                        speed = (task.downloaded - last_downloaded) / elapsed if elapsed > 0 else 0
-                        on_progress(task, speed)
-                        last_update = current_time
-                        last_downloaded = task.downloaded
-                    
-                    done = [f for f in futures if f.done()]
-                    for f in done:
-                        chunk_info = futures.pop(f)
-                        chunk_id = chunk_info[0]
-                        task.chunks_done.add(chunk_id)
-                    
-                    if not done:
-                        time.sleep(0.05)
-            
-            if task.paused or task.cancel:
-                return
-            
-            all_complete = True
-            for i, start, end in chunks:
-                chunk_file = f"{task.filename}.part{i}"
-                if not os.path.exists(chunk_file) or os.path.getsize(chunk_file) < chunk_expected_sizes[i]:
-                    all_complete = False
-                    break
-            
-            if not all_complete:
-                on_error(task, "Incomplete chunks")
-                return
-            
-            task.status = "merging"
-            on_progress(task, 0)
-            self.merge_chunks(task, self.num_threads, chunk_expected_sizes)
-            
-            task.status = "completed"
-            on_complete(task)
-            
-        except Exception as e:
-            on_error(task, str(e))
-
-    def _single_thread_download(self, task, on_progress, on_complete, on_error):
-        headers = {}
-        file_size = 0
-        if os.path.exists(task.filename):
-            file_size = os.path.getsize(task.filename)
-            headers['Range'] = f'bytes={file_size}-'
-            task.downloaded = file_size
-        
-        last_update = time.time()
-        last_downloaded = task.downloaded
-        
-        try:
-            response = session.get(task.url, headers=headers, stream=True, timeout=30)
-            if task.total_size == 0:
-                task.total_size = int(response.headers.get('content-length', 0)) + file_size
-            
-            mode = 'ab' if file_size else 'wb'
-            with open(task.filename, mode, buffering=1048576) as f:
-                for chunk in response.iter_content(chunk_size=1048576):
-                    if task.paused or task.cancel: return
-                    if chunk:
-                        f.write(chunk)
-                        task.downloaded += len(chunk)
-                        current_time = time.time()
-                        if current_time - last_update >= 0.25:
-                            speed = (task.downloaded - last_downloaded) / (current_time - last_update)
-                            on_progress(task, speed)
-                            last_update = current_time
-                            last_downloaded = task.downloaded
-            
-            if not task.paused and not task.cancel:
-                task.status = "completed"
-                on_complete(task)
-        except Exception as e:
-            task.status = "failed"
-            on_error(task, str(e))
-
 # --- Kivy UI Components ---
 
 KV = '''
@@ -281,7 +35,7 @@ KV = '''
     spacing: "8dp"
     elevation: 3
     radius: [12,]
-    md_bg_color: 1, 1, 1, 1
+    md_bg_color: root.bg_color
     shadow_offset: 0, 2
     shadow_radius: 8
 
@@ -428,7 +182,7 @@ MDScreen:
                             id: url_field
                             hint_text: "Paste download URL here..."
                             mode: "rectangle"
-                            size_hint_x: 0.6
+                            size_hint_x: 0.45
                             size_hint_y: None
                             height: "56dp"
                             line_color_focus: 0.1, 0.4, 0.8, 1
@@ -436,15 +190,24 @@ MDScreen:
                         MDTextField:
                             id: thread_field
                             hint_text: "Threads"
-                            text: "64"
+                            text: "auto"
                             mode: "rectangle"
-                            size_hint_x: 0.2
+                            size_hint_x: 0.15
                             size_hint_y: None
                             height: "56dp"
-                            input_filter: "int"
                             on_text_validate: app.set_threads(self.text)
                             line_color_focus: 0.1, 0.4, 0.8, 1
 
+                        MDTextField:
+                            id: limit_field
+                            hint_text: "Limit KB/s, 09:00-18:00=512"
+                            mode: "rectangle"
+                            size_hint_x: 0.15
+                            size_hint_y: None
+                            height: "56dp"
+                            on_text_validate: app.set_speed_limit(self.text)
+                            line_color_focus: 0.1, 0.4, 0.8, 1
+
                         MDRaisedButton:
                             text: "START"
                             size_hint_x: 0.1
@@ -478,74 +241,89 @@ MDScreen:
                 md_bg_color: 0.99, 0.99, 0.99, 1
                 padding: "8dp"
 
-                ScrollView:
-                    MDBoxLayout:
-                        id: download_list
+                orientation: "vertical"
+
+                MDLabel:
+                    text: "No downloads yet"
+                    halign: "center"
+                    font_style: "Body1"
+                    theme_text_color: "Hint"
+                    size_hint_y: None
+                    height: 0 if download_list.data else dp(100)
+                    opacity: 0 if download_list.data else 1
+
+                # Only the rows in view exist as widgets; they are reused while scrolling
+                RecycleView:
+                    id: download_list
+                    viewclass: "DownloadItemCard"
+
+                    RecycleBoxLayout:
                         orientation: "vertical"
                         spacing: "12dp"
                         padding: "8dp"
+                        default_size: None, dp(140)
+                        default_size_hint: 1, None
                         size_hint_y: None
                         height: self.minimum_height
-
-                        MDLabel:
-                            text: "No downloads yet"
-                            halign: "center"
-                            font_style: "Body1"
-                            theme_text_color: "Hint"
-                            size_hint_y: None
-                            height: "100dp"
 '''
 
-class DownloadItemCard(MDCard):
+class DownloadItemCard(RecycleDataViewBehavior, MDCard):
+    # One visible row; RecycleView sets these from the row's entry in app.rows
+    task_id = NumericProperty(0)
     filename = StringProperty("")
     progress_text = StringProperty("Starting...")
     speed_text = StringProperty("")
     eta_text = StringProperty("")
     progress_value = NumericProperty(0)
     pause_icon = StringProperty("pause-circle")
+    bg_color = ListProperty([1, 1, 1, 1])
     
-    def __init__(self, task, **kwargs):
+    def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.task = task
         self.app = MDApp.get_running_app()
     
     def toggle_pause(self):
-        if self.task.status == "completed": return
+        task = self.app.tasks.get(self.task_id)
+        if not task or task["status"] == "completed": return
         
-        if self.task.paused:
+        if task["paused"]:
             # Resume
-            self.task.paused = False
-            self.pause_icon = "pause-circle"
-            threading.Thread(
-                target=self.app.downloader.start_download,
-                args=(self.task, self.app.on_progress, self.app.on_complete, self.app.on_error),
-                daemon=True
-            ).start()
+            task["paused"] = False
+            self.app.set_row(self.task_id, pause_icon="pause-circle", progress_text="Queued")
+            self.app.send("resume", self.task_id)
         else:
             # Pause
-            self.task.paused = True
-            self.task.status = "paused"
-            self.pause_icon = "play-circle"
-            self.progress_text = "Paused"
+            task["paused"] = True
+            self.app.set_row(self.task_id, pause_icon="play-circle", progress_text="Paused")
+            self.app.send("pause", self.task_id)
 
     def cancel_download(self):
-        self.task.cancel = True
-        self.task.paused = True
-        if self.task.status != "completed":
+        task = self.app.tasks.pop(self.task_id, None)
+        self.app.send("cancel", self.task_id)
+        if task and task["status"] not in ("completed", "failed"):
             self.app.stats["active"] -= 1
             self.app.stats["failed"] += 1
         
-        url_hash = self.app.downloader.get_url_hash(self.task.url)
-        if url_hash in self.app.downloader.active_downloads:
-            del self.app.downloader.active_downloads[url_hash]
-        
-        self.parent.remove_widget(self)
+        self.app.remove_row(self.task_id)
         self.app.update_stats()
 
 class DownloadManagerApp(MDApp):
     def build(self):
-        self.downloader = MultiThreadDownloader(num_threads=64)
-        self.stats = {"total": 0, "completed": 0, "failed": 0, "active": 0}
+        # The engine runs in a daemon process of its own and keeps going when the window
+        # closes; this app only sends commands and draws the progress batches it gets back
+        self.client = self._connect()
+        self.threads = 0  # 0 lets the engine tune the connection count per host
+        self.limit = 0
+        self.schedule = []
+        counts = self.client.counts()
+        completed, failed = counts.get("completed", 0), counts.get("failed", 0)
+        self.stats = {"total": completed + failed, "completed": completed, "failed": failed, "active": 0}
+        # Latest snapshot of every listed task by id
+        self.tasks = {}
+        # Row data of every listed task, newest first, shared with the RecycleView; rows
+        # out of view only change here
+        self.rows = {}
+        self.refresh_rows = Clock.create_trigger(self._refresh_rows)
         
         # Set android permissions if needed
         if platform == 'android':
@@ -554,21 +332,85 @@ class DownloadManagerApp(MDApp):
         
         return Builder.load_string(KV)
 
+    def _connect(self):
+        if platform == 'android':
+            # Apps can't start processes of their own there; the daemon runs on a thread
+            # (phone flash copes badly with many interleaved writers)
+            daemon = DownloadDaemon({'writers': 1}, self.user_data_dir)
+            threading.Thread(target=daemon.serve_forever, daemon=True).start()
+            return DaemonClient(daemon.port, daemon.token, self.on_event)
+        return connect(self.user_data_dir, self.on_event, spawn=True)
+
+    def on_start(self):
+        # Unfinished downloads were queued again by the daemon when it started
+        for task in sorted(self.client.subscribe(), key=lambda task: task["id"]):
+            self._add_ui_item(task)
+
+    def on_stop(self):
+        self.client.close()
+
+    def send(self, cmd, *args, **kwargs):
+        # Daemon calls run off the UI thread; errors show up as a snackbar
+        threading.Thread(target=self._send, args=(cmd, args, kwargs), daemon=True).start()
+
+    def _send(self, cmd, args, kwargs):
+        try:
+            result = getattr(self.client, cmd)(*args, **kwargs)
+        except DaemonError as e:
+            Clock.schedule_once(lambda dt: Snackbar(text=str(e)).open())
+            return
+        if cmd in ("add", "bulk"):
+            Clock.schedule_once(lambda dt: self._add_ui_item(result))
+
     def set_threads(self, value):
+        # "auto" (or 0) lets the downloader tune the connection count per host
+        value = value.strip().lower()
+        if value in ("auto", "", "0"):
+            threads = 0
+        else:
+            try:
+                threads = max(1, min(256, int(value)))
+            except ValueError:
+                self.root.ids.thread_field.text = self.threads_text()
+                return
+        if threads != self.threads:
+            self.threads = threads
+            self.send("configure", threads)
+        self.root.ids.thread_field.text = self.threads_text()
+
+    def set_speed_limit(self, value):
+        # Applies to running downloads immediately; empty or 0 removes the cap. A plain
+        # number is the cap in KB/s; time windows such as 09:00-18:00=512 override it.
+        words = (value or "").replace(',', ' ').split()
+        kbps = int(words.pop(0)) if words and words[0].isdigit() else 0
         try:
-            threads = int(value)
-            threads = max(1, min(256, threads))
-            self.downloader.num_threads = threads
-            self.root.ids.thread_field.text = str(threads)
-        except:
-            self.root.ids.thread_field.text = str(self.downloader.num_threads)
+            schedule = parse_schedule(" ".join(words))
+        except ValueError as e:
+            Snackbar(text=str(e)).open()
+            schedule = self.schedule
+        if kbps * 1024 != self.limit or schedule != self.schedule:
+            self.limit = kbps * 1024
+            self.schedule = schedule
+            self.send("configure", None, self.limit, self.schedule)
+        windows = [f"{start}-{end}={rate // 1024}" for start, end, rate in self.schedule]
+        self.root.ids.limit_field.text = " ".join(([str(kbps)] if kbps else []) + windows)
+        self.update_stats()
+
+    def limit_text(self):
+        limit = f"{self.format_size(self.limit)}/s" if self.limit else ""
+        if self.schedule:
+            limit = f"{limit} scheduled".lstrip()
+        return f" | Limit: {limit}" if limit else ""
+
+    def threads_text(self):
+        return str(self.threads) if self.threads else "auto"
 
     def update_stats(self):
         label = self.root.ids.status_label
         if self.stats['total'] == 0:
-            label.text = f"Ready to download • Threads: {self.downloader.num_threads}"
+            label.text = f"Ready to download • Threads: {self.threads_text()}{self.limit_text()}"
         else:
-            label.text = f"Active: {self.stats['active']} | Completed: {self.stats['completed']} | Failed: {self.stats['failed']} | Threads: {self.downloader.num_threads}"
+            label.text = f"Active: {self.stats['active']} | Completed: {self.stats['completed']} | Failed: {self.stats['failed']} | Threads: {self.threads_text()}{self.limit_text()}"
 
     def format_size(self, size):
         for unit in ['B', 'KB', 'MB', 'GB']:
@@ -577,121 +419,157 @@ class DownloadManagerApp(MDApp):
         return f"{size:.1f} TB"
 
     def start_download(self, url):
-        url = url.strip()
+        # Mirror URLs and an expected checksum may follow the URL,
+        # e.g. "https://a/f.iso https://b/f.iso sha256:<hex>"; a path to a text file
+        # with one URL per line fetches them all as one bulk job
+        if os.path.isfile(url.strip()):
+            self.start_bulk(url.strip())
+            return
+        url, mirrors, checksum = parse_sources(url.split())
         if not url:
             Snackbar(text="Please enter a URL").open()
             return
         
-        # Update threads before starting
-        try:
-            threads = int(self.root.ids.thread_field.text)
-            self.downloader.num_threads = max(1, min(256, threads))
-        except:
-            pass
-            
-        url_hash = self.downloader.get_url_hash(url)
-        if url_hash in self.downloader.active_downloads:
-            existing = self.downloader.active_downloads[url_hash]
-            if existing.status in ["downloading", "pending"]:
-                Snackbar(text="Already downloading!").open()
-                return
+        # Update threads and speed limit before starting
+        self.set_threads(self.root.ids.thread_field.text)
+        self.set_speed_limit(self.root.ids.limit_field.text)
 
         self.root.ids.url_field.text = ""
         self.update_stats()
         
-        # Get info in thread to not block UI
-        threading.Thread(target=self._init_download, args=(url, url_hash)).start()
-
-    def _init_download(self, url, url_hash):
-        filename, total_size, _ = self.downloader.get_file_info(url)
-        if not filename:
-            Clock.schedule_once(lambda dt: Snackbar(text="Failed to get file info").open())
+        # The daemon refuses duplicates and probes the file before queueing it
+        self.send("add", url, directory=self.download_dir(), checksum=checksum, mirrors=mirrors)
+
+    def start_bulk(self, path):
+        entries = []
+        with open(path) as f:
+            for line in f:
+                parts = line.split()
+                if parts and not parts[0].startswith("#"):
+                    url, _, checksum = parse_sources(parts)
+                    if url:
+                        entries.append((url, checksum))
+        if not entries:
+            Snackbar(text="No URLs in that file").open()
             return
-            
-        # If android, adjust path to Download folder
+        self.root.ids.url_field.text = ""
+        # One row for the whole batch, counted in files
+        self.send("bulk", entries, directory=self.download_dir())
+
+    def download_dir(self):
+        # If android, save to the Download folder
         if platform == 'android':
             from android.storage import primary_external_storage_path
-            dir_path = os.path.join(primary_external_storage_path(), 'Download')
-            if not os.path.exists(dir_path):
-                os.makedirs(dir_path)
-            filename = os.path.join(dir_path, filename)
-
-        task = DownloadTask(url, filename, total_size)
-        self.downloader.active_downloads[url_hash] = task
-        task.start_time = time.time()
-        
-        Clock.schedule_once(lambda dt: self._add_ui_item(task))
+            return os.path.join(primary_external_storage_path(), 'Download')
+        return os.path.abspath('.')
 
     def _add_ui_item(self, task):
-        # Remove "No downloads yet" label if exists
-        download_list = self.root.ids.download_list
-        if len(download_list.children) == 1 and hasattr(download_list.children[0], 'text'):
-            if "No downloads yet" in download_list.children[0].text:
-                download_list.clear_widgets()
-        
-        item = DownloadItemCard(task)
-        item.filename = os.path.basename(task.filename)
-        task.ui_item = item
-        download_list.add_widget(item, index=0) # Add to top
+        if task["id"] in self.rows:
+            return  # Already listed from a progress batch
+        self.tasks[task["id"]] = task
+        running = task["status"] not in ("completed", "failed")
+        row = {
+            "task_id": task["id"],
+            "filename": os.path.basename(task["filename"]),
+            "progress_text": "Paused" if task["paused"] else "Queued",
+            "speed_text": "",
+            "eta_text": "",
+            "progress_value": task["downloaded"] / task["total_size"] * 100 if task["total_size"] else 0,
+            "pause_icon": "play-circle" if task["paused"] else "pause-circle",
+            "bg_color": [1, 1, 1, 1],
+        }
+        self.rows[task["id"]] = row
+        self.root.ids.download_list.data.insert(0, row)  # Add to top
         
-        self.stats["total"] += 1
-        self.stats["active"] += 1
+        if running:
+            self.stats["total"] += 1
+            self.stats["active"] += 1
+        self.update_stats()
+        self._update_row(task, None)
+
+    def on_event(self, message):
+        # Called on the client's reader thread with one batch of changed tasks
+        if message.get("event") == "progress":
+            Clock.schedule_once(lambda dt: self._apply_batch(message))
+
+    def _apply_batch(self, message):
+        for task in message["tasks"]:
+            if task["id"] not in self.rows:
+                self._add_ui_item(task)  # Queued by another client, e.g. kdm --enqueue
+                continue
+            previous = self.tasks.get(task["id"])
+            self.tasks[task["id"]] = task
+            self._update_row(task, previous)
+        for task_id in message["removed"]:
+            self.tasks.pop(task_id, None)
+            self.remove_row(task_id)
         self.update_stats()
-        
-        threading.Thread(
-            target=self.downloader.start_download,
-            args=(task, self.on_progress, self.on_complete, self.on_error),
-            daemon=True
-        ).start()
 
-    def on_progress(self, task, speed):
-        # Update UI on main thread
-        Clock.schedule_once(lambda dt: self._update_ui_progress(task, speed))
+    def _update_row(self, task, previous):
+        status = task["status"]
+        changed = previous is None or previous["status"] != status
+        if status == "completed":
+            if changed:
+                if previous is not None:
+                    self.stats["completed"] += 1
+                    self.stats["active"] -= 1
+                self._update_ui_complete(task)
+        elif status == "failed":
+            if changed:
+                if previous is not None:
+                    self.stats["failed"] += 1
+                    self.stats["active"] -= 1
+                self._update_ui_error(task, task["error"] or "Download failed")
+        elif task["paused"]:
+            self.set_row(task["id"], pause_icon="play-circle", progress_text="Paused", speed_text="", eta_text="")
+        elif status == "downloading":
+            self._update_ui_progress(task, task["speed"])
+
+    def set_row(self, task_id, **fields):
+        row = self.rows.get(task_id)
+        if row is not None:
+            row.update(fields)
+            self.refresh_rows()
+
+    def remove_row(self, task_id):
+        row = self.rows.pop(task_id, None)
+        if row is not None:
+            data = self.root.ids.download_list.data
+            data.pop(next(i for i, entry in enumerate(data) if entry is row))
+
+    def _refresh_rows(self, dt):
+        # Rows were changed in place; visible widgets pick the new values up
+        self.root.ids.download_list.refresh_from_data()
 
     def _update_ui_progress(self, task, speed):
-        if not task.ui_item: return
-        
-        progress = (task.downloaded / task.total_size * 100) if task.total_size > 0 else 0
-        task.ui_item.progress_value = progress
-        
-        downloaded_str = self.format_size(task.downloaded)
-        total_str = self.format_size(task.total_size)
-        task.ui_item.progress_text = f"{int(progress)}% ({downloaded_str}/{total_str})"
+        total_size, downloaded = task["total_size"], task["downloaded"]
+        if task.get("files"):
+            # A bulk job: sizes and speed count files
+            progress = downloaded / total_size * 100 if total_size else 0
+            eta = (total_size - downloaded) / speed if speed > 0 else 0
+            self.set_row(task["id"], progress_value=progress,
+                         progress_text=f"{int(progress)}% ({downloaded}/{total_size} files)",
+                         speed_text=f"{speed:.0f} files/s", eta_text=f"ETA: {int(eta)}s", pause_icon="pause-circle")
+            return
+        progress = (downloaded / total_size * 100) if total_size > 0 else 0
         
-        task.ui_item.speed_text = f"{self.format_size(speed)}/s"
+        downloaded_str = self.format_size(downloaded)
+        total_str = self.format_size(total_size)
         
-        if task.status == "merging":
-            task.ui_item.progress_text = "Merging chunks..."
-            task.ui_item.eta_text = ""
-        else:
-            remaining = task.total_size - task.downloaded
-            eta = remaining / speed if speed > 0 else 0
-            task.ui_item.eta_text = f"ETA: {int(eta)}s"
-
-    def on_complete(self, task):
-        self.stats["completed"] += 1
-        self.stats["active"] -= 1
-        Clock.schedule_once(lambda dt: self._update_ui_complete(task))
-        Clock.schedule_once(lambda dt: self.update_stats())
+        remaining = total_size - downloaded
+        eta = remaining / speed if speed > 0 else 0
+        self.set_row(task["id"], progress_value=progress,
+                     progress_text=f"{int(progress)}% ({downloaded_str}/{total_str})",
+                     speed_text=f"{self.format_size(speed)}/s", eta_text=f"ETA: {int(eta)}s",
+                     pause_icon="pause-circle")
 
     def _update_ui_complete(self, task):
-        if task.ui_item:
-            task.ui_item.progress_value = 100
-            task.ui_item.progress_text = "Completed"
-            task.ui_item.speed_text = ""
-            task.ui_item.eta_text = ""
-            task.ui_item.pause_icon = "check-circle"
-
-    def on_error(self, task, error):
-        self.stats["failed"] += 1
-        self.stats["active"] -= 1
-        Clock.schedule_once(lambda dt: self._update_ui_error(task, error))
-        Clock.schedule_once(lambda dt: self.update_stats())
+        text = f"Completed, {task['error']}" if task.get("files") and task["error"] else "Completed"
+        self.set_row(task["id"], progress_value=100, progress_text=text, speed_text="", eta_text="",
+                     pause_icon="check-circle")
 
     def _update_ui_error(self, task, error):
-        if task.ui_item:
-            task.ui_item.progress_text = f"Error: {error[:20]}"
-            task.ui_item.md_bg_color = (1, 0.9, 0.9, 1)
+        self.set_row(task["id"], progress_text=f"Error: {error[:20]}", bg_color=[1, 0.9, 0.9, 1])
 
 if __name__ == "__main__":
     DownloadManagerApp().run()
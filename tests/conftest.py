@@ -0,0 +1,72 @@
+import email.utils
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+class FileHandler(BaseHTTPRequestHandler):
+    # Serves files from root with Range and ETag support, like a plain static server
+    protocol_version = "HTTP/1.1"
+    root = '.'
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def do_GET(self):
+        self.respond(True)
+
+    def respond(self, send_body):
+        path = os.path.join(self.root, self.path.lstrip('/'))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        mtime = int(os.path.getmtime(path))
+        etag = f'"{mtime}-{size}"'
+        since = self.headers.get('If-Modified-Since')
+        fresh = since and email.utils.parsedate_to_datetime(since).timestamp() >= mtime
+        if self.headers.get('If-None-Match') == etag or fresh:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start, end = 0, size - 1
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            if match[1]:
+                start = int(match[1])
+                end = min(int(match[2]), end) if match[2] else end
+            else:
+                start = max(0, size - int(match[2]))
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', email.utils.formatdate(mtime, usegmt=True))
+        self.end_headers()
+        if send_body:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                self.wfile.write(f.read(end - start + 1))
+
+@pytest.fixture
+def file_server(tmp_path):
+    # (directory served, base URL)
+    root = tmp_path / 'www'
+    root.mkdir()
+    handler = type('Handler', (FileHandler,), {'root': str(root)})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield root, f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,117 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+import bench.range_server as range_server
+from kdm.asyncengine import AsyncDownloader
+from kdm.asynchttp import HttpClient
+from kdm.task import DownloadTask
+
+def run(downloader, task):
+    result = {}
+    downloader.start_download(task, lambda t, s: None, lambda t: result.setdefault('ok', True),
+                              lambda t, e: result.setdefault('error', e))
+    return result
+
+def test_download_completes(file_server, tmp_path):
+    root, base = file_server
+    data = os.urandom(3000000)
+    (root / 'f.bin').write_bytes(data)
+    downloader = AsyncDownloader(num_threads=4, writer_threads=2, profile_path=str(tmp_path / 'hosts.json'))
+    task = DownloadTask(f"{base}/f.bin", str(tmp_path / 'f.bin'), len(data))
+    assert run(downloader, task) == {'ok': True}
+    assert (tmp_path / 'f.bin').read_bytes() == data
+    assert not (tmp_path / 'f.bin.kdm.json').exists()
+
+def test_paused_download_resumes_after_a_restart(tmp_path, monkeypatch):
+    size = 4194304
+    server = range_server.make_server(rate=1048576)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/file/{size}"
+    path = str(tmp_path / 'f.bin')
+    try:
+        task = DownloadTask(url, path, size)
+        downloader = AsyncDownloader(num_threads=4, profile_path=str(tmp_path / 'hosts.json'))
+        worker = threading.Thread(target=run, args=(downloader, task))
+        worker.start()
+        deadline = time.monotonic() + 10
+        while task.downloaded < 1048576 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        task.paused = True
+        worker.join(10)
+        assert not worker.is_alive()
+        assert 0 < task.downloaded < size
+        assert os.path.exists(path + '.kdm.json')
+
+        # A new process knows the download only by its journal
+        restarted = DownloadTask(url, path, size)
+        resumed_from = []
+        prepare_run = AsyncDownloader._prepare_run
+        def prepare(self, task):
+            prepared = prepare_run(self, task)
+            resumed_from.append(task.downloaded)
+            return prepared
+        monkeypatch.setattr(AsyncDownloader, '_prepare_run', prepare)
+        downloader = AsyncDownloader(num_threads=4, profile_path=str(tmp_path / 'hosts.json'))
+        assert run(downloader, restarted) == {'ok': True}
+        assert resumed_from[0] >= 1048576
+        with open(path, 'rb') as f:
+            assert f.read() == range_server.content(0, size)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+@pytest.fixture
+def h2_server():
+    pytest.importorskip('h2')
+    server = range_server.make_server(http2=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"https://127.0.0.1:{server.server_address[1]}", server.certfile
+    server.shutdown()
+    server.server_close()
+
+def test_h2_ranges_come_back_exact_over_one_connection(h2_server):
+    base, certfile = h2_server
+    size = 3000000
+    ranges = [(start, min(start + 199999, size - 1)) for start in range(0, size, 200000)]
+
+    async def fetch(client, start, end):
+        response = await client.get(f"{base}/file/{size}", {'Range': f'bytes={start}-{end}'})
+        try:
+            assert response.status == 206
+            body = b''
+            while True:
+                data = await response.read(65536, 15)
+                if not data:
+                    return body
+                body += data
+        finally:
+            response.release()
+
+    async def main():
+        client = HttpClient(http2=True, cafile=certfile)
+        try:
+            bodies = await asyncio.gather(*(fetch(client, start, end) for start, end in ranges))
+            return bodies, client.protocols, {key: len(c) for key, c in client.h2.items()}
+        finally:
+            client.close()
+
+    bodies, protocols, connections = asyncio.run(main())
+    for (start, end), body in zip(ranges, bodies):
+        assert body == range_server.content(start, end - start + 1)
+    assert list(protocols.values()) == ['h2']
+    # Fifteen ranges at once, multiplexed as streams
+    assert list(connections.values()) == [1]
+
+def test_async_engine_downloads_over_h2(h2_server, tmp_path, monkeypatch):
+    base, certfile = h2_server
+    monkeypatch.setenv('REQUESTS_CA_BUNDLE', certfile)
+    size = 5000000
+    downloader = AsyncDownloader(num_threads=8, http2=True, profile_path=str(tmp_path / 'hosts.json'))
+    task = DownloadTask(f"{base}/file/{size}", str(tmp_path / 'f.bin'), size)
+    assert run(downloader, task) == {'ok': True}
+    assert downloader.stats()['http2']['origins'] == [base]
+    assert (tmp_path / 'f.bin').read_bytes() == range_server.content(0, size)
@@ -0,0 +1,108 @@
+import asyncio
+import hashlib
+import os
+import threading
+
+import pytest
+
+from kdm.bulk import BulkDownloader, make_items, url_filename
+
+def test_make_items_keeps_names_apart_and_rejects_bad_checksums(tmp_path):
+    items, rejected = make_items([
+        ('http://a.example.com/pkg/file.txt', None),
+        ('http://b.example.com/file.txt?v=2', 'md5:' + '0' * 32),
+        ('http://c.example.com/file.txt', 'crc99:00'),
+        ('http://d.example.com/file.txt', None),
+    ], str(tmp_path))
+    assert [os.path.basename(item.path) for item in items] == ['file.txt', 'file (1).txt', 'file (2).txt']
+    assert items[1].checksum == ('md5', '0' * 32)
+    assert rejected == [('http://c.example.com/file.txt', "Unknown checksum: crc99:00")]
+    assert url_filename('http://example.com/a/b.tar.gz') == 'b.tar.gz'
+
+def test_batch_is_saved_then_left_alone_when_unchanged(file_server, tmp_path):
+    root, base = file_server
+    files = {f'f{i}.txt': os.urandom(100 + i * 5000) for i in range(30)}
+    for name, data in files.items():
+        (root / name).write_bytes(data)
+    out = tmp_path / 'out'
+    out.mkdir()
+    entries = [(f"{base}/{name}", None) for name in files]
+    entries[3] = (entries[3][0], 'md5:' + hashlib.md5(files['f3.txt']).hexdigest())
+    entries[4] = (entries[4][0], 'md5:' + '0' * 32)
+    entries.append((f"{base}/missing.txt", None))
+    items, _ = make_items(entries, str(out))
+    job = BulkDownloader(connections=2, depth=4).run(items)
+    assert (job.done, job.failed) == (29, 2)
+    assert {item.error for item in items if item.status == "failed"} == {"Checksum mismatch", "HTTP 404"}
+    assert all((out / name).read_bytes() == data for name, data in files.items() if name != 'f4.txt')
+    assert not os.path.exists(out / 'f4.txt.kdm')
+
+    items, _ = make_items([(f"{base}/{name}", None) for name in files], str(out))
+    job = BulkDownloader(connections=2, depth=4).run(items)
+    assert (job.unchanged, job.done) == (29, 1)
+
+def test_large_rangeable_file_is_handed_off(file_server, tmp_path):
+    root, base = file_server
+    (root / 'big.bin').write_bytes(os.urandom(300000))
+    (root / 'small.bin').write_bytes(b'x' * 10)
+    handed = []
+    items, _ = make_items([(f"{base}/big.bin", None), (f"{base}/small.bin", None)], str(tmp_path))
+    job = BulkDownloader(large=100000, handoff=lambda item, info: handed.append(info)).run(items)
+    assert (job.handed_off, job.done) == (1, 1)
+    assert (handed[0].size, handed[0].accept_ranges) == (300000, True)
+    assert not (tmp_path / 'big.bin').exists()
+
+async def handle(reader, writer):
+    # Keep-alive server that answers pipelined requests, some of them badly
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            path = line.split()[1].decode()
+            while (await reader.readline()).strip():
+                pass
+            if path == '/huge':
+                writer.write(b"HTTP/1.1 200 OK\r\nX-Big: " + b"a" * 3000000 + b"\r\nContent-Length: 2\r\n\r\nhi")
+            elif path == '/busy':
+                writer.write(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n\r\n")
+            elif path == '/badlen':
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 5, 5\r\nConnection: close\r\n\r\nhello")
+                await writer.drain()
+                break
+            else:
+                body = path.encode() * 10
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(body) + body)
+            await writer.drain()
+    finally:
+        writer.close()
+
+@pytest.fixture
+def pipeline_server():
+    ready = threading.Event()
+    state = {}
+    async def main():
+        state['loop'], state['stop'] = asyncio.get_running_loop(), asyncio.Event()
+        async with await asyncio.start_server(handle, '127.0.0.1', 0) as server:
+            state['port'] = server.sockets[0].getsockname()[1]
+            ready.set()
+            await state['stop'].wait()
+    thread = threading.Thread(target=asyncio.run, args=(main(),), daemon=True)
+    thread.start()
+    ready.wait()
+    yield f"http://127.0.0.1:{state['port']}"
+    state['loop'].call_soon_threadsafe(state['stop'].set)
+    thread.join()
+
+def test_bad_responses_fail_only_their_own_item(pipeline_server, tmp_path):
+    urls = ([f"{pipeline_server}/ok{i}" for i in range(5)] + [f"{pipeline_server}/{path}" for path in ('huge', 'badlen', 'busy')]
+            + [f"{pipeline_server}/ok{i}" for i in range(5, 20)])
+    items, _ = make_items([(url, None) for url in urls], str(tmp_path))
+    job = BulkDownloader(connections=2, depth=4, retries=2).run(items)
+    failed = {os.path.basename(item.path): item.error for item in items if item.status == "failed"}
+    assert failed.keys() == {'huge', 'busy'}
+    assert failed['huge'].startswith("Bad response: ")
+    assert failed['busy'] == "HTTP 503"
+    assert job.done == 21
+    assert (tmp_path / 'badlen').read_bytes() == b'hello'
+    assert (tmp_path / 'ok7').read_bytes() == b'/ok7' * 10
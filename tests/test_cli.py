@@ -0,0 +1,22 @@
+import json
+import os
+import subprocess
+import sys
+
+from kdm.cli import main
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+
+def test_optional_parts_load_only_when_used():
+    code = ("import sys, kdm, kdm.cli; "
+            "print(sorted({'kdm.asyncengine', 'kdm.daemon', 'kdm.bulk', 'kdm.delta', 'multiprocessing'} & set(sys.modules))); "
+            "kdm.AsyncDownloader; print('kdm.asyncengine' in sys.modules)")
+    assert subprocess.check_output([sys.executable, '-c', code], text=True, cwd=ROOT).split('\n')[:2] == ['[]', 'True']
+
+def test_make_index_writes_the_block_index(tmp_path, capsys):
+    path = tmp_path / 'f'
+    path.write_bytes(os.urandom(10000))
+    assert main(['--make-index', '--block-size', '4096', str(path)]) == 0
+    index = json.loads((tmp_path / 'f.kdmsync').read_text())
+    assert (index['size'], index['block_size'], len(index['blocks'])) == (10000, 4096, 3)
+    assert "3 blocks of 4096 bytes" in capsys.readouterr().out
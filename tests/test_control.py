@@ -0,0 +1,109 @@
+from kdm.control import ConnectionBudget, ConnectionController, HostProfiles
+from kdm.downloader import MultiThreadDownloader
+
+MB = 1048576
+
+def run(controller, rates, step=ConnectionController.INTERVAL):
+    # Feeds one window per rate (bytes/s) and returns the target after each
+    now, downloaded, targets = 0.0, 0, []
+    controller.sample(downloaded, now)
+    for rate in rates:
+        now += step
+        downloaded += int(rate * step)
+        controller.sample(downloaded, now)
+        targets.append(controller.target)
+    return targets
+
+def test_target_climbs_while_throughput_rises():
+    controller = ConnectionController(4, 32)
+    assert run(controller, [MB, 2 * MB, 3 * MB]) == [5, 6, 7]
+    assert controller.best_target == 6
+    assert controller.best_rate == 3 * MB
+
+def test_target_turns_back_when_throughput_drops():
+    controller = ConnectionController(4, 32)
+    assert run(controller, [MB, 2 * MB, MB]) == [5, 6, 5]
+    assert controller.direction == -1
+
+def test_flat_throughput_holds_the_target():
+    controller = ConnectionController(8, 32)
+    assert run(controller, [MB, MB, MB]) == [10, 10, 10]
+
+def test_errors_halve_the_target():
+    controller = ConnectionController(16, 32)
+    controller.sample(0, 0.0)
+    controller.record_error()
+    controller.sample(MB, ConnectionController.INTERVAL)
+    assert controller.target == 8
+    assert controller.may_grow
+
+def test_connections_that_only_fail_stop_growth():
+    controller = ConnectionController(4, 32)
+    controller.sample(0, 0.0)
+    controller.record_error()
+    controller.sample(0, ConnectionController.INTERVAL)
+    assert not controller.may_grow
+
+def test_samples_inside_a_window_are_ignored():
+    controller = ConnectionController(4, 32)
+    assert run(controller, [8 * MB], step=ConnectionController.INTERVAL / 2) == [4]
+    assert controller.last_time == 0.0
+
+def test_target_stays_within_the_cap_and_fixed_mode_holds():
+    controller = ConnectionController(40, 6)
+    assert controller.target == 6
+    assert max(run(controller, [MB, 2 * MB, 4 * MB])) == 6
+    fixed = ConnectionController(4, 4, adaptive=False)
+    assert run(fixed, [MB, 2 * MB, MB]) == [4, 4, 4]
+
+def test_workers_enlist_up_to_the_target_and_retire_above_it():
+    controller = ConnectionController(2, 8)
+    assert controller.enlist() and controller.enlist()
+    assert not controller.enlist()
+    controller.target = 1
+    assert controller.retire()
+    assert not controller.retire()
+    controller.leave()
+    assert controller.active == 0
+
+def test_only_the_surplus_stops_mid_range():
+    controller = ConnectionController(6, 8)
+    for _ in range(6):
+        controller.enlist()
+    controller.target = 4
+    assert [controller.claim() for _ in range(6)] == [True, True, False, False, False, False]
+    assert controller.retire() and controller.retire()
+    assert not controller.retire()
+    assert controller.active == 4
+    assert not controller.claim()
+
+def test_host_profiles_persist_the_best_count(tmp_path):
+    path = str(tmp_path / 'kdm' / 'hosts.json')
+    profiles = HostProfiles(path)
+    assert profiles.best_threads('example.com') is None
+    profiles.remember('example.com', 12, 5 * MB)
+    profiles.remember('idle.example.com', 3, 0)
+    reloaded = HostProfiles(path)
+    assert reloaded.best_threads('example.com') == 12
+    assert reloaded.best_threads('idle.example.com') is None
+
+def test_unreadable_profiles_start_empty(tmp_path):
+    path = tmp_path / 'hosts.json'
+    path.write_text('{not json')
+    assert HostProfiles(str(path)).hosts == {}
+
+def test_budget_bound_holds_across_a_resize(tmp_path):
+    downloader = MultiThreadDownloader(max_threads=4, profile_path=str(tmp_path / 'hosts.json'))
+    budget, pool = downloader.budget, downloader.worker_pool
+    assert all(budget.acquire('a.example.com') for _ in range(4))
+    downloader.set_budget(ConnectionBudget(2, 2))
+    assert downloader.budget is budget and downloader.worker_pool is pool
+    # The four slots still held count against the new cap of two
+    assert not budget.acquire('b.example.com')
+    for _ in range(3):
+        budget.release('a.example.com')
+    assert budget.acquire('b.example.com')
+    assert not budget.acquire('c.example.com')
+    downloader.set_budget(ConnectionBudget(16, 8))
+    assert downloader.worker_pool is pool and pool._max_workers == 16
+    assert budget.per_host == 8
@@ -0,0 +1,115 @@
+import json
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from kdm.daemon import STATE_FILE, DaemonClient, DaemonError, DownloadDaemon, connect
+
+@pytest.fixture
+def daemon(tmp_path):
+    daemon = DownloadDaemon({'history': False}, str(tmp_path / 'state'))
+    thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+    thread.start()
+    yield daemon
+    daemon.shutdown()
+    thread.join(10)
+
+def test_wrong_token_is_turned_away(daemon):
+    with pytest.raises(DaemonError):
+        DaemonClient(daemon.port, 'not-the-token')
+    with socket.create_connection(('127.0.0.1', daemon.port), timeout=5) as sock:
+        sock.sendall(b'{"cmd": "list"}\n')
+        assert sock.recv(100) == b''  # Closed without a word
+
+def test_silent_listener_fails_the_handshake():
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen()
+        DaemonClient.HANDSHAKE_TIMEOUT, timeout = 0.5, DaemonClient.HANDSHAKE_TIMEOUT
+        try:
+            started = time.monotonic()
+            with pytest.raises(DaemonError):
+                DaemonClient(listener.getsockname()[1], 'token')
+            assert time.monotonic() - started < 5
+        finally:
+            DaemonClient.HANDSHAKE_TIMEOUT = timeout
+
+def test_add_list_and_progress_round_trip(daemon, file_server, tmp_path):
+    root, base = file_server
+    data = os.urandom(300000)
+    (root / 'f.bin').write_bytes(data)
+    events = []
+    done = threading.Event()
+    def on_event(event):
+        events.append(event)
+        if any(task['status'] == "completed" for task in event['tasks']):
+            done.set()
+    client = connect(daemon.state_dir, on_event=on_event)
+    try:
+        assert client.pid == os.getpid()
+        assert client.subscribe() == []
+        task = client.add(f"{base}/f.bin", directory=str(tmp_path / 'out'), limit=10485760)
+        assert (task['total_size'], task['limit']) == (len(data), 10485760)
+        assert done.wait(15)
+        assert all(event['event'] == 'progress' for event in events)
+        listed = client.list()
+        assert [(t['id'], t['status']) for t in listed] == [(task['id'], "completed")]
+        assert (tmp_path / 'out' / 'f.bin').read_bytes() == data
+        with pytest.raises(DaemonError, match="Unknown task"):
+            client.pause(task['id'] + 100)
+        with pytest.raises(DaemonError, match="Unknown command"):
+            client.call('explode')
+    finally:
+        client.close()
+
+def test_many_requests_on_one_connection_are_all_answered(daemon):
+    client = connect(daemon.state_dir)
+    try:
+        replies = []
+        threads = [threading.Thread(target=lambda: replies.append(client.list())) for _ in range(100)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(15)
+        assert replies == [[]] * 100
+    finally:
+        client.close()
+
+def spawned(state_dir):
+    return connect(state_dir, spawn=True, args=('--parallel', '1'), timeout=20)
+
+def test_connect_spawns_a_daemon_once_and_reconnects(tmp_path):
+    state_dir = str(tmp_path / 'state')
+    os.makedirs(state_dir)
+    # A daemon that died left its state behind
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        dead_port = sock.getsockname()[1]
+    with open(os.path.join(state_dir, STATE_FILE), 'w') as f:
+        json.dump({'port': dead_port, 'token': 'x', 'pid': 1}, f)
+    with pytest.raises(DaemonError):
+        connect(state_dir)
+    clients = []
+    racers = [threading.Thread(target=lambda: clients.append(spawned(state_dir))) for _ in range(3)]
+    for racer in racers:
+        racer.start()
+    for racer in racers:
+        racer.join(30)
+    try:
+        assert len(clients) == 3
+        assert len({client.pid for client in clients}) == 1
+        assert clients[0].pid != os.getpid()
+        again = connect(state_dir)
+        assert again.pid == clients[0].pid
+        again.close()
+    finally:
+        clients[0].shutdown()
+        for client in clients:
+            client.close()
+    deadline = time.monotonic() + 10
+    while os.path.exists(os.path.join(state_dir, STATE_FILE)) and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert not os.path.exists(os.path.join(state_dir, STATE_FILE))
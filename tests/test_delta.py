@@ -0,0 +1,122 @@
+import json
+import random
+
+from kdm import delta
+from kdm.downloader import MultiThreadDownloader
+from kdm.segments import Segment
+from kdm.task import DownloadTask
+
+BLOCK = 1024
+
+def data(n, seed=1):
+    return random.Random(seed).randbytes(n)
+
+def index_for(tmp_path, content, block_size=BLOCK):
+    path = tmp_path / 'new'
+    path.write_bytes(content)
+    return delta.make_index(str(path), block_size)
+
+def test_rolling_checksum_matches_a_fresh_one():
+    block = data(BLOCK + 1)
+    window = block[:BLOCK]
+    a = sum(window) & 0xFFFF
+    b = (delta.weak_checksum(window) >> 16)
+    out, new = block[0], block[BLOCK]
+    a = (a - out + new) & 0xFFFF
+    b = (b - BLOCK * out + a) & 0xFFFF
+    assert a | (b << 16) == delta.weak_checksum(block[1:])
+
+def test_index_describes_every_block(tmp_path):
+    content = data(10 * BLOCK + 10)
+    index = index_for(tmp_path, content)
+    assert index['size'] == len(content)
+    assert len(index['blocks']) == 11
+    assert index['blocks'][-1][1] == delta.strong_checksum(content[-10:].ljust(BLOCK, b'\0'))
+    (tmp_path / 'new.kdmsync').write_text(json.dumps(index))
+    assert delta.load_index(str(tmp_path / 'new.kdmsync')) == index
+
+def test_small_edits_only_lose_their_own_blocks(tmp_path):
+    old = bytearray(data(64 * BLOCK))
+    index = index_for(tmp_path, bytes(old))
+    old[5 * BLOCK + 3] ^= 0xff
+    old[40 * BLOCK] ^= 0xff
+    (tmp_path / 'old').write_bytes(old)
+    found = delta.match_blocks(index, str(tmp_path / 'old'))
+    assert set(found) == set(range(64)) - {5, 40}
+    assert all(found[i] == i * BLOCK for i in found)
+
+def test_inserted_bytes_shift_the_matches(tmp_path):
+    new = data(32 * BLOCK)
+    index = index_for(tmp_path, new)
+    (tmp_path / 'old').write_bytes(new[:10 * BLOCK] + b'inserted' + new[10 * BLOCK:])
+    found = delta.match_blocks(index, str(tmp_path / 'old'))
+    assert set(found) == set(range(32))
+    assert found[9] == 9 * BLOCK
+    assert found[10] == 10 * BLOCK + len(b'inserted')
+
+def test_unrelated_copy_matches_nothing(tmp_path):
+    index = index_for(tmp_path, data(16 * BLOCK))
+    (tmp_path / 'old').write_bytes(data(16 * BLOCK, seed=2))
+    assert delta.match_blocks(index, str(tmp_path / 'old')) == {}
+    (tmp_path / 'tiny').write_bytes(b'x')
+    assert delta.match_blocks(index, str(tmp_path / 'tiny')) == {}
+
+def test_scan_gives_up_on_a_mostly_changed_copy(tmp_path, monkeypatch):
+    monkeypatch.setattr(delta, 'SCAN_PROBE', 4 * BLOCK)
+    new = data(64 * BLOCK)
+    index = index_for(tmp_path, new)
+    # Only the first blocks and the very last one survive
+    (tmp_path / 'old').write_bytes(new[:4 * BLOCK] + data(59 * BLOCK, seed=2) + new[-BLOCK:])
+    assert set(delta.match_blocks(index, str(tmp_path / 'old'))) == {0, 1, 2, 3}
+    monkeypatch.setattr(delta, 'SCAN_PROBE', 64 * BLOCK)
+    assert set(delta.match_blocks(index, str(tmp_path / 'old'))) == {0, 1, 2, 3, 63}
+
+def test_plan_copies_found_blocks_and_leaves_the_rest_to_fetch(tmp_path):
+    new = data(20 * BLOCK + 100)
+    index = index_for(tmp_path, new)
+    old = bytearray(new)
+    old[7 * BLOCK:9 * BLOCK] = data(2 * BLOCK, seed=3)
+    (tmp_path / 'old').write_bytes(old)
+    task = DownloadTask('http://example.com/new', str(tmp_path / 'out'), len(new))
+    # The short last block is never found; the old copy is hashed in whole blocks
+    assert delta.plan(task, index, str(tmp_path / 'old')) == 18 * BLOCK
+    missing = [(s.start, s.end) for s in task.segments if s.pos <= s.end]
+    assert missing == [(7 * BLOCK, 9 * BLOCK - 1), (20 * BLOCK, len(new) - 1)]
+    assert task.segments[-1].end == len(new) - 1
+    rebuilt = bytearray((tmp_path / 'out.kdm').read_bytes())
+    for start, end in missing:
+        rebuilt[start:end + 1] = new[start:end + 1]
+    assert rebuilt == new
+
+def test_download_takes_unchanged_blocks_from_the_old_copy(file_server, tmp_path):
+    root, base = file_server
+    new = data(40 * delta.BLOCK_SIZE + 1234)
+    (root / 'f.bin').write_bytes(new)
+    (root / 'f.bin.kdmsync').write_text(json.dumps(delta.make_index(str(root / 'f.bin'))))
+    old = bytearray(new)
+    old[3 * delta.BLOCK_SIZE + 10] ^= 0xff
+    (tmp_path / 'old.bin').write_bytes(old)
+    task = DownloadTask(f"{base}/f.bin", str(tmp_path / 'f.bin'), len(new))
+    task.delta_source = str(tmp_path / 'old.bin')
+    result = {}
+    MultiThreadDownloader(num_threads=4, profile_path=str(tmp_path / 'hosts.json')).start_download(
+        task, lambda t, s: None, lambda t: result.setdefault('ok', True), lambda t, e: result.setdefault('error', e))
+    assert result == {'ok': True}
+    assert task.reused == 39 * delta.BLOCK_SIZE
+    assert (tmp_path / 'f.bin').read_bytes() == new
+
+def test_scattered_edits_in_a_large_copy_keep_everything_else(tmp_path, monkeypatch):
+    # Scaled down: the copy is 64 times SCAN_LIMIT and 5% of its blocks changed in place
+    monkeypatch.setattr(delta, 'SCAN_PROBE', 8 * BLOCK)
+    monkeypatch.setattr(delta, 'SCAN_LIMIT', 32 * BLOCK)
+    count = 2048
+    new = data(count * BLOCK)
+    index = index_for(tmp_path, new)
+    changed = set(random.Random(7).sample(range(count), count // 20))
+    old = bytearray(new)
+    for i in changed:
+        old[i * BLOCK + 100] ^= 0xff
+    (tmp_path / 'old').write_bytes(old)
+    found = delta.match_blocks(index, str(tmp_path / 'old'))
+    assert set(found) == set(range(count)) - changed
+    assert all(found[i] == i * BLOCK for i in found)
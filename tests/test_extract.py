@@ -0,0 +1,88 @@
+import importlib
+import io
+import lzma
+import os
+import subprocess
+import sys
+import tarfile
+import zipfile
+
+import pytest
+
+from kdm.downloader import MultiThreadDownloader
+from kdm.extract import archive_kind, written_ranges
+from kdm.segments import Segment
+from kdm.task import DownloadTask
+
+FILES = {'src/a.bin': os.urandom(700000), 'src/sub/b.txt': b'hello\n' * 50000, 'src/empty': b''}
+
+def test_archive_kind_goes_by_the_name():
+    assert archive_kind('A.ZIP') == 'zip'
+    assert archive_kind('x.tar.gz') == archive_kind('x.tgz') == archive_kind('x.tar') == 'tar'
+    assert archive_kind('x.txt.xz') == archive_kind('x.bz2') == 'compressed'
+    assert archive_kind('x.iso') is None
+
+def test_written_ranges_merges_adjacent_segments():
+    segments = [Segment(100, 199, 200), Segment(0, 99, 100), Segment(200, 299, 250), Segment(300, 399, 300)]
+    assert written_ranges(segments) == [[0, 250]]
+    assert written_ranges([Segment(0, 99, 50), Segment(100, 199, 150)]) == [[0, 50], [100, 150]]
+
+def make_zip(path):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, data in FILES.items():
+            archive.writestr(name, data)
+
+def make_tar(path):
+    with tarfile.open(path, 'w:gz') as archive:
+        for name, data in FILES.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+
+def download(url, directory, keep_archive=True):
+    downloader = MultiThreadDownloader(num_threads=4, profile_path=str(directory / 'hosts.json'))
+    filename, total, _ = downloader.get_file_info(url)
+    task = DownloadTask(url, str(directory / filename), total)
+    task.extract_to = str(directory / 'x')
+    task.keep_archive = keep_archive
+    result = {}
+    downloader.start_download(task, lambda t, s: None, lambda t: result.setdefault('ok', True),
+                              lambda t, e: result.setdefault('error', e))
+    return task, result
+
+@pytest.mark.parametrize('name, make', [('arc.zip', make_zip), ('arc.tar.gz', make_tar)])
+def test_archive_is_unpacked_as_it_downloads(name, make, file_server, tmp_path):
+    root, base = file_server
+    make(root / name)
+    task, result = download(f"{base}/{name}", tmp_path, keep_archive=name.endswith('.zip'))
+    assert result == {'ok': True}
+    assert task.extractor.members == len(FILES)
+    for path, data in FILES.items():
+        assert (tmp_path / 'x' / path).read_bytes() == data
+    assert (tmp_path / name).exists() == name.endswith('.zip')
+
+def test_single_compressed_file_is_unpacked(file_server, tmp_path):
+    root, base = file_server
+    (root / 'a.bin.xz').write_bytes(lzma.compress(FILES['src/a.bin']))
+    task, result = download(f"{base}/a.bin.xz", tmp_path)
+    assert result == {'ok': True}
+    assert (tmp_path / 'x' / 'a.bin').read_bytes() == FILES['src/a.bin']
+
+def test_missing_compression_module_fails_the_extraction(file_server, tmp_path, monkeypatch):
+    root, base = file_server
+    (root / 'a.bin.xz').write_bytes(lzma.compress(FILES['src/a.bin']))
+    real_import = importlib.import_module
+    def import_module(name, *args):
+        if name == 'lzma':
+            raise ImportError(name)
+        return real_import(name, *args)
+    monkeypatch.setattr(importlib, 'import_module', import_module)
+    task, result = download(f"{base}/a.bin.xz", tmp_path)
+    assert result == {'error': "Extraction failed: This Python has no lzma support"}
+
+def test_imports_without_bz2_or_lzma():
+    # As on Android builds that leave them out
+    code = ("import sys; sys.modules['bz2'] = sys.modules['lzma'] = None; "
+            "import kdm.extract; print(kdm.extract.archive_kind('a.tar.xz'))")
+    assert subprocess.check_output([sys.executable, '-c', code], text=True,
+                                   cwd=os.path.dirname(os.path.dirname(__file__))).strip() == 'tar'
@@ -0,0 +1,61 @@
+import os
+import sqlite3
+
+from kdm.downloader import MultiThreadDownloader
+from kdm.history import DownloadHistory
+from kdm.segments import Segment
+from kdm.task import DownloadTask
+
+def test_old_database_gains_the_new_columns(tmp_path):
+    path = str(tmp_path / 'history.db')
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE downloads (id INTEGER PRIMARY KEY, url TEXT NOT NULL, filename TEXT NOT NULL, "
+               "total_size INTEGER NOT NULL DEFAULT 0, downloaded INTEGER NOT NULL DEFAULT 0, status TEXT NOT NULL, "
+               "mirrors TEXT, checksum TEXT, etag TEXT, last_modified TEXT, error TEXT, created REAL NOT NULL, "
+               "updated REAL NOT NULL, completed REAL)")
+    db.execute("INSERT INTO downloads (url, filename, status, created, updated) "
+               "VALUES ('http://example.com/f', 'f', 'paused', 0, 0)")
+    db.commit()
+    db.close()
+    history = DownloadHistory(path)
+    task = history.restore(history.unfinished()[0])
+    assert (task.resolved_url, task.rate_limit) == (None, 0)
+    history.close()
+
+def test_redirect_target_and_limit_survive_a_restart(tmp_path):
+    history = DownloadHistory(str(tmp_path / 'history.db'))
+    task = DownloadTask('http://example.com/latest', str(tmp_path / 'f'), 300)
+    task.resolved_url = 'http://cdn.example.com/f-1.2'
+    task.rate_limit = 4096
+    task.etag = '"v1"'
+    task.segments = [Segment(0, 299, 120)]
+    task.paused = True
+    history.save(task, segments=True)
+    history.close()
+    with open(task.temp_filename, 'wb') as f:
+        f.write(b'\0' * 300)
+    history = DownloadHistory(str(tmp_path / 'history.db'))
+    restored = history.restore(history.unfinished()[0])
+    assert restored.download_url == 'http://cdn.example.com/f-1.2'
+    assert restored.rate_limit == 4096
+    assert [(s.start, s.end, s.pos) for s in restored.segments] == [(0, 299, 120)]
+    history.close()
+
+def test_resumed_download_skips_the_probe(file_server, tmp_path):
+    root, base = file_server
+    data = os.urandom(500000)
+    (root / 'f-1.2.bin').write_bytes(data)
+    etag = MultiThreadDownloader(num_threads=1, profile_path=str(tmp_path / 'hosts.json')).file_info(f"{base}/f-1.2.bin").etag
+    # Probing the original URL would fail; it only answered with the redirect back then
+    task = DownloadTask(f"{base}/latest", str(tmp_path / 'f.bin'), len(data))
+    task.resolved_url = f"{base}/f-1.2.bin"
+    task.etag = etag
+    task.segments = [Segment(0, 99999, 100000), Segment(100000, len(data) - 1)]
+    with open(task.temp_filename, 'wb') as f:
+        f.write(data[:100000].ljust(len(data), b'\0'))
+    result = {}
+    downloader = MultiThreadDownloader(num_threads=4, profile_path=str(tmp_path / 'hosts.json'))
+    downloader.start_download(task, lambda t, s: None, lambda t: result.setdefault('ok', True),
+                              lambda t, e: result.setdefault('error', e))
+    assert result == {'ok': True}
+    assert (tmp_path / 'f.bin').read_bytes() == data
@@ -0,0 +1,112 @@
+import hashlib
+import threading
+
+import pytest
+
+import bench.range_server as range_server
+from kdm.asyncengine import AsyncDownloader
+from kdm.downloader import MultiThreadDownloader
+from kdm.integrity import (PIECE_SIZE, PieceHasher, StreamingDigest, find_bad_pieces,
+                           parse_checksum, piece_ranges)
+from kdm.task import DownloadTask
+
+DATA = bytes(range(256)) * 16384  # 4 MB
+
+def md5(data):
+    return hashlib.md5(data).hexdigest()
+
+def test_parse_checksum_names_or_guesses_the_algorithm():
+    assert parse_checksum('SHA256:ABC') == ('sha256', 'abc')
+    assert parse_checksum(' ' + 'a' * 40 + ' ') == ('sha1', 'a' * 40)
+    assert parse_checksum('sha-1:ab') == ('sha1', 'ab')
+    with pytest.raises(ValueError):
+        parse_checksum('abc')
+    with pytest.raises(ValueError):
+        parse_checksum('crc99:abc')
+
+def test_aligned_attempt_hashes_every_piece_it_covers():
+    pieces = {}
+    hasher = PieceHasher(pieces, len(DATA) - 100)
+    for offset in range(0, len(DATA) - 100, 300000):
+        hasher.feed(offset, DATA[offset:min(offset + 300000, len(DATA) - 100)])
+    assert pieces == {i: md5(DATA[i * PIECE_SIZE:min((i + 1) * PIECE_SIZE, len(DATA) - 100)]) for i in range(4)}
+
+def test_attempt_joined_midway_skips_to_the_next_piece():
+    pieces = {}
+    hasher = PieceHasher(pieces, len(DATA))
+    start = PIECE_SIZE + 10
+    hasher.feed(start, DATA[start:3 * PIECE_SIZE])
+    assert set(pieces) == {2}
+    hasher.feed(3 * PIECE_SIZE + 5, DATA[3 * PIECE_SIZE + 5:])  # A gap restarts it too
+    assert set(pieces) == {2}
+
+def test_streaming_digest_catches_up_on_data_that_landed_ahead():
+    digest = StreamingDigest('sha256', hashlib.sha256(DATA).hexdigest())
+    digest.feed_at(PIECE_SIZE, DATA[PIECE_SIZE:2 * PIECE_SIZE])  # Ahead; ignored
+    digest.feed_at(0, DATA[:1000])
+    digest.feed_at(500, DATA[500:PIECE_SIZE])  # Overlaps what it already has
+    assert digest.pos == PIECE_SIZE
+    digest.catch_up(lambda start, n: DATA[start:start + n], len(DATA), limit=PIECE_SIZE)
+    assert digest.pos == 2 * PIECE_SIZE
+    digest.catch_up(lambda start, n: DATA[start:start + n], len(DATA))
+    assert digest.matches()
+
+def test_bad_pieces_include_changed_and_unhashed_ones():
+    disk = bytearray(DATA)
+    pieces = {i: md5(DATA[i * PIECE_SIZE:(i + 1) * PIECE_SIZE]) for i in range(3)}
+    disk[PIECE_SIZE + 7] ^= 0xff
+    bad = find_bad_pieces(lambda start, n: bytes(disk[start:start + n]), pieces, len(DATA))
+    assert bad == [1, 3]
+    assert piece_ranges(bad, len(DATA) - 1) == [(PIECE_SIZE, 2 * PIECE_SIZE - 1),
+                                                (3 * PIECE_SIZE, len(DATA) - 2)]
+    assert piece_ranges([2, 0, 1], len(DATA)) == [(0, 3 * PIECE_SIZE - 1)]
+
+SIZE = 20000000  # Big enough that no tail hedge fetches the corrupted byte again
+CORRUPT_AT = 5000000
+
+@pytest.fixture
+def corrupt_once(monkeypatch):
+    # Serves the bench file with one byte flipped in the first response covering it
+    good = range_server.content
+    state = {'left': 1}
+    def content(start, n):
+        data = good(start, n)
+        if state['left'] and start <= CORRUPT_AT < start + n:
+            state['left'] -= 1
+            data = bytearray(data)
+            data[CORRUPT_AT - start] ^= 0xff
+        return bytes(data)
+    monkeypatch.setattr(range_server, 'content', content)
+    server = range_server.make_server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/file/{SIZE}", hashlib.sha256(good(0, SIZE)).hexdigest()
+    server.shutdown()
+    server.server_close()
+
+def download(engine, url, path, checksum, tmp_path):
+    task = DownloadTask(url, str(path), SIZE)
+    task.set_checksum('sha256:' + checksum)
+    result = {}
+    engine(num_threads=4, profile_path=str(tmp_path / 'hosts.json')).start_download(
+        task, lambda t, s: None, lambda t: result.setdefault('ok', True),
+        lambda t, e: result.setdefault('error', e))
+    return task, result
+
+@pytest.mark.parametrize('engine', [MultiThreadDownloader, AsyncDownloader])
+def test_corrupted_piece_is_fetched_again(engine, corrupt_once, tmp_path):
+    url, checksum = corrupt_once
+    path = tmp_path / 'out'
+    task, result = download(engine, url, path, checksum, tmp_path)
+    assert result == {'ok': True}
+    assert task.repairs == 1
+    assert hashlib.sha256(path.read_bytes()).hexdigest() == checksum
+
+@pytest.mark.parametrize('engine', [MultiThreadDownloader, AsyncDownloader])
+def test_wrong_checksum_keeps_the_download(engine, corrupt_once, tmp_path):
+    url, _ = corrupt_once
+    path = tmp_path / 'out'
+    task, result = download(engine, url, path, '0' * 64, tmp_path)
+    assert result == {'error': "Checksum mismatch"}
+    assert not path.exists()
+    assert (tmp_path / 'out.kdm').stat().st_size == SIZE
+    assert (tmp_path / 'out.kdm.json').exists()
@@ -0,0 +1,105 @@
+import os
+import threading
+
+import pytest
+
+# No display or GPU needed: GL calls go to Kivy's mock backend
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+os.environ.setdefault('KIVY_NO_CONSOLELOG', '1')
+os.environ.setdefault('KIVY_GL_BACKEND', 'mock')
+pytest.importorskip('kivy')
+pytest.importorskip('kivymd')
+
+from kivy.clock import Clock
+from kivy.metrics import dp
+
+import main_kivy
+from kdm import DaemonClient, DownloadDaemon
+
+class HeadlessApp(main_kivy.DownloadManagerApp):
+    def _connect(self):
+        # A daemon of its own on a thread, as on Android, in the test's directory
+        self.daemon = DownloadDaemon({'history': False}, self.state_dir)
+        threading.Thread(target=self.daemon.serve_forever, daemon=True).start()
+        return DaemonClient(self.daemon.port, self.daemon.token, self.on_event)
+
+@pytest.fixture(scope='module')
+def app(tmp_path_factory):
+    app = HeadlessApp()
+    app.state_dir = str(tmp_path_factory.mktemp('state'))
+    app._run_prepare()
+    yield app
+    app.client.close()
+    app.daemon.shutdown()
+
+@pytest.fixture(autouse=True)
+def empty_list(app):
+    for task_id in list(app.rows):
+        app.remove_row(task_id)
+    app.tasks.clear()
+    render(app)
+
+def render(app):
+    for _ in range(3):
+        Clock.tick()
+
+def snapshot(task_id, **fields):
+    task = {'id': task_id, 'url': f'http://example.com/{task_id}.bin', 'filename': f'/tmp/{task_id}.bin',
+            'total_size': 1000, 'downloaded': 0, 'speed': 0.0, 'status': 'queued', 'paused': False,
+            'limit': 0, 'error': None}
+    task.update(fields)
+    return task
+
+def batch(*tasks, removed=()):
+    return {'event': 'progress', 'tasks': list(tasks), 'removed': list(removed)}
+
+def cards(app):
+    return list(app.root.ids.download_list.layout_manager.children)
+
+def card(app, task_id):
+    return next(c for c in cards(app) if c.task_id == task_id)
+
+def test_rows_are_recycled_and_show_their_own_task(app):
+    for task_id in range(1, 41):
+        app._add_ui_item(snapshot(task_id))
+    render(app)
+    shown = cards(app)
+    assert 0 < len(shown) < 40
+    app.root.ids.download_list.scroll_y = 0
+    render(app)
+    for c in cards(app):
+        assert c.filename == f'{c.task_id}.bin'
+    assert {c.task_id for c in cards(app)} != {c.task_id for c in shown}
+
+def test_progress_batch_refreshes_the_visible_row(app):
+    for task_id in range(1, 4):
+        app._add_ui_item(snapshot(task_id))
+    render(app)
+    assert card(app, 2).progress_text == 'Queued'
+    app._apply_batch(batch(snapshot(2, status='downloading', downloaded=500, speed=100.0)))
+    render(app)
+    assert card(app, 2).progress_text == '50% (500.0 B/1000.0 B)'
+    assert card(app, 2).progress_value == 50
+    assert card(app, 1).progress_text == 'Queued'
+
+def test_failed_download_turns_its_row_red(app):
+    app._add_ui_item(snapshot(7, status='downloading'))
+    failed = app.stats['failed']
+    app._apply_batch(batch(snapshot(7, status='failed', error='HTTP 404')))
+    render(app)
+    assert app.rows[7]['bg_color'] == [1, 0.9, 0.9, 1]
+    assert list(card(app, 7).bg_color) == [1, 0.9, 0.9, 1]
+    assert card(app, 7).progress_text == 'Error: HTTP 404'
+    assert app.stats['failed'] == failed + 1
+
+def test_placeholder_takes_space_only_while_the_list_is_empty(app):
+    placeholder = next(w for w in app.root.walk() if getattr(w, 'text', None) == 'No downloads yet')
+    assert placeholder.height == dp(100)
+    assert placeholder.opacity == 1
+    app._add_ui_item(snapshot(9))
+    render(app)
+    assert placeholder.height == 0
+    assert placeholder.opacity == 0
+    app._apply_batch(batch(removed=[9]))
+    render(app)
+    assert placeholder.height == dp(100)
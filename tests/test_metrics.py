@@ -0,0 +1,37 @@
+from kdm.metrics import MetricsRegistry
+from kdm.task import DownloadTask
+
+def tracked(registry, n, status):
+    tasks = []
+    for i in range(n):
+        task = DownloadTask(f'http://example.com/{status}{i}', f'{status}{i}', 0)
+        task.status = status
+        registry.track(task, 'example.com')
+        tasks.append(task)
+    return tasks
+
+def test_only_finished_tasks_are_evicted(monkeypatch):
+    monkeypatch.setattr(MetricsRegistry, 'MAX_TASKS', 4)
+    registry = MetricsRegistry()
+    running = tracked(registry, 3, 'downloading')
+    tracked(registry, 2, 'completed')
+    queued = tracked(registry, 2, 'queued')
+    # Nothing left that may go; the registry grows past the cap instead
+    assert list(registry.tasks) == running + queued
+    running[0].cancel = True
+    later = tracked(registry, 1, 'queued')
+    assert list(registry.tasks) == running[1:] + queued + later
+
+def test_tasks_without_history_rows_get_distinct_ids():
+    registry = MetricsRegistry()
+    first = DownloadTask('http://a.example.com/setup.exe', 'setup.exe', 10)
+    second = DownloadTask('http://b.example.com/setup.exe', 'setup.exe', 20)
+    saved = DownloadTask('http://c.example.com/setup.exe', 'setup.exe', 30)
+    saved.id = 42
+    for task in (first, second, saved):
+        registry.track(task, 'example.com')
+    registry.track(first, 'example.com')  # Tracking again keeps the number
+    assert [t['id'] for t in registry.snapshot()['tasks']] == [2, 42, 1]
+    text = registry.to_prometheus()
+    for task_id, size in ((1, 10), (2, 20), (42, 30)):
+        assert f'kdm_task_size_bytes{{id="{task_id}",file="setup.exe"}} {size}' in text
@@ -0,0 +1,67 @@
+import time
+
+import pytest
+
+from kdm.ratelimit import BandwidthLimiter, RateSchedule, TokenBucket, parse_schedule
+from kdm.task import DownloadTask
+
+def at(hhmm):
+    return time.strptime(hhmm, '%H:%M')
+
+def test_bucket_lets_a_burst_through_then_paces():
+    bucket = TokenBucket(1000)
+    assert bucket.reserve(500, 10.0) == 0.0  # Within the burst
+    assert bucket.reserve(500, 10.0) == pytest.approx(0.5)
+    assert bucket.reserve(1000, 10.0) == pytest.approx(1.5)
+
+def test_idle_time_is_not_banked_beyond_the_burst():
+    bucket = TokenBucket(1000)
+    bucket.reserve(1000, 0.0)
+    assert bucket.reserve(1000, 100.0) == pytest.approx(0.5)
+
+def test_unlimited_bucket_never_waits():
+    bucket = TokenBucket()
+    assert bucket.reserve(10 ** 9, 0.0) == 0.0
+    assert TokenBucket(1000).reserve(10 ** 9, 0.0, rate=0) == 0.0
+
+def test_new_rate_forgets_the_old_debt():
+    bucket = TokenBucket(10)
+    bucket.reserve(10000, 0.0)
+    bucket.set_rate(1000)
+    assert bucket.reserve(500, 0.0) == 0.0
+
+def test_schedule_picks_the_first_matching_window():
+    schedule = RateSchedule([("09:00", "18:00", 512000), ("12:00", "13:00", 0), ("23:00", "07:00", 0)])
+    assert schedule.rate_at(at('09:00')) == 512000
+    assert schedule.rate_at(at('12:30')) == 512000
+    assert schedule.rate_at(at('18:00')) is None
+    assert schedule.rate_at(at('23:30')) == 0
+    assert schedule.rate_at(at('06:59')) == 0
+    assert schedule.rate_at(at('07:00')) is None
+
+def test_parse_schedule_takes_kilobytes_per_second():
+    assert parse_schedule("09:00-18:00=512, 23:00-7:00=0") == [
+        ("09:00", "18:00", 524288), ("23:00", "7:00", 0)]
+    assert parse_schedule("") == []
+
+@pytest.mark.parametrize('value', ["9-18=512", "09:00-18:00", "25:00-18:00=1", "09:60-18:00=1", "09:00-18:00=-1"])
+def test_parse_schedule_rejects_bad_entries(value):
+    with pytest.raises(ValueError):
+        parse_schedule(value)
+
+def test_task_limit_applies_without_a_global_limit():
+    limiter = BandwidthLimiter()
+    task = DownloadTask('http://example.com/f', 'f', 0)
+    other = DownloadTask('http://example.com/g', 'g', 0)
+    assert limiter.reserve(task, 10 ** 6) == 0.0
+    limiter.set_task_limit(task, 1000)
+    limiter.reserve(task, 1000)
+    assert limiter.reserve(task, 1000) > 0.9
+    assert limiter.reserve(other, 10 ** 6) == 0.0
+
+def test_changing_the_limit_wakes_sleepers():
+    limiter = BandwidthLimiter(1)
+    wakeup = limiter.wakeup
+    limiter.set_rate(0)
+    assert wakeup.is_set()
+    assert not limiter.wakeup.is_set()
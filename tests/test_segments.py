@@ -0,0 +1,71 @@
+import time
+
+from kdm.integrity import PIECE_SIZE
+from kdm.segments import Segment, SegmentScheduler, written_until
+from kdm.task import DownloadTask
+
+MB = 1048576
+
+def scheduler_for(*segments):
+    task = DownloadTask('http://example.com/f', 'f', max(s.end for s in segments) + 1)
+    task.segments = list(segments)
+    return SegmentScheduler(task)
+
+def test_idle_segments_go_out_largest_first():
+    scheduler = scheduler_for(Segment(0, MB - 1), Segment(MB, 4 * MB - 1), Segment(4 * MB, 5 * MB - 1))
+    seg, cursor = scheduler.acquire()
+    assert (seg.start, seg.end) == (MB, 4 * MB - 1)
+    assert cursor == [MB]
+    assert seg.workers == 1
+
+def test_busy_segment_is_split_on_a_piece_boundary():
+    scheduler = scheduler_for(Segment(0, 16 * MB - 1))
+    first, cursor = scheduler.acquire()
+    cursor[0] = 3 * MB  # Its worker got this far
+    second, _ = scheduler.acquire()
+    assert second.start % PIECE_SIZE == 0
+    assert first.end == second.start - 1
+    assert second.end == 16 * MB - 1
+    assert 3 * MB < second.start < 16 * MB
+    assert len(scheduler.segments) == 2
+
+def test_straggler_is_hedged_once_nothing_is_worth_splitting():
+    scheduler = scheduler_for(Segment(0, SegmentScheduler.MIN_PIECE - 1))
+    seg, _ = scheduler.acquire()
+    hedge, cursor = scheduler.acquire()
+    assert hedge is seg
+    assert seg.workers == 2
+    assert scheduler.acquire() is None
+
+def test_segments_backing_off_are_skipped_until_due():
+    scheduler = scheduler_for(Segment(0, MB - 1))
+    scheduler.segments[0].retry_at = time.monotonic() + 60
+    assert scheduler.acquire() is None
+    assert 59 < scheduler.next_retry() <= 60
+    scheduler.segments[0].retry_at = 0.0
+    assert scheduler.acquire() is not None
+
+def test_released_progress_stays_with_the_segment():
+    scheduler = scheduler_for(Segment(0, MB - 1))
+    seg, cursor = scheduler.acquire()
+    cursor[0] = 1000
+    scheduler.release(seg, cursor)
+    assert seg.workers == 0
+    assert seg.pos == 1000
+    assert scheduler.confirmed() == 1000
+    assert scheduler.acquire()[1] == [1000]
+
+def test_spare_counts_only_work_a_worker_can_take():
+    scheduler = scheduler_for(Segment(0, SegmentScheduler.MIN_PIECE - 1))
+    assert scheduler.spare() == 1
+    scheduler.acquire()
+    assert scheduler.spare() == 1  # One hedge
+    scheduler.acquire()
+    assert scheduler.spare() == 0
+    assert scheduler_for(Segment(0, 4 * MB - 1)).spare() == 4 * MB // SegmentScheduler.MIN_PIECE
+
+def test_written_until_stops_at_the_first_gap():
+    segments = [Segment(0, 99, 100), Segment(100, 199, 150), Segment(200, 299, 300)]
+    assert written_until(segments) == 150
+    assert scheduler_for(*segments).finished() is False
+    assert scheduler_for(Segment(0, 9, 10)).finished() is True
@@ -0,0 +1,84 @@
+import json
+import os
+
+from kdm.segments import Segment
+from kdm.storage import OutputFile, ResumeJournal, validators_match
+from kdm.task import DownloadTask
+
+def test_output_file_is_preallocated_and_written_at_offsets(tmp_path):
+    path = str(tmp_path / 'out.kdm')
+    output = OutputFile(path, 10)
+    assert os.path.getsize(path) == 10
+    output.write_at(6, b'wxyz')
+    output.write_at(0, b'abc')
+    output.write_many(3, [b'd', b'ef'])
+    assert output.read_at(0, 10) == b'abcdefwxyz'
+    output.close()
+
+def test_output_file_keeps_data_unless_truncated(tmp_path):
+    path = str(tmp_path / 'out.kdm')
+    output = OutputFile(path, 4)
+    output.write_at(0, b'keep')
+    output.close()
+    output = OutputFile(path, 4)
+    assert output.read_at(0, 4) == b'keep'
+    output.close()
+    output = OutputFile(path, 4, truncate=True)
+    assert output.read_at(0, 4) == b'\0' * 4
+    output.close()
+
+def test_finalize_moves_the_file_into_place(tmp_path):
+    output = OutputFile(str(tmp_path / 'out.kdm'), 3)
+    output.write_at(0, b'end')
+    output.finalize(str(tmp_path / 'out'))
+    assert (tmp_path / 'out').read_bytes() == b'end'
+    assert not (tmp_path / 'out.kdm').exists()
+
+def journaled_task(tmp_path):
+    task = DownloadTask('http://example.com/f', str(tmp_path / 'f'), 300)
+    task.etag = '"v1"'
+    task.segments = [Segment(0, 99, 100), Segment(100, 199, 150), Segment(200, 299)]
+    output = OutputFile(task.temp_filename, task.total_size)
+    journal = ResumeJournal(task)
+    journal.save(output)
+    output.close()
+    return task, journal
+
+def test_journal_restores_segments(tmp_path):
+    task, journal = journaled_task(tmp_path)
+    state = journal.load()
+    restored = DownloadTask(task.url, task.filename, 300)
+    restored.etag = '"v1"'
+    segments = ResumeJournal(restored).restore(state)
+    assert [(s.start, s.end, s.pos) for s in segments] == [(0, 99, 100), (100, 199, 150), (200, 299, 200)]
+
+def test_journal_is_dropped_when_the_file_changed(tmp_path):
+    task, journal = journaled_task(tmp_path)
+    changed = DownloadTask(task.url, task.filename, 300)
+    changed.etag = '"v2"'
+    assert ResumeJournal(changed).restore(journal.load()) is None
+    resized = DownloadTask(task.url, task.filename, 301)
+    assert ResumeJournal(resized).restore(journal.load()) is None
+
+def test_truncated_temp_file_only_loses_what_it_no_longer_holds(tmp_path):
+    task, journal = journaled_task(tmp_path)
+    os.truncate(task.temp_filename, 120)
+    segments = ResumeJournal(task).restore(journal.load())
+    assert [s.pos for s in segments] == [100, 120, 200]
+
+def test_corrupt_or_foreign_journal_is_ignored(tmp_path):
+    task, journal = journaled_task(tmp_path)
+    with open(journal.path, 'w') as f:
+        f.write('{not json')
+    assert journal.load() is None
+    with open(journal.path, 'w') as f:
+        json.dump({'version': ResumeJournal.VERSION + 1}, f)
+    assert journal.load() is None
+    journal.remove()
+    assert not os.path.exists(journal.path)
+
+def test_validators_only_disagree_when_both_sides_know_one():
+    assert validators_match('"a"', None, '"a"', 'Mon')
+    assert not validators_match('"a"', None, '"b"', None)
+    assert not validators_match(None, 'Mon', None, 'Tue')
+    assert validators_match('"a"', None, None, 'Tue')